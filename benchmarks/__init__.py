@@ -0,0 +1,4 @@
+'''
+Benchmarks of the write and read paths of versionalchemy against on-disk SQLite. Run them with
+``make benchmark`` or ``python -m benchmarks``, see ``python -m benchmarks --help``.
+'''
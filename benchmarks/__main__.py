@@ -0,0 +1,58 @@
+'''
+Runs the benchmarks and optionally writes their results as JSON and compares them to the results
+of an earlier run, e.g.::
+
+    python -m benchmarks --output master.json
+    python -m benchmarks --output branch.json --compare master.json
+'''
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import sys
+
+from benchmarks import bench_read, bench_write, harness  # noqa
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__.strip())
+    parser.add_argument('-o', '--output', help='a file to write the results to as JSON')
+    parser.add_argument(
+        '-k', '--filter', help='only run the benchmarks whose names contain this string'
+    )
+    parser.add_argument(
+        '--compare', metavar='BASELINE', help='the JSON results of an earlier run to compare to'
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='the relative change of the median time reported as a regression (default: 0.1)',
+    )
+    parser.add_argument(
+        '--quick', action='store_true',
+        help='time a single call of each benchmark, e.g. to check that they run',
+    )
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        results = harness.run(args.filter, repeat=1, min_time=0, log=print)
+    else:
+        results = harness.run(args.filter, log=print)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if not args.compare:
+        return 0
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    print('\nCompared to {}:'.format(baseline.get('commit') or args.compare))
+    rows = harness.compare(baseline, results, threshold=args.threshold)
+    for description, before, after, ratio, status in rows:
+        print('{:<50} {:>12.1f} us {:>12.1f} us {:>7.2f}x {}'.format(
+            description, before * 1e6, after * 1e6, ratio, status
+        ))
+    return 1 if any(status == 'regression' for _, _, _, _, status in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+'''
+Benchmarks of the read path: every mode of :func:`versionalchemy.api.get` against the depth of
+the history of the rows.
+'''
+from __future__ import absolute_import
+
+import contextlib
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.harness import benchmark, sqlite_engine
+from benchmarks.models import make_models, make_values
+from versionalchemy import api, bulk
+
+#: The number of rows whose history is read
+NUM_ROWS = 100
+NUM_COLUMNS = 5
+
+
+@benchmark('get', mode=['va_id', 'latest', 'as_of', 'range'], depth=[1, 10, 100])
+@contextlib.contextmanager
+def get(mode, depth):
+    '''
+    Reads the history of rows which have depth versions each, from the version in the middle of
+    it for the va_id, as_of and range modes.
+    '''
+    with sqlite_engine() as engine:
+        Base, Model, ArchiveModel = make_models(NUM_COLUMNS)
+        Base.metadata.create_all(engine)
+        Model.register(ArchiveModel, engine)
+        session = sessionmaker(bind=engine)()
+        middle = _write_history(session, Model, depth)
+        kwargs = {
+            'va_id': {'va_id': middle['va_id']},
+            'latest': {},
+            'as_of': {'t1': middle['time']},
+            'range': {'t1': middle['time'], 't2': datetime.now()},
+        }[mode]
+        try:
+            yield lambda: api.get(Model, session, page_size=NUM_ROWS * depth, **kwargs)
+        finally:
+            session.close()
+
+
+def _write_history(session, Model, depth):
+    '''
+    Writes depth versions of each row.
+
+    :return: a dict of the time and the largest va_id once the version in the middle of the \
+    history was written
+    '''
+    middle = None
+    for version in range(depth):
+        if version == 0:
+            bulk.bulk_insert_mappings(session, Model, [
+                dict(make_values(NUM_COLUMNS, 0), product_id=i) for i in range(NUM_ROWS)
+            ])
+            ids = [row[0] for row in session.execute(sa.select([Model.id]))]
+        else:
+            bulk.bulk_update_mappings(session, Model, [
+                dict(make_values(NUM_COLUMNS, version), id=row_id) for row_id in ids
+            ])
+        session.commit()
+        if version == depth // 2:
+            middle = {
+                'time': datetime.now(),
+                'va_id': session.execute(
+                    sa.select([sa.func.max(Model.ArchiveTable.va_id)])
+                ).scalar(),
+            }
+    return middle
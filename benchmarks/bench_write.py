@@ -0,0 +1,92 @@
+'''
+Benchmarks of the write path: flushes, the serialization of rows into ``va_data`` and the
+encoding of ``va_data``.
+'''
+from __future__ import absolute_import
+
+import contextlib
+import itertools
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.harness import benchmark, sqlite_engine
+from benchmarks.models import make_models, make_values
+from versionalchemy import utils
+
+
+@benchmark(
+    'flush',
+    op=['insert', 'update'],
+    rows=[1, 100, 1000],
+    columns=[5, 50],
+    versioned=[True, False],
+)
+@contextlib.contextmanager
+def flush(op, rows, columns, versioned):
+    '''
+    Commits a session which inserts or updates rows, with or without versioning, so the cost
+    of the flush handler is the difference between the two. The rows inserted by a round are
+    deleted before the next one, so every round inserts into tables of the same size.
+    '''
+    with sqlite_engine() as engine:
+        Base, Model, ArchiveModel = make_models(columns, versioned=versioned)
+        Base.metadata.create_all(engine)
+        if versioned:
+            Model.register(ArchiveModel, engine)
+        # Objects are not expired so updates do not load them again
+        session = sessionmaker(bind=engine, expire_on_commit=False)()
+        objs = [Model(product_id=i, **make_values(columns, i)) for i in range(rows)]
+        session.add_all(objs)
+        session.commit()
+        counter = itertools.count(1)
+
+        def insert():
+            start = next(counter) * rows
+            session.add_all([
+                Model(product_id=i, **make_values(columns, i)) for i in range(start, start + rows)
+            ])
+            session.commit()
+
+        def reset():
+            session.expunge_all()
+            for table in (Model, ArchiveModel):
+                if table is not None:
+                    session.execute(sa.delete(table.__table__).where(table.product_id >= rows))
+            session.commit()
+
+        def update():
+            n = next(counter)
+            for obj in objs:
+                obj.col0 = 'value {}'.format(n)
+            session.commit()
+
+        try:
+            yield (reset, insert) if op == 'insert' else update
+        finally:
+            session.close()
+
+
+@benchmark('to_dict', columns=[5, 20, 50])
+@contextlib.contextmanager
+def to_dict(columns):
+    with sqlite_engine() as engine:
+        Base, Model, ArchiveModel = make_models(columns)
+        Base.metadata.create_all(engine)
+        Model.register(ArchiveModel, engine)
+        row = Model(product_id=1, **make_values(columns, 1))
+        yield lambda: row._to_dict(engine.dialect)
+
+
+@benchmark('json_serde', op=['dumps', 'loads'], keys=[10, 100, 1000])
+@contextlib.contextmanager
+def json_serde(op, keys):
+    col_type = utils.JSONEncodedDict()
+    dialect = sqlite.dialect()
+    data = make_values(keys, 1)
+    if op == 'dumps':
+        yield lambda: col_type.process_bind_param(data, dialect)
+    else:
+        text = col_type.process_bind_param(data, dialect)
+        yield lambda: col_type.process_result_value(text, dialect)
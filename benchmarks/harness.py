@@ -0,0 +1,194 @@
+'''
+A minimal benchmark runner with no dependencies outside the standard library. Benchmarks are
+registered with :func:`benchmark` and their results are written as JSON, so that runs of different
+commits can be compared with :func:`compare`.
+'''
+from __future__ import absolute_import, division
+
+import contextlib
+import datetime
+import itertools
+import os
+import platform
+import sqlite3
+import subprocess
+import tempfile
+import timeit
+
+import six
+import sqlalchemy as sa
+
+#: The version of the format of the results
+RESULTS_FORMAT = 1
+
+_benchmarks = []
+
+
+def benchmark(name, **params):
+    '''
+    :param name: the name of the benchmark
+    :param params: lists of the values of each parameter; the benchmark is run for every \
+        combination of them
+
+    Registers a benchmark. The decorated function takes one value of each parameter and returns
+    a context manager, which sets up what is measured, yields the callable which is timed and
+    cleans up when it exits. It may instead yield a ``(setup, callable)`` tuple, in which case
+    setup is called before each round, see :func:`measure`.
+    '''
+    def decorator(func):
+        _benchmarks.append((name, func, params))
+        return func
+    return decorator
+
+
+def get_benchmarks(name_filter=None):
+    '''
+    :param name_filter: if specified, only the benchmarks whose names contain it are returned
+
+    :return: a list of ``(name, func, params)`` tuples for every combination of parameters of \
+    the registered benchmarks
+    :rtype: list
+    '''
+    result = []
+    for name, func, params in _benchmarks:
+        if name_filter is not None and name_filter not in name:
+            continue
+        param_names = sorted(params)
+        for values in itertools.product(*(params[p] for p in param_names)):
+            result.append((name, func, dict(zip(param_names, values))))
+    return result
+
+
+def measure(func, repeat=5, min_time=0.2, setup=None):
+    '''
+    :param func: the callable to time
+    :param repeat: the number of rounds
+    :param min_time: the minimum number of seconds of each round; the number of calls per round \
+        is increased until a round takes at least this long
+    :param setup: an optional callable which is called before each round and not timed, e.g. to \
+        reset the state which func changes
+
+    :return: a dict of the number of calls per round and the min, median, mean and standard \
+    deviation of the seconds per call across rounds
+    :rtype: dict
+    '''
+    timer = timeit.default_timer
+
+    def run_round(number):
+        if setup is not None:
+            setup()
+        start = timer()
+        for _ in six.moves.range(number):
+            func()
+        return timer() - start
+
+    number = 1
+    elapsed = run_round(number)
+    while elapsed < min_time:
+        number *= 10 if elapsed < min_time / 10 else 2
+        elapsed = run_round(number)
+    times = sorted([elapsed / number] + [
+        run_round(number) / number for _ in six.moves.range(repeat - 1)
+    ])
+    mean = sum(times) / len(times)
+    middle = len(times) // 2
+    median = times[middle] if len(times) % 2 else (times[middle - 1] + times[middle]) / 2
+    return {
+        'number': number,
+        'repeat': len(times),
+        'min': times[0],
+        'median': median,
+        'mean': mean,
+        'stddev': (sum((t - mean) ** 2 for t in times) / len(times)) ** 0.5,
+    }
+
+
+def run(name_filter=None, repeat=5, min_time=0.2, log=None):
+    '''
+    Runs the benchmarks whose names contain name_filter, see :func:`measure`.
+
+    :param log: an optional callable which is called with a line of text after each benchmark
+
+    :return: the results, which can be serialized as JSON
+    :rtype: dict
+    '''
+    results = []
+    for name, func, params in get_benchmarks(name_filter):
+        with func(**params) as timed:
+            setup = None
+            if isinstance(timed, tuple):
+                setup, timed = timed
+            result = dict(measure(timed, repeat=repeat, min_time=min_time, setup=setup))
+        result.update(name=name, params=params)
+        results.append(result)
+        if log is not None:
+            log('{:<50} {:>12.1f} us'.format(_describe(result), result['median'] * 1e6))
+    return {
+        'format': RESULTS_FORMAT,
+        'commit': _get_commit(),
+        'created_at': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'sqlalchemy': sa.__version__,
+        'sqlite': sqlite3.sqlite_version,
+        'results': results,
+    }
+
+
+def compare(baseline, results, threshold=0.1):
+    '''
+    :param baseline: results returned by :func:`run` for an earlier commit
+    :param results: results returned by :func:`run`
+    :param threshold: the relative change of the median time above which a benchmark is \
+        reported as a regression or an improvement
+
+    :return: a list of ``(description, baseline median, median, ratio, status)`` tuples of the \
+    benchmarks in both results, where status is ``'regression'``, ``'improvement'`` or ``''``
+    :rtype: list
+    '''
+    baseline_medians = {_describe(r): r['median'] for r in baseline['results']}
+    rows = []
+    for result in results['results']:
+        description = _describe(result)
+        if description not in baseline_medians:
+            continue
+        ratio = result['median'] / baseline_medians[description]
+        status = ''
+        if ratio > 1 + threshold:
+            status = 'regression'
+        elif ratio < 1 / (1 + threshold):
+            status = 'improvement'
+        rows.append((description, baseline_medians[description], result['median'], ratio, status))
+    return rows
+
+
+@contextlib.contextmanager
+def sqlite_engine():
+    '''
+    Yields an engine of a new SQLite database file, which is deleted when the context exits.
+    '''
+    fd, path = tempfile.mkstemp(suffix='.db', prefix='va-benchmark-')
+    os.close(fd)
+    engine = sa.create_engine('sqlite:///{}'.format(path))
+    try:
+        yield engine
+    finally:
+        engine.dispose()
+        os.remove(path)
+
+
+def _describe(result):
+    params = ','.join('{}={}'.format(k, result['params'][k]) for k in sorted(result['params']))
+    return '{}[{}]'.format(result['name'], params)
+
+
+def _get_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            commit = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull,
+            )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode('ascii').strip()
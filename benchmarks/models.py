@@ -0,0 +1,56 @@
+from __future__ import absolute_import
+
+from sqlalchemy import Column, Index, Integer, String, UniqueConstraint
+from sqlalchemy.ext.declarative import declarative_base
+
+import versionalchemy
+from versionalchemy.models import VALogMixin, VAModelMixin
+
+
+def make_models(num_columns, versioned=True):
+    '''
+    :param num_columns: the number of columns of the user table besides its id and product_id
+    :param versioned: whether the user table inherits from \
+        :class:`~versionalchemy.models.VAModelMixin`
+
+    :return: a new declarative base with the models of a user table versioned by product_id, and \
+    of its log table if versioned (else None)
+    :rtype: tuple
+    '''
+    versionalchemy.init()
+    Base = declarative_base()
+    attrs = {
+        '__tablename__': 'bench_table',
+        '__table_args__': (UniqueConstraint('product_id'),),
+        'id': Column(Integer, primary_key=True),
+        'product_id': Column(Integer, nullable=False),
+    }
+    for i in range(num_columns):
+        attrs['col{}'.format(i)] = Column(Integer if i % 2 else String(50))
+    if not versioned:
+        return Base, type('BenchTable', (Base,), attrs), None
+
+    attrs['va_version_columns'] = ['product_id']
+    Model = type('BenchTable', (VAModelMixin, Base), attrs)
+    ArchiveModel = type('BenchArchiveTable', (VALogMixin, Base), {
+        '__tablename__': 'bench_table_archive',
+        '__table_args__': (
+            UniqueConstraint('product_id', 'va_version'),
+            Index(None, 'product_id', 'va_updated_at'),
+            Index(None, 'va_updated_at'),
+        ),
+        'product_id': Column(Integer, nullable=False),
+        'user_id': Column(String(50)),
+    })
+    return Base, Model, ArchiveModel
+
+
+def make_values(num_columns, n):
+    '''
+    :return: the values of the columns of a row of the user table returned by \
+    :func:`make_models`, which differ for each n
+    :rtype: dict
+    '''
+    return {
+        'col{}'.format(i): n if i % 2 else 'value {} of row'.format(n) for i in range(num_columns)
+    }
@@ -14,11 +14,13 @@ dev_requires = [
     "ipython",
     "isort>=4.3.21",
     'mock;python_version=="2.7"',
+    "msgpack>=0.6",
     "nose",
     "pip-tools",
     "pylint",
     "sphinx",
     "sphinx-rtd-theme<0.2",
+    "zstandard",
 ]
 
 with open("VERSION") as version_fd:
@@ -60,7 +62,11 @@ setup(
     license='MIT License',
     packages=['versionalchemy', 'versionalchemy/api', 'versionalchemy/models'],
     install_requires=install_requires,
-    extras_require={"dev": dev_requires},
+    extras_require={
+        "dev": dev_requires,
+        "msgpack": ["msgpack>=0.6"],
+        "zstd": ["zstandard"],
+    },
     # Currently `versionalchemy` supports Python 2.7, and Python 3.6+
     python_requires=">=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, !=3.4.*, !=3.5.*, <4",
     include_package_data=True,
@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 
-from sqlalchemy import Boolean, Column, Integer, String, UniqueConstraint
+from sqlalchemy import Boolean, Column, Index, Integer, String, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 
 from versionalchemy.models import VALogMixin, VAModelMixin
@@ -30,6 +30,8 @@ class ArchiveTable(VALogMixin, Base):
 
     __table_args__ = (
         UniqueConstraint('product_id', 'va_version', name='product_id'),
+        Index(None, 'product_id', 'va_updated_at'),
+        Index(None, 'va_updated_at'),
     )
 
 
@@ -54,4 +56,31 @@ class MultiColumnArchiveTable(VALogMixin, Base):
     user_id = Column(String(50))
     __table_args__ = (
         UniqueConstraint('product_id_1', 'product_id_2', 'va_version'),
+        Index(None, 'product_id_1', 'product_id_2', 'va_updated_at'),
+        Index(None, 'va_updated_at'),
+    )
+
+
+class CounterUserTable(VAModelMixin, Base):
+    __tablename__ = 'counter_test_table'
+    va_version_columns = ['product_id']
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, nullable=False)
+    col1 = Column(String(50))
+    va_version = Column(Integer)
+
+    __table_args__ = (
+        UniqueConstraint('product_id'),
+    )
+
+
+class CounterArchiveTable(VALogMixin, Base):
+    __tablename__ = 'counter_test_table_archive'
+    product_id = Column(Integer, nullable=False)
+    user_id = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('product_id', 'va_version'),
+        Index(None, 'product_id', 'va_updated_at'),
+        Index(None, 'va_updated_at'),
     )
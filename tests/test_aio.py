@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+
+import unittest
+
+from tests.models import UserTable
+from tests.utils import SQLiteFileTestBase
+from versionalchemy.api import get
+
+try:
+    import asyncio
+    from versionalchemy.api.aio import AsyncAPI
+except ImportError:  # PY2
+    asyncio = None
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class TestAsyncAPI(SQLiteFileTestBase):
+    def setUp(self):
+        super(TestAsyncAPI, self).setUp()
+        self.session.add_all([UserTable(**p) for p in (self.p1, self.p2, self.p3)])
+        self.session.commit()
+
+        self.api = AsyncAPI(self.Session, max_workers=2)
+        self.addCleanup(self.api.shutdown)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+
+    def _run(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_get(self):
+        conds = [{'product_id': 10}]
+        result = self._run(self.api.get(UserTable, conds=conds))
+        self.assertEqual(result, get(UserTable, self.session, conds=conds))
+        self.assertEqual(result[0]['va_data']['col1'], 'foobar')
+
+    def test_get_each(self):
+        conds_list = [[{'product_id': product_id}] for product_id in (2546, 10, 11, 12)]
+        results = self._run(self.api.get_each(UserTable, conds_list, fields=['col1']))
+        self.assertEqual(
+            [[r['va_data'] for r in result] for result in results],
+            [[{'col1': 'test'}], [{'col1': 'foobar'}], [{'col1': 'baz'}], []],
+        )
+
+    def test_delete(self):
+        self._run(self.api.delete(UserTable, [{'product_id': 10}]))
+        self.session.expire_all()
+        self.assertEqual(get(UserTable, self.session, conds=[{'product_id': 10}]), [])
+        self.assertEqual(len(get(UserTable, self.session)), 2)
+
+    def test_errors_are_raised(self):
+        with self.assertRaises(ValueError):
+            self._run(self.api.get(UserTable, conds=[{'foo': 1}]))
+        with self.assertRaises(ValueError):
+            self._run(self.api.delete(UserTable, [{'foo': 1}]))
+        self.assertEqual(len(get(UserTable, self.session)), 3)
@@ -7,12 +7,20 @@ from itertools import chain
 import six
 import sqlalchemy as sa
 from six.moves import range, zip
-from sqlalchemy import func
+from sqlalchemy import Column, DateTime, func, Index, Integer, String, UniqueConstraint
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.ext.declarative import declarative_base
 
 from tests.models import ArchiveTable, MultiColumnUserTable, UserTable
-from tests.utils import SQLiteTestBase
-from versionalchemy.api import delete, get
-from versionalchemy.api.data import _get_conditions_list
+from tests.utils import SQLiteFileTestBase, SQLiteTestBase
+from versionalchemy.api import delete, get, get_many, iter_history
+from versionalchemy.api.data import (
+    _get_conditions_list,
+    _get_fields_column,
+    _supports_window_functions,
+    _unpack_fields,
+)
+from versionalchemy.models import VALogMixin, VAModelMixin
 from versionalchemy.utils import get_dialect
 
 try:
@@ -20,6 +28,34 @@ try:
 except ImportError:
     import mock
 
+Base = declarative_base()
+
+
+class DateUserTable(VAModelMixin, Base):
+    __tablename__ = 'date_test_table'
+    va_version_columns = ['day', 'name']
+    id = Column(Integer, primary_key=True)
+    day = Column(DateTime, nullable=False)
+    name = Column(String(50), nullable=False)
+    col1 = Column(Integer)
+
+    __table_args__ = (
+        UniqueConstraint('day', 'name'),
+    )
+
+
+class DateArchiveTable(VALogMixin, Base):
+    __tablename__ = 'date_test_table_archive'
+    day = Column(DateTime, nullable=False)
+    name = Column(String(50), nullable=False)
+    user_id = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('day', 'name', 'va_version'),
+        Index(None, 'day', 'name', 'va_updated_at'),
+        Index(None, 'va_updated_at'),
+    )
+
 
 class TestDeleteAPI(SQLiteTestBase):
     def setUp(self):
@@ -403,6 +439,110 @@ class TestGetAPI(SQLiteTestBase):
         self.p1_history[-1]['va_data']['invalid_col'] = None
         self._assert_result(result, self.p1_history[-1:], fields=fields)
 
+    def test_fields_pushdown(self):
+        kwargs = dict(t1=datetime.utcfromtimestamp(9), t2=datetime.utcfromtimestamp(45))
+        with mock.patch('versionalchemy.api.data._get_fields_column', return_value=None):
+            expected = {
+                tuple(fields): get(UserTable, self.session, fields=fields, **kwargs)
+                for fields in (['col1'], ['col2', 'other_name', 'invalid_col'])
+            }
+        for fields, result in six.iteritems(expected):
+            with self._record_statements() as statements:
+                self.assertEqual(get(UserTable, self.session, fields=fields, **kwargs), result)
+                self.assertEqual(list(iter_history(
+                    UserTable, self.session, fields=fields, batch_size=2, **kwargs
+                )), result)
+            if get_dialect(self.session).server_version_info >= (3, 38):
+                self.assertTrue(all('json_extract' in s for s in statements))
+
+    def test_fields_with_quotes(self):
+        self.session.execute(sa.insert(ArchiveTable.__table__).values(
+            product_id=100,
+            va_version=0,
+            va_deleted=False,
+            va_updated_at=datetime.utcfromtimestamp(10),
+            va_data={'col1': 'a', 'a"b': 1},
+        ))
+        self.assertIsNone(_get_fields_column(
+            ArchiveTable, get_dialect(self.session), ['col1', 'a"b']
+        ))
+        result = get(
+            UserTable, self.session, t1=self.t1, conds=[{'product_id': 100}], fields=['col1', 'a"b']
+        )
+        self.assertEqual(result[0]['va_data'], {'col1': 'a', 'a"b': 1})
+
+    def test_fields_column(self):
+        fields = ['col1', 'col2']
+        dialect = mysql.dialect()
+        dialect.server_version_info = (8, 0, 20)
+        self.assertIn(
+            'json_array(json_extract(', str(_get_fields_column(ArchiveTable, dialect, fields))
+        )
+        dialect.server_version_info = (5, 6)
+        self.assertIsNone(_get_fields_column(ArchiveTable, dialect, fields))
+        dialect.server_version_info = (8, 0, 20)
+        self.assertIsNone(_get_fields_column(ArchiveTable, dialect, fields + ['a\\b']))
+
+        dialect = postgresql.dialect()
+        dialect.server_version_info = (12, 0)
+        self.assertIn(
+            'jsonb_build_array(', str(_get_fields_column(ArchiveTable, dialect, fields))
+        )
+        with mock.patch.object(ArchiveTable, '_va_deltas', True):
+            self.assertIsNone(_get_fields_column(ArchiveTable, dialect, fields))
+
+        # The arrays are returned as JSON text or, e.g. by psycopg2, already parsed
+        for values in ('["a", 1]', ['a', 1]):
+            self.assertEqual(
+                _unpack_fields([{'va_data': values}], fields),
+                [{'va_data': {'col1': 'a', 'col2': 1}}],
+            )
+
+    def test_time_slice_strategies(self):
+        with mock.patch('versionalchemy.models.datetime') as p:
+            p.now.return_value = datetime.utcfromtimestamp(50)
+            self.session.delete(self.session.query(UserTable).filter_by(product_id=11).one())
+            self.session.flush()
+        self.assertTrue(_supports_window_functions(get_dialect(self.session)))
+
+        for t in range(5, 60, 5):
+            for kwargs, latest in [
+                ({}, 3),
+                ({'include_deleted': False}, 2),
+                ({'conds': [{'product_id': 11}]}, 1),
+            ]:
+                t1 = datetime.utcfromtimestamp(t)
+                with self._record_statements() as statements:
+                    ranked = get(UserTable, self.session, t1=t1, **kwargs)
+                self.assertIn('row_number()', statements[-1])
+                with mock.patch(
+                    'versionalchemy.api.data._supports_window_functions', return_value=False
+                ):
+                    self.assertEqual(get(UserTable, self.session, t1=t1, **kwargs), ranked)
+                if t == 55:
+                    self.assertEqual(len(ranked), latest)
+
+        dialect = mysql.dialect()
+        dialect.server_version_info = (5, 7, 30)
+        self.assertFalse(_supports_window_functions(dialect))
+        dialect.server_version_info = (10, 3, 22, 'MariaDB')
+        self.assertTrue(_supports_window_functions(dialect))
+        self.assertTrue(_supports_window_functions(postgresql.dialect()))
+
+    def test_changes_exclude_deleted(self):
+        with mock.patch('versionalchemy.models.datetime') as p:
+            p.now.return_value = datetime.utcfromtimestamp(50)
+            self.session.delete(self.session.query(UserTable).filter_by(product_id=11).one())
+            self.session.flush()
+        result = get(
+            UserTable,
+            self.session,
+            t1=datetime.utcfromtimestamp(25),
+            t2=datetime.utcfromtimestamp(60),
+            include_deleted=False,
+        )
+        self._assert_result(result, [self.p1_history[2], self.p1_history[3], self.p2_history[1]])
+
     def test_failure_conditions(self):
         '''
         Pass invalid conds arguments and ensure the query fails.
@@ -486,6 +626,53 @@ class TestGetAPI(SQLiteTestBase):
             )
             self._assert_result(result, history[0:80:10], fields=['col1'])
 
+    def test_cursor_paging(self):
+        history = list(chain(self.p1_history, self.p2_history, self.p3_history))
+        for kwargs in [
+            {},
+            {'va_id': 0},
+            {'t1': datetime.utcfromtimestamp(0), 't2': datetime.utcfromtimestamp(45)},
+        ]:
+            expected = history if kwargs else [h[-1] for h in (
+                self.p1_history, self.p2_history, self.p3_history
+            )]
+            result, cursor = [], None
+            for _ in range(len(expected)):
+                page = get(UserTable, self.session, page_size=2, cursor=cursor, **kwargs)
+                result.extend(page)
+                cursor = page.cursor
+                if cursor is None:
+                    break
+            self.assertIsNone(cursor)
+            self._assert_result(result, expected)
+
+        page = get(UserTable, self.session, page_size=2, va_id=0)
+        self.assertEqual(page, get(UserTable, self.session, page_size=2, va_id=0, page=1))
+
+    def test_cursor_failure_conditions(self):
+        cursor = get(UserTable, self.session, page_size=1).cursor
+        with self.assertRaises(ValueError):
+            get(UserTable, self.session, page_size=1, page=2, cursor=cursor)
+        with self.assertRaises(ValueError):
+            get(UserTable, self.session, cursor='foo')
+
+    def test_iter_history(self):
+        for kwargs in [
+            {},
+            {'va_id': 3},
+            {'t1': datetime.utcfromtimestamp(25)},
+            {'t1': datetime.utcfromtimestamp(0), 't2': datetime.utcfromtimestamp(45)},
+            {'fields': ['col2'], 'conds': [{'product_id': 10}]},
+        ]:
+            expected = get(UserTable, self.session, **kwargs)
+            for batch_size in (1, 2, 1000):
+                result = iter_history(UserTable, self.session, batch_size=batch_size, **kwargs)
+                self.assertNotIsInstance(result, list)
+                self.assertEqual(list(result), expected)
+
+        with self.assertRaises(ValueError):
+            iter_history(UserTable, self.session, batch_size=0)
+
     def _assert_result(self, result, expected, fields=None):
         self.assertEqual(len(result), len(expected))
         for res, exp in zip(result, expected):
@@ -516,3 +703,89 @@ class TestGetAPI(SQLiteTestBase):
             'va_version': version,
             'product_id': row.product_id
         }
+
+
+class TestCursorTypes(SQLiteTestBase):
+    def setUp(self):
+        super(TestCursorTypes, self).setUp()
+        Base.metadata.create_all(self.engine)
+        DateUserTable.register(DateArchiveTable, self.engine)
+
+    def tearDown(self):
+        Base.metadata.drop_all(self.engine)
+        super(TestCursorTypes, self).tearDown()
+
+    def test_datetime_cursor_paging(self):
+        days = [datetime(2020, 1, 1, 12), datetime(2020, 1, 1, 12, 0, 0, 500), datetime(2020, 1, 2)]
+        rows = [DateUserTable(day=day, name=name) for day in days for name in ('a', 'b')]
+        self.session.add_all(rows)
+        self.session.commit()
+        for row in rows:
+            row.col1 = 1
+        self.session.commit()
+
+        for kwargs in [{}, {'va_id': 0}]:
+            result, cursor = [], None
+            while True:
+                page = get(DateUserTable, self.session, page_size=2, cursor=cursor, **kwargs)
+                result.extend(page)
+                cursor = page.cursor
+                if cursor is None:
+                    break
+            self.assertEqual(
+                [(r['va_data']['day'], r['va_data']['name'], r['va_version']) for r in result],
+                [
+                    (day.isoformat(), name, version)
+                    for day in days for name in ('a', 'b') for version in (kwargs and [0, 1] or [1])
+                ],
+            )
+
+
+class TestGetManyAPI(SQLiteFileTestBase):
+    def setUp(self):
+        super(TestGetManyAPI, self).setUp()
+        # products 0 - 9 are inserted at 10, odd ones are changed at 20 and 3 is deleted at 30
+        rows = [UserTable(product_id=i, col1='a', col2=i, col3=1) for i in range(10)]
+        for t, changes in [(10, rows), (20, rows[1::2]), (30, [])]:
+            with mock.patch('versionalchemy.models.datetime') as p:
+                p.now.return_value = datetime.utcfromtimestamp(t)
+                for row in changes:
+                    row.col1 = 'b' if t > 10 else row.col1
+                self.session.add_all(changes)
+                if t == 30:
+                    self.session.delete(rows[3])
+                self.session.commit()
+        # a change of col2 only, which is rolled up when fields is ['col1']
+        rows[4].col2 = 100
+        self.session.commit()
+
+    def test_get_many(self):
+        keys = [{'product_id': i} for i in (9, 4, 3, 0, 7, 12, 1, 4)]
+        for kwargs in [
+            {},
+            {'t1': datetime.utcfromtimestamp(15)},
+            {'t1': datetime.utcfromtimestamp(0), 't2': datetime.utcfromtimestamp(25)},
+            {'fields': ['col1']},
+            {'fields': ['col1'], 't1': datetime.utcfromtimestamp(0), 't2': datetime(2100, 1, 1)},
+            {'include_deleted': False, 't1': datetime.utcfromtimestamp(35)},
+        ]:
+            expected = get(UserTable, self.session, conds=keys, page_size=1000, **kwargs)
+            self.assertTrue(expected)
+            for chunk_size, max_workers in [(1, 1), (2, 3), (None, 4)]:
+                result = get_many(
+                    UserTable,
+                    self.Session,
+                    keys,
+                    chunk_size=chunk_size,
+                    max_workers=max_workers,
+                    **kwargs
+                )
+                self.assertEqual(result, expected)
+
+        self.assertEqual(get_many(UserTable, self.Session, []), [])
+        with self.assertRaises(ValueError):
+            get_many(UserTable, self.Session, keys, chunk_size=0)
+        with self.assertRaises(ValueError):
+            get_many(UserTable, self.Session, keys, max_workers=0)
+        with self.assertRaises(ValueError):
+            get_many(UserTable, self.Session, [{'foo': 1}])
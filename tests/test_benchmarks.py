@@ -0,0 +1,56 @@
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmarks import harness
+from benchmarks.__main__ import main
+
+try:
+    from unittest import mock  # PY3
+except ImportError:
+    import mock
+
+
+class TestBenchmarks(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_measure(self):
+        func = mock.Mock()
+        result = harness.measure(func, repeat=3, min_time=0)
+        self.assertEqual((result['number'], result['repeat']), (1, 3))
+        self.assertEqual(func.call_count, 3)
+        self.assertLessEqual(result['min'], result['median'])
+
+        setup = mock.Mock()
+        harness.measure(func, repeat=3, min_time=0, setup=setup)
+        self.assertEqual(setup.call_count, 3)
+
+    def test_get_benchmarks(self):
+        params = [params for _, _, params in harness.get_benchmarks('json_serde')]
+        self.assertEqual(len(params), 6)
+        self.assertIn({'op': 'loads', 'keys': 100}, params)
+
+    def test_run_and_compare(self):
+        path = os.path.join(self.tmp_dir, 'results.json')
+        with mock.patch('benchmarks.__main__.print'):
+            self.assertEqual(main(['--quick', '-k', 'to_dict', '--output', path]), 0)
+        with open(path) as f:
+            results = json.load(f)
+        self.assertEqual(
+            [r['params'] for r in results['results']],
+            [{'columns': 5}, {'columns': 20}, {'columns': 50}],
+        )
+
+        slower = dict(results, results=[
+            dict(r, median=r['median'] * 2) for r in results['results']
+        ])
+        rows = harness.compare(results, slower)
+        self.assertEqual([row[4] for row in rows], ['regression'] * 3)
+        self.assertEqual([row[4] for row in harness.compare(slower, results)], ['improvement'] * 3)
+        self.assertEqual([row[4] for row in harness.compare(results, results)], [''] * 3)
@@ -0,0 +1,351 @@
+from __future__ import absolute_import
+
+import json
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, oracle, postgresql
+from sqlalchemy.ext.declarative import declarative_base
+
+import versionalchemy as va
+from tests.models import ArchiveTable, CounterArchiveTable, CounterUserTable, UserTable
+from tests.utils import SQLiteTestBase
+from versionalchemy import bulk, utils, VAModelMixin
+from versionalchemy.api import get
+from versionalchemy.exceptions import LogTableCreationError
+from versionalchemy.models import VALogMixin
+from versionalchemy.outbox import drain, QueueOutbox
+from versionalchemy.triggers import create_triggers
+
+try:
+    from unittest import mock  # PY3
+except ImportError:
+    import mock
+
+
+Base = declarative_base()
+
+
+class UnregisteredTable(VAModelMixin, Base):
+    __tablename__ = 'unregistered_table'
+    id = sa.Column(sa.Integer, primary_key=True)
+
+
+class DateTimeTable(VAModelMixin, Base):
+    __tablename__ = 'bulk_datetime_table'
+    va_version_columns = ['product_id']
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    product_id = sa.Column(sa.Integer, unique=True)
+    value = sa.Column(sa.Integer)
+    ts = sa.Column(sa.DateTime)
+
+
+class DateTimeArchiveTable(VALogMixin, Base):
+    __tablename__ = 'bulk_datetime_table_archive'
+    __table_args__ = (sa.UniqueConstraint('product_id', 'va_version'),)
+    product_id = sa.Column(sa.Integer)
+    user_id = sa.Column(sa.String(50))
+
+
+class BulkTestMixin(object):
+    def _versions(self, ArchiveTable_=ArchiveTable):
+        return [
+            (r['product_id'], r['va_version'], r['va_deleted'])
+            for r in self._result_to_dict(self.session.execute(
+                sa.select([ArchiveTable_]).order_by(ArchiveTable_.va_id)
+            ))
+        ]
+
+    def _va_ids(self):
+        return dict(list(self.session.execute(
+            sa.select([UserTable.product_id, UserTable.va_id])
+        )))
+
+    def _latest_va_ids(self):
+        return {
+            r['product_id']: r['va_id'] for r in get(UserTable, self.session, include_deleted=False)
+        }
+
+
+class TestBulk(BulkTestMixin, SQLiteTestBase):
+    def test_bulk_insert_mappings(self):
+        with self._record_statements() as statements:
+            bulk.bulk_insert_mappings(
+                self.session, UserTable, [self.p1, self.p2, dict(self.p3, col4=5)], user_id='bob'
+            )
+        self.assertEqual(
+            self._count_statements(statements, 'INSERT', ArchiveTable.__tablename__), 1
+        )
+        self.assertEqual(self._count_statements(statements, 'UPDATE', UserTable.__tablename__), 1)
+        self.session.commit()
+
+        for p in (self.p1, self.p2):
+            self._verify_row(p, 0)
+            self._verify_archive(p, 0, user='bob')
+        self._verify_archive(dict(self.p3, other_name=5, id=3), 0)
+        self.assertEqual(self._va_ids(), self._latest_va_ids())
+
+    def test_insert_after_delete(self):
+        row = UserTable(**self.p1)
+        self.session.add(row)
+        self.session.commit()
+        self.session.delete(row)
+        self.session.commit()
+        bulk.bulk_insert_mappings(self.session, UserTable, [self.p1])
+        self.assertEqual(self._versions(), [(10, 0, False), (10, 1, True), (10, 2, False)])
+
+    def test_bulk_update_mappings(self):
+        bulk.bulk_insert_mappings(self.session, UserTable, [self.p1, self.p2, self.p3])
+        ids = dict(list(self.session.execute(sa.select([UserTable.product_id, UserTable.id]))))
+        with self._record_statements() as statements:
+            bulk.bulk_update_mappings(self.session, UserTable, [
+                {'id': ids[10], 'col1': 'changed', 'col4': 1},
+                {'id': ids[11], 'product_id': 12},
+                # Neither a change nor an existing row is versioned
+                {'id': ids[2546], 'col1': 'test'},
+                {'id': 100, 'col1': 'missing'},
+            ], user_id='bob')
+        # The latest versions and the va_ids of the inserted archive rows
+        self.assertEqual(
+            self._count_statements(statements, 'SELECT', ArchiveTable.__tablename__), 2
+        )
+        self.assertEqual(
+            self._count_statements(statements, 'INSERT', ArchiveTable.__tablename__), 1
+        )
+        self.assertEqual(self._count_statements(statements, 'UPDATE', UserTable.__tablename__), 2)
+        self.session.commit()
+
+        self.assertEqual(self._versions(), [
+            (10, 0, False), (11, 0, False), (2546, 0, False),
+            (10, 1, False), (11, 1, True), (12, 0, False),
+        ])
+        self._verify_row(dict(self.p1, col1='changed', other_name=1), 1)
+        self._verify_archive(dict(self.p1, col1='changed', other_name=1), 1, user='bob')
+        self._verify_archive(self.p2, 1, deleted=True)
+        self._verify_archive(dict(self.p2, product_id=12), 0)
+        self.assertEqual(self._va_ids(), self._latest_va_ids())
+
+    def test_bulk_save_objects(self):
+        p1 = UserTable(**self.p1)
+        self.session.add(p1)
+        self.session.commit()
+
+        p1.col1 = 'changed'
+        bulk.bulk_save_objects(self.session, [p1, UserTable(**self.p2)])
+        self.session.commit()
+        self.assertEqual(self._versions(), [(10, 0, False), (11, 0, False), (10, 1, False)])
+        self.assertEqual(p1.col1, 'changed')
+        self.assertEqual(self._va_ids(), self._latest_va_ids())
+
+        # Objects which are not in a session are saved too
+        self.session.expunge(p1)
+        p1.col1 = 'detached'
+        bulk.bulk_save_objects(self.session, [p1])
+        self.assertEqual(self._versions()[-1], (10, 2, False))
+
+    def test_triggers(self):
+        create_triggers(UserTable, ArchiveTable, self.engine)
+        UserTable.register(ArchiveTable, self.engine, triggers=True)
+        try:
+            bulk.bulk_insert_mappings(self.session, UserTable, [self.p1, self.p2])
+            bulk.bulk_update_mappings(self.session, UserTable, [{'id': 1, 'col1': 'changed'}])
+            query = self.session.query(UserTable).filter(UserTable.product_id == 11)
+            va.versioned_update(query, {'col1': 'changed'})
+            va.versioned_delete(query)
+        finally:
+            UserTable.register(ArchiveTable, self.engine)
+        self.assertEqual(self._versions(), [
+            (10, 0, False), (11, 0, False), (10, 1, False), (11, 1, False), (11, 2, True),
+        ])
+
+    def test_outbox(self):
+        outbox = QueueOutbox()
+        UserTable.register(ArchiveTable, self.engine, outbox=outbox)
+        try:
+            bulk.bulk_insert_mappings(self.session, UserTable, [self.p1, self.p2])
+            bulk.bulk_update_mappings(self.session, UserTable, [{'id': 1, 'col1': 'changed'}])
+            self.assertEqual(self._versions(), [])
+            self.session.commit()
+            self.assertEqual(drain(outbox, self.session), 3)
+            with self.assertRaises(ValueError):
+                va.versioned_update(self.session.query(UserTable), {'col1': 'changed'})
+        finally:
+            UserTable.register(ArchiveTable, self.engine)
+        self.assertEqual(self._versions(), [(10, 0, False), (11, 0, False), (10, 1, False)])
+        self.assertEqual(self._va_ids(), self._latest_va_ids())
+
+    def test_version_counter(self):
+        bulk.bulk_insert_mappings(self.session, CounterUserTable, [
+            {'product_id': 1, 'col1': 'a'}, {'product_id': 2, 'col1': 'a'},
+        ])
+        ids = dict(list(self.session.execute(
+            sa.select([CounterUserTable.product_id, CounterUserTable.id])
+        )))
+        bulk.bulk_update_mappings(self.session, CounterUserTable, [{'id': ids[1], 'col1': 'b'}])
+        va.versioned_update(
+            self.session.query(CounterUserTable).filter(CounterUserTable.product_id == 2),
+            {'col1': 'b'},
+        )
+        self.assertEqual(self._versions(CounterArchiveTable), [
+            (1, 0, False), (2, 0, False), (1, 1, False), (2, 1, False),
+        ])
+        self.assertEqual(
+            dict(list(self.session.execute(
+                sa.select([CounterUserTable.product_id, CounterUserTable.va_version])
+            ))),
+            {1: 1, 2: 1},
+        )
+
+    def test_mappings_are_validated(self):
+        with self.assertRaises(ValueError):
+            bulk.bulk_insert_mappings(self.session, UserTable, [{'col1': 'a'}])
+        with self.assertRaises(ValueError):
+            bulk.bulk_update_mappings(self.session, UserTable, [{'product_id': 10}])
+        # Mappings which change nothing write nothing
+        bulk.bulk_insert_mappings(self.session, UserTable, [])
+        bulk.bulk_update_mappings(self.session, UserTable, [{'id': 100, 'col1': 'a'}])
+        self.assertEqual(self._versions(), [])
+        with self.assertRaises(LogTableCreationError):
+            bulk.bulk_insert_mappings(self.session, UnregisteredTable, [{'id': 1}])
+
+
+class TestVersionedQueries(BulkTestMixin, SQLiteTestBase):
+    def setUp(self):
+        super(TestVersionedQueries, self).setUp()
+        self.session.add_all([UserTable(**p) for p in (self.p1, self.p2, self.p3)])
+        self.session.commit()
+
+    def test_versioned_update(self):
+        query = self.session.query(UserTable).filter(UserTable.col2 <= 11)
+        with self._record_statements() as statements:
+            count = va.versioned_update(
+                query, {UserTable.col1: 'changed', 'col2': UserTable.col2 + 1}, user_id='bob'
+            )
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            self._count_statements(statements, 'SELECT', UserTable.__tablename__), 1
+        )
+        self.assertEqual(
+            self._count_statements(statements, 'INSERT', ArchiveTable.__tablename__), 1
+        )
+        self.session.commit()
+
+        self.assertEqual(self._versions(), [
+            (10, 0, False), (11, 0, False), (2546, 0, False), (10, 1, False), (11, 1, False),
+        ])
+        self._verify_archive(dict(self.p1, col1='changed', col2=11), 1, user='bob')
+        self._verify_archive(dict(self.p2, col1='changed', col2=12), 1, user='bob')
+        self._verify_row(dict(self.p1, col1='changed', col2=11), 1)
+        self.assertEqual(self._va_ids(), self._latest_va_ids())
+
+        # Rows which do not change are not versioned
+        va.versioned_update(self.session.query(UserTable), {'col1': 'changed'})
+        self.assertEqual([v for _, v, _ in self._versions()], [0, 0, 0, 1, 1, 1])
+        self.assertEqual(self._va_ids(), self._latest_va_ids())
+
+    def test_versioned_update_of_keys(self):
+        p2 = self.session.query(UserTable).filter(UserTable.product_id == 11).one()
+        va.versioned_update(
+            self.session.query(UserTable).filter(UserTable.product_id == 11), {'product_id': 12}
+        )
+        self.assertEqual(p2.product_id, 12)
+        self.assertEqual(self._versions()[3:], [(11, 1, True), (12, 0, False)])
+        self._verify_archive(self.p2, 1, deleted=True)
+        self._verify_archive(dict(self.p2, product_id=12), 0)
+        self.assertEqual(self._va_ids(), self._latest_va_ids())
+
+    def test_versioned_delete(self):
+        count = va.versioned_delete(
+            self.session.query(UserTable).filter(UserTable.product_id != 11), user_id='bob'
+        )
+        self.assertEqual(count, 2)
+        self.session.commit()
+        self.assertEqual(self._versions()[3:], [(10, 1, True), (2546, 1, True)])
+        self._verify_archive(self.p1, 1, deleted=True, user='bob')
+        self.assertEqual(
+            [r['product_id'] for r in get(UserTable, self.session, include_deleted=False)], [11]
+        )
+
+    def test_query_is_validated(self):
+        with self.assertRaises(ValueError):
+            va.versioned_delete(self.session.query(UserTable.id))
+        with mock.patch.object(ArchiveTable.va_data, 'type', utils.CompressedJSONEncodedDict()):
+            with self.assertRaises(ValueError):
+                va.versioned_update(self.session.query(UserTable), {'col1': 'changed'})
+        self.assertEqual(len(self._versions()), 3)
+
+
+class TestVersionedDateTimes(SQLiteTestBase):
+    def setUp(self):
+        super(TestVersionedDateTimes, self).setUp()
+        Base.metadata.create_all(self.engine)
+        self.addCleanup(Base.metadata.drop_all, self.engine)
+        DateTimeTable.register(DateTimeArchiveTable, self.engine)
+
+    def _va_data(self):
+        return [
+            (r['product_id'], r['va_deleted'], r['va_data']['ts'])
+            for r in self._result_to_dict(self.session.execute(
+                sa.select([DateTimeArchiveTable]).order_by(DateTimeArchiveTable.va_id)
+            ))
+        ]
+
+    def test_datetimes_are_serialized_as_by_flushes(self):
+        ts = datetime(2020, 1, 1, 12, 30)
+        self.session.add_all([
+            DateTimeTable(product_id=1, value=0, ts=ts),
+            DateTimeTable(product_id=2, value=0, ts=ts.replace(microsecond=500)),
+            DateTimeTable(product_id=3, value=0),
+        ])
+        self.session.commit()
+        flushed = self._va_data()
+        self.assertEqual([v for _, _, v in flushed], [
+            '2020-01-01T12:30:00', '2020-01-01T12:30:00.000500', None,
+        ])
+
+        # Values of the user table and of the update are formatted alike
+        va.versioned_update(self.session.query(DateTimeTable), {'value': 1})
+        va.versioned_update(
+            self.session.query(DateTimeTable).filter(DateTimeTable.product_id == 3), {'ts': ts}
+        )
+        va.versioned_delete(self.session.query(DateTimeTable))
+        self.session.commit()
+        self.assertEqual(self._va_data()[3:], [
+            (p, False, v) for p, _, v in flushed
+        ] + [(3, False, '2020-01-01T12:30:00')] + [
+            (p, True, v) for p, _, v in flushed[:2]
+        ] + [(3, True, '2020-01-01T12:30:00')])
+
+
+class TestJSONObject(SQLiteTestBase):
+    # More pairs than are passed to one call of a JSON function, with NULL values
+    pairs = [
+        ('c{}'.format(i), sa.null() if i % 2 else sa.literal(i, type_=sa.Integer))
+        for i in range(120)
+    ]
+
+    def _compile(self, dialect):
+        return str(bulk._json_object(dialect, self.pairs).compile(dialect=dialect))
+
+    def test_sqlite(self):
+        result = self.session.execute(
+            sa.select([bulk._json_object(self.engine.dialect, self.pairs)])
+        ).scalar()
+        self.assertEqual(
+            json.loads(result), {'c{}'.format(i): None if i % 2 else i for i in range(120)}
+        )
+
+    def test_postgresql(self):
+        sql = self._compile(postgresql.dialect())
+        self.assertTrue(sql.startswith('CAST('))
+        self.assertEqual(sql.count('jsonb_build_object('), 3)
+        self.assertEqual(sql.count(' || '), 2)
+
+    def test_mysql(self):
+        sql = self._compile(mysql.dialect())
+        self.assertTrue(sql.startswith('json_object('))
+        self.assertEqual(sql.count('json_object('), 1)
+
+    def test_unsupported_dialect(self):
+        with self.assertRaises(NotImplementedError):
+            bulk._json_object(oracle.dialect(), self.pairs)
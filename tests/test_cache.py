@@ -0,0 +1,162 @@
+from __future__ import absolute_import
+
+import time
+from datetime import datetime
+
+import versionalchemy as va
+from tests.models import CounterUserTable, UserTable
+from tests.utils import SQLiteTestBase
+from versionalchemy.api import delete, get, ReadCache
+
+try:
+    from unittest import mock  # PY3
+except ImportError:
+    import mock
+
+
+class TestReadCache(SQLiteTestBase):
+    def setUp(self):
+        super(TestReadCache, self).setUp()
+        self.cache = ReadCache(maxsize=3, ttl=60)
+        self.other_session = self.Session()
+        self.addCleanup(self.other_session.close)
+        self.rows = [UserTable(**p) for p in (self.p1, self.p2, self.p3)]
+        with mock.patch('versionalchemy.models.datetime') as p:
+            p.now.return_value = datetime.utcfromtimestamp(10)
+            self.session.add_all(self.rows)
+            self.session.commit()
+
+    def _get(self, session=None, **kwargs):
+        '''
+        Returns the result of a cached get and whether it was read from the database.
+        '''
+        with self._record_statements() as statements:
+            result = get(UserTable, session or self.session, cache=self.cache, **kwargs)
+        return result, bool(statements)
+
+    def test_hit(self):
+        conds = [{'product_id': 10}]
+        result, queried = self._get(conds=conds, page_size=1)
+        self.assertTrue(queried)
+        self.assertEqual(result[0]['va_data']['col1'], 'foobar')
+
+        result[0]['va_data']['col1'] = 'changed'
+        cached, queried = self._get(conds=conds, page_size=1)
+        self.assertFalse(queried)
+        self.assertEqual(cached[0]['va_data']['col1'], 'foobar')
+        self.assertEqual(cached.cursor, result.cursor)
+
+        _, queried = self._get(conds=conds, page_size=1, fields=['col1'])
+        self.assertTrue(queried)
+
+    def test_flush_invalidates(self):
+        p1, p2 = [{'product_id': 10}], [{'product_id': 11}]
+        self._get(conds=p1)
+        self._get(conds=p2)
+        self._get()
+
+        self.rows[1].col1 = 'changed'
+        self.session.flush()
+        self.assertFalse(self._get(self.other_session, conds=p1)[1])
+        result, queried = self._get(self.other_session, conds=p2)
+        self.assertTrue(queried)
+        self.assertEqual(result[0]['va_data']['col1'], 'changed')
+        self.assertTrue(self._get(self.other_session)[1])
+
+        delete(UserTable, self.session, p1)
+        result, queried = self._get(self.other_session, conds=p1)
+        self.assertTrue(queried)
+        self.assertEqual(result, [])
+
+    def test_transaction_end_invalidates(self):
+        p2 = [{'product_id': 11}]
+        self.session.begin_nested()
+        self.rows[1].col1 = 'changed'
+        self.session.flush()
+        result, queried = self._get(conds=p2)
+        self.assertEqual(result[0]['va_data']['col1'], 'changed')
+        self.session.rollback()
+        result, queried = self._get(conds=p2)
+        self.assertTrue(queried)
+        self.assertEqual(result[0]['va_data']['col1'], 'baz')
+
+        self.rows[1].col1 = 'changed'
+        self.session.flush()
+        self.assertTrue(self._get(self.other_session, conds=p2)[1])
+        self.assertFalse(self._get(self.other_session, conds=p2)[1])
+        self.session.commit()
+        self.assertTrue(self._get(self.other_session, conds=p2)[1])
+        # Rows are only invalidated again by the transaction which wrote them
+        self.session.commit()
+        self.assertFalse(self._get(self.other_session, conds=p2)[1])
+
+    def test_pending_writes_are_not_cached(self):
+        p1, p2 = [{'product_id': 10}], [{'product_id': 11}]
+        self._get(self.other_session, conds=p1)
+        self.rows[1].col1 = 'changed'
+        self.session.flush()
+
+        # The transaction which wrote the table neither reads cached results nor caches its reads
+        self.assertTrue(self._get(conds=p1)[1])
+        result, queried = self._get(conds=p2)
+        self.assertTrue(queried)
+        self.assertEqual(result[0]['va_data']['col1'], 'changed')
+        self.assertEqual(len(self.cache), 1)
+        self.assertTrue(self._get(self.other_session, conds=p2)[1])
+
+        # Other tables are still cached
+        self.assertEqual(get(CounterUserTable, self.session, cache=self.cache), [])
+        self.assertEqual(len(self.cache), 3)
+        self.session.commit()
+        self.assertFalse(self._get(conds=p1)[1])
+
+    def test_versioned_queries_invalidate_every_row(self):
+        p1 = [{'product_id': 10}]
+        self._get(conds=p1)
+        self._get(conds=p1, fields=['col1'])
+        va.versioned_update(
+            self.session.query(UserTable).filter(UserTable.product_id == 11), {'col1': 'changed'}
+        )
+        self.assertTrue(self._get(self.other_session, conds=p1)[1])
+        self.assertTrue(self._get(self.other_session, conds=p1, fields=['col1'])[1])
+
+        # Every row is invalidated again when the transaction ends
+        self.rows[2].col1 = 'changed'
+        self.session.flush()
+        self.assertFalse(self._get(self.other_session, conds=p1)[1])
+        self.session.commit()
+        self.assertTrue(self._get(conds=p1)[1])
+
+    def test_set_and_clear(self):
+        key = ReadCache.make_key(UserTable, None, None)
+        self.cache.set(key, UserTable, None, ['a'])
+        self.cache.set(key, UserTable, None, ['b'])
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.get(key), ['b'])
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+        self.assertIsNone(self.cache.get(key))
+
+    def test_eviction(self):
+        now = time.time()
+        with mock.patch('versionalchemy.api.cache.time') as p:
+            p.time.return_value = now
+            for product_id in (10, 11, 2546):
+                self._get(conds=[{'product_id': product_id}])
+            self._get(t1=datetime.utcfromtimestamp(20))
+            self.assertEqual(len(self.cache), 3)
+            # the least recently used result is evicted
+            self.assertTrue(self._get(conds=[{'product_id': 10}])[1])
+
+            # results expire after the ttl except for historical queries
+            p.time.return_value = now + 61
+            self.assertFalse(self._get(t1=datetime.utcfromtimestamp(20))[1])
+            self.assertTrue(self._get(conds=[{'product_id': 2546}])[1])
+            self.assertTrue(self._get(conds=[{'product_id': 10}])[1])
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            ReadCache(maxsize=0)
+        with self.assertRaises(ValueError):
+            self._get(conds=[{'foo': 10}])
+        self.assertEqual(len(self.cache), 0)
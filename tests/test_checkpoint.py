@@ -0,0 +1,165 @@
+from __future__ import absolute_import
+
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy import Column, Index, Integer, String, UniqueConstraint
+from sqlalchemy.ext.declarative import declarative_base
+
+from tests.utils import SQLiteTestBase
+from versionalchemy.api import build_checkpoint, delete, get
+from versionalchemy.exceptions import LogTableCreationError
+from versionalchemy.models import VACheckpointMixin, VALogMixin, VAModelMixin
+
+try:
+    from unittest import mock  # PY3
+except ImportError:
+    import mock
+
+Base = declarative_base()
+
+
+class CheckpointUserTable(VAModelMixin, Base):
+    __tablename__ = 'checkpoint_test_table'
+    va_version_columns = ['product_id']
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, nullable=False)
+    col1 = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('product_id'),
+    )
+
+
+class CheckpointArchiveTable(VALogMixin, Base):
+    __tablename__ = 'checkpoint_test_table_archive'
+    product_id = Column(Integer, nullable=False)
+    user_id = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('product_id', 'va_version'),
+        Index(None, 'product_id', 'va_updated_at'),
+        Index(None, 'va_updated_at'),
+    )
+
+
+class CheckpointTable(VACheckpointMixin, Base):
+    __tablename__ = 'checkpoint_test_table_checkpoint'
+    product_id = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('product_id', 'va_checkpoint_at'),
+    )
+
+
+class NoConstraintCheckpointTable(VACheckpointMixin, Base):
+    __tablename__ = 'no_constraint_checkpoint'
+    product_id = Column(Integer, nullable=False)
+
+
+def ts(t):
+    return datetime.utcfromtimestamp(t)
+
+
+class TestCheckpoint(SQLiteTestBase):
+    UserTable = CheckpointUserTable
+
+    def setUp(self):
+        super(TestCheckpoint, self).setUp()
+        Base.metadata.create_all(self.engine)
+        CheckpointUserTable.register(
+            CheckpointArchiveTable, self.engine, CheckpointTable=CheckpointTable
+        )
+
+        # products 1 - 3 are changed every 10 seconds from 10 to 100; 2 is deleted at 55 and
+        # inserted again at 60, and 3 is only changed until 30
+        rows = {}
+        for t in range(10, 110, 10):
+            with mock.patch('versionalchemy.models.datetime') as p:
+                p.now.return_value = ts(t)
+                for product_id in (1, 2, 3):
+                    if product_id not in rows:
+                        rows[product_id] = CheckpointUserTable(product_id=product_id)
+                    elif product_id == 3 and t > 30:
+                        continue
+                    rows[product_id].col1 = 'v{}'.format(t)
+                    self.session.add(rows[product_id])
+                self.session.flush()
+            if t == 50:
+                with mock.patch('versionalchemy.models.datetime') as p:
+                    p.now.return_value = ts(55)
+                    self.session.delete(rows.pop(2))
+                    self.session.flush()
+
+    def tearDown(self):
+        self.session.rollback()
+        Base.metadata.drop_all(self.engine)
+        super(TestCheckpoint, self).tearDown()
+
+    def _checkpoint_rows(self):
+        return self._result_to_dict(self.session.execute(
+            sa.select([CheckpointTable])
+            .order_by(CheckpointTable.va_checkpoint_at, CheckpointTable.product_id)
+        ))
+
+    def _get_without_checkpoints(self, **kwargs):
+        with mock.patch.object(CheckpointUserTable, 'CheckpointTable', None):
+            return get(CheckpointUserTable, self.session, **kwargs)
+
+    def test_build_checkpoint(self):
+        self.assertEqual(build_checkpoint(CheckpointUserTable, self.session, ts(25)), 3)
+        self.assertEqual(build_checkpoint(CheckpointUserTable, self.session, ts(75)), 3)
+        rows = self._checkpoint_rows()
+        self.assertEqual([r['product_id'] for r in rows], [1, 2, 3, 1, 2, 3])
+        versions = dict(self.session.execute(
+            sa.select([CheckpointArchiveTable.va_id, CheckpointArchiveTable.va_version])
+        ).fetchall())
+        self.assertEqual([versions[r['va_id']] for r in rows], [1, 1, 1, 6, 7, 2])
+
+        with self.assertRaises(ValueError):
+            build_checkpoint(CheckpointUserTable, self.session, ts(75))
+        with self.assertRaises(ValueError):
+            build_checkpoint(CheckpointUserTable, self.session, ts(50))
+        with mock.patch.object(CheckpointUserTable, 'CheckpointTable', None):
+            with self.assertRaises(ValueError):
+                build_checkpoint(CheckpointUserTable, self.session, ts(100))
+        # A checkpoint is built at the current time by default
+        self.assertEqual(build_checkpoint(CheckpointUserTable, self.session), 3)
+
+    def test_get_uses_checkpoints(self):
+        build_checkpoint(CheckpointUserTable, self.session, ts(25))
+        build_checkpoint(CheckpointUserTable, self.session, ts(60))
+        for window_functions in (True, False):
+            with mock.patch(
+                'versionalchemy.api.data._supports_window_functions',
+                return_value=window_functions,
+            ):
+                for t in range(0, 120, 5):
+                    for kwargs in [
+                        {'t1': ts(t)},
+                        {'t1': ts(t), 'include_deleted': False},
+                        {'t1': ts(t), 'conds': [{'product_id': 2}]},
+                    ]:
+                        with self._record_statements() as statements:
+                            result = get(CheckpointUserTable, self.session, **kwargs)
+                        self.assertEqual(result, self._get_without_checkpoints(**kwargs))
+                        self.assertEqual(
+                            any(CheckpointTable.__tablename__ in s for s in statements[1:]),
+                            t >= 25,
+                        )
+
+    def test_delete_removes_checkpoints(self):
+        build_checkpoint(CheckpointUserTable, self.session, ts(25))
+        delete(CheckpointUserTable, self.session, [{'product_id': 1}])
+        self.assertEqual([r['product_id'] for r in self._checkpoint_rows()], [2, 3])
+
+    def test_register_validates_checkpoint_table(self):
+        with self.assertRaises(LogTableCreationError):
+            CheckpointUserTable.register(
+                CheckpointArchiveTable, self.engine, CheckpointTable=NoConstraintCheckpointTable
+            )
+        # Version columns which are listed twice are only validated once
+        CheckpointTable._validate(
+            self.engine, CheckpointUserTable.product_id, CheckpointUserTable.product_id
+        )
+        self.assertEqual(CheckpointTable._version_col_names, ['product_id'])
@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+
+import unittest
+import zlib
+from datetime import datetime
+
+from sqlalchemy import Column, Index, Integer, String, UnicodeText, UniqueConstraint
+from sqlalchemy.ext.declarative import declarative_base
+
+from tests.utils import SQLiteTestBase
+from versionalchemy import utils
+from versionalchemy.api import get
+from versionalchemy.models import VALogMixin, VAModelMixin
+
+try:
+    from unittest import mock  # PY3
+except ImportError:
+    import mock
+
+Base = declarative_base()
+
+
+class CompressedUserTable(VAModelMixin, Base):
+    __tablename__ = 'compressed_test_table'
+    va_version_columns = ['product_id']
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, nullable=False)
+    col1 = Column(UnicodeText)
+
+    __table_args__ = (
+        UniqueConstraint('product_id'),
+    )
+
+
+class CompressedArchiveTable(VALogMixin, Base):
+    __tablename__ = 'compressed_test_table_archive'
+    va_data = Column(utils.CompressedJSONEncodedDict(threshold=64), nullable=False)
+    product_id = Column(Integer, nullable=False)
+    user_id = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('product_id', 'va_version'),
+        Index(None, 'product_id', 'va_updated_at'),
+        Index(None, 'va_updated_at'),
+    )
+
+
+class TestCompressedJSONEncodedDict(SQLiteTestBase):
+    UserTable = CompressedUserTable
+
+    def setUp(self):
+        super(TestCompressedJSONEncodedDict, self).setUp()
+        Base.metadata.create_all(self.engine)
+        CompressedUserTable.register(CompressedArchiveTable, self.engine)
+        self.type_ = utils.CompressedJSONEncodedDict(threshold=64)
+        self.dialect = self.engine.dialect
+
+    def tearDown(self):
+        Base.metadata.drop_all(self.engine)
+        super(TestCompressedJSONEncodedDict, self).tearDown()
+
+    def _round_trip(self, type_, value):
+        return type_.process_result_value(type_.process_bind_param(value, self.dialect), None)
+
+    def test_small_values_are_not_compressed(self):
+        value = {'a': 'b'}
+        stored = self.type_.process_bind_param(value, self.dialect)
+        self.assertEqual(stored, b'\x00' + utils.json_dumps(value).encode('utf-8'))
+        self.assertEqual(self._round_trip(self.type_, value), value)
+        self.assertIsNone(self.type_.process_bind_param(None, self.dialect))
+        self.assertIsNone(self.type_.process_result_value(None, self.dialect))
+
+    def test_large_values_are_compressed(self):
+        value = {'a': 'b' * 1000, 'c': u'\u2603'}
+        stored = self.type_.process_bind_param(value, self.dialect)
+        self.assertEqual(stored[:1], b'\x01')
+        self.assertLess(len(stored), 100)
+        self.assertEqual(zlib.decompress(stored[1:]).decode('utf-8'), utils.json_dumps(value))
+        self.assertEqual(self._round_trip(self.type_, value), value)
+
+        # values compressed with any algorithm can be read
+        type_ = utils.CompressedJSONEncodedDict(threshold=0, level=9)
+        self.assertEqual(type_.process_result_value(stored, self.dialect), value)
+
+    def test_uncompressed_json_is_read(self):
+        self.assertEqual(self.type_.process_result_value(b'{"a": 1}', self.dialect), {'a': 1})
+        self.assertEqual(self.type_.process_result_value(u'{"a": 1}', self.dialect), {'a': 1})
+        self.assertEqual(
+            self.type_.process_result_value(memoryview(b'\x00{"a": 1}'), self.dialect), {'a': 1}
+        )
+
+    def test_invalid_values(self):
+        with self.assertRaises(ValueError):
+            utils.CompressedJSONEncodedDict(algorithm='foo')
+        with self.assertRaises(ValueError):
+            self.type_.process_bind_param([1], self.dialect)
+
+    def test_zstd_missing(self):
+        with mock.patch.object(utils, 'zstandard', None):
+            with self.assertRaises(ImportError):
+                utils.CompressedJSONEncodedDict(algorithm='zstd')
+            with self.assertRaises(ImportError):
+                self.type_.process_result_value(b'\x02foo', self.dialect)
+
+    @unittest.skipIf(utils.zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        type_ = utils.CompressedJSONEncodedDict(threshold=0, algorithm='zstd')
+        value = {'a': 'b' * 1000}
+        stored = type_.process_bind_param(value, self.dialect)
+        self.assertEqual(stored[:1], b'\x02')
+        self.assertEqual(self.type_.process_result_value(stored, self.dialect), value)
+
+    def test_get(self):
+        history = []
+        row = CompressedUserTable(product_id=1, col1='small')
+        for i, col1 in enumerate(['small', 'large' * 100, 'small again']):
+            row.col1 = col1
+            with mock.patch('versionalchemy.models.datetime') as p:
+                p.now.return_value = datetime.utcfromtimestamp(10 * (i + 1))
+                self._add_and_test_version(row, i)
+            history.append(col1)
+            self._verify_archive(dict(product_id=1, col1=col1), i, log_id=row.va_id)
+
+        def col1s(result):
+            return [r['va_data']['col1'] for r in result]
+        self.assertEqual(col1s(get(CompressedUserTable, self.session)), history[-1:])
+        self.assertEqual(col1s(get(
+            CompressedUserTable, self.session, t1=datetime.utcfromtimestamp(25)
+        )), history[1:2])
+        self.assertEqual(col1s(get(
+            CompressedUserTable,
+            self.session,
+            t1=datetime.utcfromtimestamp(0),
+            t2=datetime.utcfromtimestamp(100),
+        )), history)
+        self.assertEqual(col1s(get(CompressedUserTable, self.session, va_id=0)), history)
@@ -56,3 +56,18 @@ class TestDelete(SQLiteTestBase):
         ).fetchall()), 0)
         self._verify_archive(self.p1, 0)
         self._verify_archive(self.p1, 1, deleted=True, user='test_user')
+
+    def test_delete_and_update_in_same_flush(self):
+        p1 = UserTable(**self.p1)
+        p2 = UserTable(**self.p2)
+        self.session.add_all([p1, p2])
+        self.session.commit()
+
+        self.session.delete(p1)
+        p2.col1 = 'changed'
+        self.session.flush()
+
+        self._verify_archive(self.p1, 1, deleted=True, log_id=p1.va_id)
+        self._verify_archive(dict(self.p2, col1='changed'), 1, log_id=p2.va_id)
+        self.session.expire(p2)
+        self.assertEqual(p2.version(self.session), 1)
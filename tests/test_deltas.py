@@ -0,0 +1,247 @@
+from __future__ import absolute_import
+
+from datetime import datetime
+
+import six
+import sqlalchemy as sa
+from sqlalchemy import Boolean, Column, Index, Integer, String, UniqueConstraint
+from sqlalchemy.ext.declarative import declarative_base
+
+from tests.utils import SQLiteTestBase
+from versionalchemy import bulk
+from versionalchemy.api import get, iter_history
+from versionalchemy.exceptions import LogTableCreationError
+from versionalchemy.models import VALogMixin, VAModelMixin
+from versionalchemy.outbox import QueueOutbox
+
+try:
+    from unittest import mock  # PY3
+except ImportError:
+    import mock
+
+Base = declarative_base()
+
+
+class DeltaUserTable(VAModelMixin, Base):
+    __tablename__ = 'delta_test_table'
+    va_version_columns = ['product_id']
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, nullable=False)
+    col1 = Column(String(50))
+    col2 = Column(Integer)
+
+    __table_args__ = (
+        UniqueConstraint('product_id'),
+    )
+
+
+class DeltaArchiveTable(VALogMixin, Base):
+    __tablename__ = 'delta_test_table_archive'
+    va_keyframe_interval = 3
+    va_delta = Column(Boolean, nullable=False)
+    product_id = Column(Integer, nullable=False)
+    user_id = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('product_id', 'va_version'),
+        Index(None, 'product_id', 'va_updated_at'),
+        Index(None, 'va_updated_at'),
+    )
+
+
+class NoDeltaArchiveTable(VALogMixin, Base):
+    __tablename__ = 'no_delta_test_table_archive'
+    va_keyframe_interval = 3
+    product_id = Column(Integer, nullable=False)
+    user_id = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('product_id', 'va_version'),
+        Index(None, 'product_id', 'va_updated_at'),
+        Index(None, 'va_updated_at'),
+    )
+
+
+class OnUpdateUserTable(VAModelMixin, Base):
+    __tablename__ = 'onupdate_test_table'
+    va_version_columns = ['product_id']
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, nullable=False)
+    col1 = Column(String(50))
+    # A value set by the ORM and a value computed by the database
+    state = Column(String(50), default='inserted', onupdate='updated')
+    touched = Column(Integer, default=0, onupdate=sa.literal_column('1'))
+
+    __table_args__ = (
+        UniqueConstraint('product_id'),
+    )
+
+
+class OnUpdateArchiveTable(VALogMixin, Base):
+    __tablename__ = 'onupdate_test_table_archive'
+    va_keyframe_interval = 3
+    va_delta = Column(Boolean, nullable=False)
+    product_id = Column(Integer, nullable=False)
+    user_id = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('product_id', 'va_version'),
+        Index(None, 'product_id', 'va_updated_at'),
+        Index(None, 'va_updated_at'),
+    )
+
+
+class TestDeltas(SQLiteTestBase):
+    UserTable = DeltaUserTable
+
+    def setUp(self):
+        super(TestDeltas, self).setUp()
+        Base.metadata.create_all(self.engine)
+        DeltaUserTable.register(DeltaArchiveTable, self.engine)
+
+    def tearDown(self):
+        Base.metadata.drop_all(self.engine)
+        super(TestDeltas, self).tearDown()
+
+    def _archive_rows(self):
+        return self._result_to_dict(self.session.execute(
+            sa.select([DeltaArchiveTable])
+            .order_by(DeltaArchiveTable.product_id, DeltaArchiveTable.va_version)
+        ))
+
+    def _make_history(self):
+        '''
+        Writes versions 0 - 5 of a row, one every 10 seconds, and returns the full data of each.
+        '''
+        row = DeltaUserTable(product_id=1, col1='a', col2=0)
+        history = []
+        for i in range(6):
+            if i:
+                if i % 2:
+                    row.col1 = row.col1 + 'a'
+                else:
+                    row.col2 = i
+            with mock.patch('versionalchemy.models.datetime') as p:
+                p.now.return_value = datetime.utcfromtimestamp(10 * (i + 1))
+                self._add_and_test_version(row, i)
+            history.append(dict(id=row.id, product_id=1, col1=row.col1, col2=row.col2))
+        return history
+
+    def test_updates_store_deltas(self):
+        history = self._make_history()
+        rows = self._archive_rows()
+        self.assertEqual([r['va_delta'] for r in rows], [False, True, True, False, True, True])
+        self.assertEqual(rows[0]['va_data'], history[0])
+        self.assertEqual(rows[1]['va_data'], {'col1': 'aa'})
+        self.assertEqual(rows[2]['va_data'], {'col2': 2})
+        self.assertEqual(rows[3]['va_data'], history[3])
+        self.assertEqual(rows[5]['va_data'], {'col1': 'aaaa'})
+
+    def test_inserts_deletes_and_key_changes_are_keyframes(self):
+        row = DeltaUserTable(product_id=1, col1='a', col2=0)
+        self._add_and_test_version(row, 0)
+        row.product_id = 2
+        self._add_and_test_version(row, 0)
+        self.session.delete(row)
+        self.session.commit()
+
+        rows = self._archive_rows()
+        self.assertEqual([r['va_delta'] for r in rows], [False, False, False, False])
+        self.assertEqual([r['va_deleted'] for r in rows], [False, True, False, True])
+        for r in rows:
+            self.assertEqual(set(r['va_data']), {'id', 'product_id', 'col1', 'col2'})
+
+    def test_onupdate_columns_are_in_deltas(self):
+        OnUpdateUserTable.register(OnUpdateArchiveTable, self.engine)
+        row = OnUpdateUserTable(product_id=1, col1='a')
+        self.session.add(row)
+        for col1 in ('a', 'b', 'c'):
+            row.col1 = col1
+            self.session.commit()
+        history = [
+            dict(id=row.id, product_id=1, col1=col1, state=state, touched=touched)
+            for col1, state, touched in [
+                ('a', 'inserted', 0), ('b', 'updated', 1), ('c', 'updated', 1),
+            ]
+        ]
+
+        rows = self._result_to_dict(self.session.execute(
+            sa.select([OnUpdateArchiveTable]).order_by(OnUpdateArchiveTable.va_version)
+        ))
+        self.assertEqual([r['va_delta'] for r in rows], [False, True, True])
+        self.assertEqual(rows[1]['va_data'], {'col1': 'b', 'state': 'updated', 'touched': 1})
+        self.assertEqual([r['va_data'] for r in get(
+            OnUpdateUserTable,
+            self.session,
+            t1=datetime.utcfromtimestamp(0),
+            t2=datetime(2100, 1, 1),
+        )], history)
+
+    def test_get_rebuilds_rows(self):
+        history = self._make_history()
+
+        def data(result):
+            return [r['va_data'] for r in result]
+        self.assertEqual(data(get(DeltaUserTable, self.session)), history[-1:])
+        self.assertEqual(data(get(
+            DeltaUserTable, self.session, t1=datetime.utcfromtimestamp(35)
+        )), history[2:3])
+        self.assertEqual(data(get(
+            DeltaUserTable,
+            self.session,
+            t1=datetime.utcfromtimestamp(15),
+            t2=datetime.utcfromtimestamp(100),
+        )), history[1:])
+        va_id = self._archive_rows()[1]['va_id']
+        self.assertEqual(data(get(DeltaUserTable, self.session, va_id=va_id)), history[2:])
+        self.assertEqual(data(get(DeltaUserTable, self.session, va_id=va_id, fields=['col2'])), [
+            {'col2': 2}, {'col2': 4},
+        ])
+
+    def test_iter_history(self):
+        history = self._make_history()
+        for batch_size in (1, 2, 4):
+            self.assertEqual([r['va_data'] for r in iter_history(
+                DeltaUserTable,
+                self.session,
+                t1=datetime.utcfromtimestamp(15),
+                t2=datetime.utcfromtimestamp(100),
+                batch_size=batch_size,
+            )], history[1:])
+
+    def test_get_fetches_bases_in_one_query(self):
+        for product_id in range(1, 4):
+            row = DeltaUserTable(product_id=product_id, col1='a', col2=0)
+            self._add_and_test_version(row, 0)
+            row.col1 = 'b'
+            self._add_and_test_version(row, 1)
+
+        with self._record_statements() as statements:
+            result = get(DeltaUserTable, self.session)
+        self.assertEqual([r['va_data']['col1'] for r in result], ['b', 'b', 'b'])
+        self.assertEqual([r['va_data']['col2'] for r in result], [0, 0, 0])
+        self.assertEqual(
+            self._count_statements(statements, 'SELECT', DeltaArchiveTable.__tablename__), 2
+        )
+
+    def test_bulk_writes_store_keyframes(self):
+        bulk.bulk_insert_mappings(
+            self.session, DeltaUserTable, [{'product_id': 1, 'col1': 'a', 'col2': 0}]
+        )
+        bulk.versioned_update(self.session.query(DeltaUserTable), {'col1': 'b'})
+        rows = self._archive_rows()
+        self.assertEqual([r['va_delta'] for r in rows], [False, False])
+        self.assertEqual([r['va_data']['col1'] for r in rows], ['a', 'b'])
+        self.assertEqual(get(DeltaUserTable, self.session)[0]['va_data']['col1'], 'b')
+
+    def test_keyframe_interval_is_validated(self):
+        with self.assertRaises(LogTableCreationError):
+            NoDeltaArchiveTable._validate(self.engine, DeltaUserTable.product_id)
+        with mock.patch.object(DeltaArchiveTable, 'va_keyframe_interval', 0):
+            with self.assertRaises(LogTableCreationError):
+                DeltaArchiveTable._validate(self.engine, DeltaUserTable.product_id)
+
+    def test_deltas_cannot_be_archived_later(self):
+        for kwargs in [{'outbox': QueueOutbox()}, {'triggers': True}]:
+            with six.assertRaisesRegex(self, LogTableCreationError, 'cannot use'):
+                DeltaUserTable.register(DeltaArchiveTable, self.engine, **kwargs)
@@ -1,8 +1,50 @@
 from __future__ import absolute_import
 
+import sqlalchemy as sa
+from sqlalchemy import Column, Index, Integer, String, TypeDecorator, UniqueConstraint
+from sqlalchemy.ext.declarative import declarative_base
+
 import versionalchemy
-from tests.models import UserTable
+from tests.models import ArchiveTable, UserTable
 from tests.utils import SQLiteTestBase
+from versionalchemy.models import VALogMixin, VAModelMixin
+
+Base = declarative_base()
+
+
+class LowerCaseString(TypeDecorator):
+    '''
+    A string which is read back in lower case, so it does not match the value it was written with.
+    '''
+    impl = String(50)
+    python_type = str
+
+    def process_result_value(self, value, dialect):
+        return value.lower()
+
+
+class LowerCaseUserTable(VAModelMixin, Base):
+    __tablename__ = 'lower_case_test_table'
+    va_version_columns = ['name']
+    id = Column(Integer, primary_key=True)
+    name = Column(LowerCaseString, nullable=False)
+    col1 = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('name'),
+    )
+
+
+class LowerCaseArchiveTable(VALogMixin, Base):
+    __tablename__ = 'lower_case_test_table_archive'
+    name = Column(LowerCaseString, nullable=False)
+    user_id = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('name', 'va_version'),
+        Index(None, 'name', 'va_updated_at'),
+        Index(None, 'va_updated_at'),
+    )
 
 
 class TestInsert(SQLiteTestBase):
@@ -40,3 +82,36 @@ class TestInsert(SQLiteTestBase):
 
         self._verify_row(self.p1, 0)
         self._verify_archive(self.p1, 0, log_id=p.va_id, user='test_user')
+
+    def test_insert_many_products_batches_archive_inserts(self):
+        rows = [
+            UserTable(product_id=i, col1='foo', col2=i, col3=True) for i in range(100)
+        ]
+        self.session.add_all(rows)
+        with self._record_statements() as statements:
+            self.session.flush()
+        self.assertEqual(
+            self._count_statements(statements, 'INSERT', ArchiveTable.__tablename__), 1
+        )
+        for row in rows:
+            self.assertEqual(row.version(self.session), 0)
+            self._verify_archive(
+                dict(product_id=row.product_id, col1='foo', col2=row.product_id, col3=True),
+                0,
+                log_id=row.va_id,
+            )
+
+    def test_va_ids_of_keys_read_back_as_other_values(self):
+        Base.metadata.create_all(self.engine)
+        try:
+            LowerCaseUserTable.register(LowerCaseArchiveTable, self.engine)
+            rows = [LowerCaseUserTable(name=name, col1='foo') for name in ('A', 'b', 'C')]
+            self.session.add_all(rows)
+            self.session.flush()
+            va_ids = dict(list(self.session.execute(
+                sa.select([LowerCaseArchiveTable.name, LowerCaseArchiveTable.va_id])
+            )))
+            self.assertEqual([row.va_id for row in rows], [va_ids['a'], va_ids['b'], va_ids['c']])
+        finally:
+            self.session.close()
+            Base.metadata.drop_all(self.engine)
@@ -61,6 +61,32 @@ class TestArchiveTable(SQLiteTestBase):
         finally:
             UserTable.register(ArchiveTable, self.engine)
 
+    def test_build_row_dict(self):
+        p = UserTable(**self.p1)
+        self._add_and_test_version(p, 0)
+        p.col1 = 'new'
+
+        row_dict = ArchiveTable.build_row_dict(p, self.session, user_id='foo')
+        self.assertEqual(row_dict['va_version'], 1)
+        self.assertEqual(row_dict['product_id'], p.product_id)
+        self.assertEqual(row_dict['user_id'], 'foo')
+        self.assertEqual(row_dict['va_data']['col1'], 'new')
+
+        latest_versions = {(p.product_id, ): 5}
+        row_dict = ArchiveTable.build_row_dict(p, self.session, latest_versions=latest_versions)
+        self.assertEqual(row_dict['va_version'], 6)
+        self.assertEqual(latest_versions, {(p.product_id, ): 6})
+
+    def test_latest_versions(self):
+        self.session.add_all([UserTable(**self.p1), UserTable(**self.p2)])
+        self.session.commit()
+        p1 = self.session.query(UserTable).filter_by(product_id=self.p1['product_id']).one()
+        p1.col1 = 'new'
+        self.session.commit()
+
+        latest = ArchiveTable._latest_versions(self.session, [(10, ), (11, ), (12, )])
+        self.assertEqual(latest, {(10, ): 1, (11, ): 0})
+
     def test_archive_table_collision_fails_1(self):
         """
         Try to insert two records with the same version and foreign key in the same transaction
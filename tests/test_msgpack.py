@@ -0,0 +1,99 @@
+from __future__ import absolute_import
+
+import unittest
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import Column, Index, Integer, String, UniqueConstraint
+from sqlalchemy.ext.declarative import declarative_base
+
+from tests.utils import SQLiteTestBase
+from versionalchemy import utils
+from versionalchemy.api import get
+from versionalchemy.models import VALogMixin, VAModelMixin
+
+try:
+    from unittest import mock  # PY3
+except ImportError:
+    import mock
+
+Base = declarative_base()
+
+
+class MsgPackUserTable(VAModelMixin, Base):
+    __tablename__ = 'msgpack_test_table'
+    va_version_columns = ['product_id']
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, nullable=False)
+    col1 = Column(String(50))
+    col2 = Column(Integer)
+
+    __table_args__ = (
+        UniqueConstraint('product_id'),
+    )
+
+
+class MsgPackArchiveTable(VALogMixin, Base):
+    __tablename__ = 'msgpack_test_table_archive'
+    va_data = Column(utils.MsgPackEncodedDict, nullable=False)
+    product_id = Column(Integer, nullable=False)
+    user_id = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('product_id', 'va_version'),
+        Index(None, 'product_id', 'va_updated_at'),
+        Index(None, 'va_updated_at'),
+    )
+
+
+@unittest.skipIf(utils.msgpack is None, 'msgpack is not installed')
+class TestMsgPackEncodedDict(SQLiteTestBase):
+    UserTable = MsgPackUserTable
+
+    def setUp(self):
+        super(TestMsgPackEncodedDict, self).setUp()
+        Base.metadata.create_all(self.engine)
+        MsgPackUserTable.register(MsgPackArchiveTable, self.engine)
+
+    def tearDown(self):
+        Base.metadata.drop_all(self.engine)
+        super(TestMsgPackEncodedDict, self).tearDown()
+
+    def test_serde(self):
+        t = utils.MsgPackEncodedDict()
+        ts = datetime(2019, 1, 2, 3, 4, 5)
+        value = {'a': [1, u'\u2603'], 'b': ts, 'c': Decimal('1.5'), 'd': None}
+        packed = t.process_bind_param(value, self.engine.dialect)
+        self.assertLess(len(packed), len(utils.json_dumps(value)))
+        self.assertEqual(
+            t.process_result_value(packed, self.engine.dialect),
+            utils.json_loads(utils.json_dumps(value)),
+        )
+        self.assertEqual(
+            t.process_result_value(t.process_bind_param('{"a": 1}', None), None), {'a': 1}
+        )
+        self.assertIsNone(t.process_bind_param(None, None))
+        self.assertIsNone(t.process_result_value(None, None))
+        with self.assertRaises(ValueError):
+            t.process_bind_param([1], None)
+
+    def test_versioning(self):
+        row = MsgPackUserTable(product_id=1, col1='foo', col2=5)
+        self._add_and_test_version(row, 0)
+        row.col1 = 'bar'
+        self._add_and_test_version(row, 1)
+
+        self._verify_archive(dict(product_id=1, col1='foo', col2=5), 0)
+        self._verify_archive(dict(product_id=1, col1='bar', col2=5), 1, log_id=row.va_id)
+
+        result = get(MsgPackUserTable, self.session, t1=datetime(1970, 1, 1), t2=datetime.now())
+        self.assertEqual([r['va_data']['col1'] for r in result], ['foo', 'bar'])
+        result = get(MsgPackUserTable, self.session, fields=['col1', 'col2'])
+        self.assertEqual(result[0]['va_data'], {'col1': 'bar', 'col2': 5})
+
+
+class TestMsgPackMissing(unittest.TestCase):
+    def test_requires_msgpack(self):
+        with mock.patch.object(utils, 'msgpack', None):
+            with self.assertRaises(ImportError):
+                utils.MsgPackEncodedDict()
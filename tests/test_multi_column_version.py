@@ -192,3 +192,28 @@ class TestMultiColumnVersioning(SQLiteTestBase):
         self._verify_archive(r, 0)
         self._verify_archive(r, 1, deleted=True)
         self._verify_archive(r_new, 2)
+
+    def test_update_version_column_of_many_rows(self):
+        r1 = {
+            'product_id_1': 11,
+            'product_id_2': 'foo',
+            'col1': 'foo',
+            'col2': 100,
+        }
+        r2 = dict(r1, product_id_2='bar')
+        row1 = MultiColumnUserTable(**r1)
+        row2 = MultiColumnUserTable(**r2)
+        self.session.add_all([row1, row2])
+        self.session.flush()
+
+        row1.product_id_1 = 12
+        row2.product_id_1 = 12
+        with self._record_statements() as statements:
+            self.session.flush()
+        self.assertEqual(self._count_statements(
+            statements, 'INSERT', MultiColumnUserTable.ArchiveTable.__tablename__
+        ), 1)
+        for r, row in [(r1, row1), (r2, row2)]:
+            self.assertEqual(row.version(self.session), 0)
+            self._verify_archive(r, 1, deleted=True)
+            self._verify_archive(dict(r, product_id_1=12), 0, log_id=row.va_id)
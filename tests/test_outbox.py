@@ -0,0 +1,265 @@
+from __future__ import absolute_import
+
+import json
+import time
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy import Column, Index, Integer, String, UniqueConstraint
+from sqlalchemy.ext.declarative import declarative_base
+
+from tests.utils import SQLiteFileTestBase, SQLiteTestBase
+from versionalchemy.api import get
+from versionalchemy.exceptions import LogTableCreationError
+from versionalchemy.models import VALogMixin, VAModelMixin, VAOutboxMixin
+from versionalchemy.outbox import drain, OutboxWorker, QueueOutbox, TableOutbox
+
+try:
+    from unittest import mock  # PY3
+except ImportError:
+    import mock
+
+Base = declarative_base()
+
+
+class OutboxUserTable(VAModelMixin, Base):
+    __tablename__ = 'outbox_test_table'
+    va_version_columns = ['product_id']
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, nullable=False)
+    col1 = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('product_id'),
+    )
+
+
+class OutboxArchiveTable(VALogMixin, Base):
+    __tablename__ = 'outbox_test_table_archive'
+    product_id = Column(Integer, nullable=False)
+    user_id = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('product_id', 'va_version'),
+        Index(None, 'product_id', 'va_updated_at'),
+        Index(None, 'va_updated_at'),
+    )
+
+
+class OutboxTable(VAOutboxMixin, Base):
+    __tablename__ = 'outbox_test_table_outbox'
+
+
+class OutboxTestMixin(object):
+    def setUp(self):
+        super(OutboxTestMixin, self).setUp()
+        Base.metadata.create_all(self.engine)
+        self.outbox = self.make_outbox()
+        OutboxUserTable.register(OutboxArchiveTable, self.engine, outbox=self.outbox)
+
+    def tearDown(self):
+        OutboxUserTable.register(OutboxArchiveTable, self.engine)
+        Base.metadata.drop_all(self.engine)
+        super(OutboxTestMixin, self).tearDown()
+
+    def _archive_rows(self):
+        return self._result_to_dict(self.session.execute(
+            sa.select([OutboxArchiveTable])
+            .order_by(OutboxArchiveTable.product_id, OutboxArchiveTable.va_version)
+        ))
+
+    def _make_changes(self):
+        '''
+        Inserts products 1 and 2, updates 1 twice, changes the key of 2 to 3 and deletes 1,
+        committing after each step. Returns the rows which are left.
+        '''
+        p1 = OutboxUserTable(product_id=1, col1='a')
+        p2 = OutboxUserTable(product_id=2, col1='a')
+        self.session.add_all([p1, p2])
+        self.session.commit()
+        for col1 in ('b', 'c'):
+            p1.col1 = col1
+            self.session.commit()
+        # the old key is only known once the expired row is loaded
+        self.assertEqual(p2.product_id, 2)
+        p2.product_id = 3
+        self.session.commit()
+        self.session.delete(p1)
+        self.session.commit()
+        return p2
+
+    def _assert_archived(self, p3):
+        rows = self._archive_rows()
+        self.assertEqual(
+            [(r['product_id'], r['va_version'], r['va_deleted']) for r in rows],
+            [(1, 0, False), (1, 1, False), (1, 2, False), (1, 3, True),
+             (2, 0, False), (2, 1, True), (3, 0, False)],
+        )
+        self.assertEqual([r['va_data']['col1'] for r in rows], ['a', 'b', 'c', 'c', 'a', 'a', 'a'])
+        va_id = self.session.execute(
+            sa.select([OutboxUserTable.va_id]).where(OutboxUserTable.id == p3.id)
+        ).scalar()
+        self.assertEqual(va_id, rows[-1]['va_id'])
+        self.assertEqual(
+            [r['va_data']['col1'] for r in get(OutboxUserTable, self.session)], ['a']
+        )
+
+
+class TestQueueOutbox(OutboxTestMixin, SQLiteTestBase):
+    def make_outbox(self):
+        return QueueOutbox()
+
+    def test_drain(self):
+        with self._record_statements() as statements:
+            p3 = self._make_changes()
+        self.assertEqual(
+            self._count_statements(statements, 'SELECT', OutboxArchiveTable.__tablename__), 0
+        )
+        self.assertEqual(self._archive_rows(), [])
+        self.assertEqual(len(self.outbox), 7)
+
+        self.assertEqual(drain(self.outbox, self.session, limit=3), 3)
+        self.assertEqual(drain(self.outbox, self.session), 4)
+        self.assertEqual(drain(self.outbox, self.session), 0)
+        self._assert_archived(p3)
+
+    def test_rolled_back_rows_are_discarded(self):
+        row = OutboxUserTable(product_id=1, col1='a')
+        self.session.add(row)
+        self.session.flush()
+        self.session.rollback()
+        self.assertEqual(len(self.outbox), 0)
+
+        row = OutboxUserTable(product_id=2, col1='a')
+        self.session.add(row)
+        self.session.flush()
+        self.session.begin_nested()
+        row.col1 = 'b'
+        self.session.flush()
+        self.session.rollback()
+        self.session.begin_nested()
+        row.col1 = 'c'
+        self.session.flush()
+        self.session.commit()
+        self.assertEqual(len(self.outbox), 0)
+        self.session.commit()
+
+        drain(self.outbox, self.session)
+        self.assertEqual([r['va_data']['col1'] for r in self._archive_rows()], ['a', 'c'])
+
+    def test_failed_drain_is_requeued(self):
+        self.session.add(OutboxUserTable(product_id=1, col1='a'))
+        self.session.commit()
+        with mock.patch('versionalchemy._insert_archive_rows', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                drain(self.outbox, self.session)
+        self.assertEqual(len(self.outbox), 1)
+        self.assertEqual(drain(self.outbox, self.session), 1)
+        self.assertEqual([r['va_version'] for r in self._archive_rows()], [0])
+
+    def test_register_rejects_outbox(self):
+        with mock.patch.object(OutboxArchiveTable, 'va_keyframe_interval', 3):
+            with self.assertRaises(LogTableCreationError):
+                OutboxUserTable.register(OutboxArchiveTable, self.engine, outbox=self.outbox)
+
+
+class TestTableOutbox(OutboxTestMixin, SQLiteTestBase):
+    def make_outbox(self):
+        return TableOutbox(OutboxTable)
+
+    def test_drain(self):
+        self.session.add_all([OutboxUserTable(product_id=i, col1='a') for i in range(10, 20)])
+        with self._record_statements() as statements:
+            self.session.commit()
+        self.assertEqual(self._count_statements(statements, 'INSERT', OutboxTable.__tablename__), 1)
+        self.assertEqual(drain(self.outbox, self.session), 10)
+
+        p3 = self._make_changes()
+        self.assertEqual(self.session.query(OutboxTable).count(), 7)
+        self.assertEqual(drain(self.outbox, self.session, limit=5), 5)
+        self.assertEqual(self.session.query(OutboxTable).count(), 2)
+        self.assertEqual(drain(self.outbox, self.session), 2)
+        self.assertEqual(self.session.query(OutboxTable).count(), 0)
+        self.session.execute(
+            sa.delete(OutboxArchiveTable.__table__).where(OutboxArchiveTable.product_id >= 10)
+        )
+        self._assert_archived(p3)
+
+    def test_payload_is_json(self):
+        now = datetime(2020, 1, 1, 12, 0, 0, 500)
+        with mock.patch('versionalchemy.models.datetime') as p:
+            p.now.return_value = now
+            self.session.add(OutboxUserTable(product_id=1, col1='a'))
+            self.session.commit()
+        payload = json.loads(self.session.execute(
+            sa.text('SELECT va_payload FROM {}'.format(OutboxTable.__tablename__))
+        ).scalar())
+        self.assertEqual(payload['va_updated_at'], now.isoformat())
+        self.assertEqual(payload['va_data'], {'id': 1, 'product_id': 1, 'col1': 'a'})
+        self.assertEqual(drain(self.outbox, self.session), 1)
+        row, = self._archive_rows()
+        self.assertEqual(row['va_updated_at'], now)
+        self.assertIs(row['va_deleted'], False)
+
+    def test_failed_drain_is_kept(self):
+        self.session.add(OutboxUserTable(product_id=1, col1='a'))
+        self.session.commit()
+        with mock.patch('versionalchemy._insert_archive_rows', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                drain(self.outbox, self.session)
+        self.assertEqual(self.session.query(OutboxTable).count(), 1)
+        self.assertEqual(drain(self.outbox, self.session), 1)
+
+    def test_unregistered_table_is_rejected(self):
+        self.session.add(OutboxTable(va_table='foo', va_payload={}))
+        self.session.commit()
+        with self.assertRaises(ValueError):
+            drain(self.outbox, self.session)
+
+
+class TestOutboxWorker(OutboxTestMixin, SQLiteFileTestBase):
+    def make_outbox(self):
+        return QueueOutbox()
+
+    def test_worker(self):
+        worker = OutboxWorker(self.outbox, self.Session, batch_size=2, interval=0.01)
+        worker.start()
+        try:
+            p3 = self._make_changes()
+        finally:
+            worker.stop()
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(len(self.outbox), 0)
+        self._assert_archived(p3)
+
+    def test_stopped_worker_drains_outbox(self):
+        self.session.add_all([OutboxUserTable(product_id=i, col1='a') for i in range(3)])
+        self.session.commit()
+        worker = OutboxWorker(self.outbox, self.Session, batch_size=2)
+        # Rows put before the worker is stopped are archived in batches
+        worker._stopped.set()
+        with mock.patch.object(worker, 'drain', wraps=worker.drain) as p:
+            worker.run()
+        self.assertEqual(p.call_count, 2)
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(len(self._archive_rows()), 3)
+
+    def test_worker_retries_failed_drains(self):
+        failures = [RuntimeError('failed')]
+
+        def flaky_drain(*args):
+            if failures:
+                raise failures.pop()
+            return drain(*args)
+        worker = OutboxWorker(self.outbox, self.Session, interval=0.01)
+        with mock.patch('versionalchemy.outbox.drain', side_effect=flaky_drain), \
+                mock.patch('versionalchemy.outbox.log') as log:
+            self.session.add(OutboxUserTable(product_id=1, col1='a'))
+            self.session.commit()
+            worker.start()
+            while failures:
+                time.sleep(0.01)
+            worker.stop()
+        log.exception.assert_called_once_with('Failed to drain the versionalchemy outbox')
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(len(self._archive_rows()), 1)
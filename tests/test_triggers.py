@@ -0,0 +1,270 @@
+from __future__ import absolute_import
+
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy import Column, DateTime, Integer, String, UniqueConstraint
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.ext.declarative import declarative_base
+
+from tests.models import ArchiveTable, CounterArchiveTable, CounterUserTable, UserTable
+from tests.utils import SQLiteTestBase
+from versionalchemy import utils
+from versionalchemy.api import get, ReadCache
+from versionalchemy.exceptions import LogTableCreationError
+from versionalchemy.models import VALogMixin, VAModelMixin
+from versionalchemy.outbox import QueueOutbox
+from versionalchemy.triggers import (
+    create_triggers,
+    drop_triggers,
+    get_drop_trigger_ddl,
+    get_trigger_ddl,
+)
+
+try:
+    from unittest import mock  # PY3
+except ImportError:
+    import mock
+
+
+Base = declarative_base()
+
+
+class DateTimeTable(VAModelMixin, Base):
+    __tablename__ = 'datetime_table'
+    va_version_columns = ['product_id']
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, nullable=False)
+    ts = Column(DateTime)
+
+    __table_args__ = (
+        UniqueConstraint('product_id'),
+    )
+
+
+class DateTimeArchiveTable(VALogMixin, Base):
+    __tablename__ = 'datetime_table_archive'
+    product_id = Column(Integer, nullable=False)
+    user_id = Column(String(50))
+
+    __table_args__ = (
+        UniqueConstraint('product_id', 'va_version'),
+    )
+
+
+class TestTriggers(SQLiteTestBase):
+    def setUp(self):
+        super(TestTriggers, self).setUp()
+        create_triggers(UserTable, ArchiveTable, self.engine)
+        UserTable.register(ArchiveTable, self.engine, triggers=True)
+
+    def tearDown(self):
+        UserTable.register(ArchiveTable, self.engine)
+        super(TestTriggers, self).tearDown()
+
+    def _archive_rows(self):
+        rows = self._result_to_dict(self.session.execute(
+            sa.select([ArchiveTable]).order_by(ArchiveTable.va_id)
+        ))
+        return [
+            (r['product_id'], r['va_version'], r['va_deleted'], r['va_data']) for r in rows
+        ]
+
+    def _make_changes(self):
+        '''
+        Inserts, updates, changes the key of and deletes rows with the ORM and with SQL which
+        does not go through it.
+        '''
+        p1 = UserTable(**self.p1)
+        p2 = UserTable(**self.p2)
+        self.session.add_all([p1, p2])
+        self.session.commit()
+        p1.col1 = 'changed'
+        p1.col4 = 5
+        self.session.commit()
+        # An update which changes nothing is not versioned
+        self.session.execute(
+            sa.update(UserTable.__table__).where(UserTable.product_id == 10).values(col1='changed')
+        )
+        self.session.commit()
+        self.session.execute(sa.insert(UserTable.__table__).values(**self.p3))
+        self.session.execute(
+            sa.update(UserTable.__table__)
+            .where(UserTable.product_id == 2546)
+            .values(col2=13, col3=1)
+        )
+        self.assertEqual(p2.product_id, 11)
+        p2.product_id = 12
+        self.session.commit()
+        self.session.delete(p1)
+        self.session.execute(
+            sa.delete(UserTable.__table__).where(UserTable.product_id == 2546)
+        )
+        self.session.commit()
+
+    def test_triggers_match_flushes(self):
+        with self._record_statements() as statements:
+            self._make_changes()
+        self.assertEqual(
+            self._count_statements(statements, 'INSERT', ArchiveTable.__tablename__), 0
+        )
+        archived = self._archive_rows()
+        self.assertEqual(
+            [r[:3] for r in archived],
+            [(10, 0, False), (11, 0, False), (10, 1, False), (2546, 0, False),
+             (2546, 1, False), (11, 1, True), (12, 0, False), (2546, 2, True),
+             (10, 2, True)],
+        )
+
+        # The same changes archived by flushes; raw SQL is not versioned then
+        self.session.execute(sa.delete(UserTable.__table__))
+        self.session.execute(sa.delete(ArchiveTable.__table__))
+        drop_triggers(UserTable, self.engine)
+        UserTable.register(ArchiveTable, self.engine)
+        self._make_changes()
+        expected = [r for r in self._archive_rows() if r[0] != 2546]
+        self.assertEqual([r for r in archived if r[0] != 2546], expected)
+
+    def test_va_data_of_many_columns(self):
+        p1 = UserTable(**self.p1)
+        self.session.add(p1)
+        self.session.commit()
+        # va_data is built with json_set once there are too many columns for json_object
+        drop_triggers(UserTable, self.engine)
+        with mock.patch('versionalchemy.triggers._SQLITE_JSON_OBJECT_COLUMNS', 2):
+            create_triggers(UserTable, ArchiveTable, self.engine)
+        p1.col2 = 20
+        self.session.commit()
+        inserted, updated = [r[3] for r in self._archive_rows()]
+        self.assertEqual(updated, dict(inserted, col2=20))
+
+    def test_va_id(self):
+        p1 = UserTable(**self.p1)
+        self.session.add(p1)
+        self.session.commit()
+        p1.col2 = 20
+        self.session.commit()
+        log_id = self.session.execute(sa.select([sa.func.max(ArchiveTable.va_id)])).scalar()
+        self.assertEqual(p1.va_id, log_id)
+        self._verify_archive(dict(self.p1, col2=20), 1, log_id=log_id)
+        self.assertEqual(
+            [r['va_data']['col2'] for r in get(UserTable, self.session)], [20]
+        )
+
+    def test_va_id_after_flush(self):
+        p1 = UserTable(**self.p1)
+        self.session.add(p1)
+        self.session.flush()
+        log_id = self.session.execute(sa.select([sa.func.max(ArchiveTable.va_id)])).scalar()
+        self.assertEqual(p1.va_id, log_id)
+        self.assertEqual(p1.version(self.session), 0)
+        p1.col2 = 20
+        self.session.flush()
+        self.assertEqual(p1.va_id, log_id + 1)
+        self.assertEqual(p1.version(self.session), 1)
+        self.session.commit()
+
+    def test_cache_is_invalidated(self):
+        p1 = UserTable(**self.p1)
+        self.session.add(p1)
+        self.session.commit()
+        self.assertEqual(p1.product_id, 10)
+        self.cache = ReadCache()
+        with mock.patch('versionalchemy.api.cache.invalidate') as invalidate:
+            p1.product_id = 20
+            self.session.commit()
+        invalidate.assert_called_once_with(ArchiveTable, {(10,), (20,)}, session=self.session)
+
+    def test_register_rejects_triggers(self):
+        with self.assertRaises(LogTableCreationError):
+            CounterUserTable.register(CounterArchiveTable, self.engine, triggers=True)
+        with self.assertRaises(LogTableCreationError):
+            UserTable.register(
+                ArchiveTable, self.engine, triggers=True, outbox=QueueOutbox()
+            )
+        with mock.patch.object(ArchiveTable, 'va_keyframe_interval', 3):
+            with self.assertRaises(LogTableCreationError):
+                get_trigger_ddl(UserTable, ArchiveTable, self.engine.dialect)
+        with mock.patch.object(ArchiveTable.va_data, 'type', utils.CompressedJSONEncodedDict()):
+            with self.assertRaises(LogTableCreationError):
+                get_trigger_ddl(UserTable, ArchiveTable, self.engine.dialect)
+        with self.assertRaises(NotImplementedError):
+            get_trigger_ddl(UserTable, ArchiveTable, mysql.dialect())
+        with self.assertRaises(NotImplementedError):
+            get_drop_trigger_ddl(UserTable, mysql.dialect())
+
+
+class TestDateTimeTriggers(SQLiteTestBase):
+    def setUp(self):
+        super(TestDateTimeTriggers, self).setUp()
+        Base.metadata.create_all(self.engine)
+        self.addCleanup(Base.metadata.drop_all, self.engine)
+
+    def _write_rows(self, offset):
+        '''
+        Inserts, updates and deletes rows with datetimes with and without microseconds, and
+        returns the va_data of their archive rows without the columns which differ by offset.
+        '''
+        rows = [
+            DateTimeTable(product_id=offset + i, ts=ts) for i, ts in enumerate([
+                datetime(2020, 1, 1, 12, 30), datetime(2020, 1, 1, 12, 30, 0, 500), None,
+            ])
+        ]
+        self.session.add_all(rows)
+        self.session.commit()
+        rows[2].ts = datetime(2021, 2, 3, 4, 5, 6, 7)
+        self.session.delete(rows[0])
+        self.session.commit()
+        archived = self._result_to_dict(self.session.execute(
+            sa.select([DateTimeArchiveTable])
+            .where(DateTimeArchiveTable.product_id >= offset)
+            .order_by(DateTimeArchiveTable.va_id)
+        ))
+        return [
+            (r['va_deleted'],
+             {k: v for k, v in r['va_data'].items() if k not in ('id', 'product_id')})
+            for r in archived
+        ]
+
+    def test_datetimes_match_flushes(self):
+        DateTimeTable.register(DateTimeArchiveTable, self.engine)
+        flushed = self._write_rows(0)
+        self.assertEqual(flushed[0][1], {'ts': '2020-01-01T12:30:00'})
+        self.assertEqual(flushed[1][1], {'ts': '2020-01-01T12:30:00.000500'})
+
+        create_triggers(DateTimeTable, DateTimeArchiveTable, self.engine)
+        DateTimeTable.register(DateTimeArchiveTable, self.engine, triggers=True)
+        self.assertEqual(sorted(self._write_rows(10), key=repr), sorted(flushed, key=repr))
+
+        ddl = get_trigger_ddl(DateTimeTable, DateTimeArchiveTable, postgresql.dialect())[0]
+        self.assertIn(
+            "|| jsonb_build_object('ts', CASE WHEN (to_char(NEW.ts, 'US') = '000000')", ddl
+        )
+
+
+class TestPostgreSQLTriggerDDL(SQLiteTestBase):
+    def test_ddl(self):
+        dialect = postgresql.dialect()
+        function, insert, update, delete = get_trigger_ddl(UserTable, ArchiveTable, dialect)
+        self.assertIn('CREATE OR REPLACE FUNCTION test_table_va_archive()', function)
+        self.assertIn("(to_jsonb(NEW) - 'va_id')::text", function)
+        self.assertIn('RETURNING va_id INTO NEW.va_id', function)
+        self.assertIn('WHERE test_table_archive.product_id = OLD.product_id', function)
+        self.assertEqual(
+            insert,
+            'CREATE TRIGGER test_table_va_insert BEFORE INSERT ON test_table FOR EACH ROW '
+            'EXECUTE PROCEDURE test_table_va_archive()',
+        )
+        self.assertIn('BEFORE UPDATE OF other_name, id, product_id, col1, col2, col3 ON', update)
+        self.assertIn('OLD.other_name IS DISTINCT FROM NEW.other_name', update)
+        self.assertIn('BEFORE DELETE', delete)
+        self.assertEqual(
+            get_drop_trigger_ddl(UserTable, dialect)[-1],
+            'DROP FUNCTION IF EXISTS test_table_va_archive()',
+        )
+        # Version columns which are listed twice are only matched once
+        with mock.patch.object(UserTable, 'va_version_columns', ['product_id', 'product_id']):
+            self.assertEqual(
+                get_trigger_ddl(UserTable, ArchiveTable, dialect),
+                [function, insert, update, delete],
+            )
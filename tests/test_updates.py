@@ -115,6 +115,51 @@ class TestUpdate(SQLiteTestBase):
             'col2': -1,
         }), 1, user='test_user2', log_id=p.va_id)
 
+    def test_update_many_products_looks_up_versions_once(self):
+        rows = [UserTable(product_id=i, col1='foo', col2=i, col3=True) for i in range(50)]
+        self.session.add_all(rows)
+        self.session.flush()
+
+        for row in rows:
+            row.col1 = 'bar'
+        with self._record_statements() as statements:
+            self.session.flush()
+        max_queries = [
+            s for s in statements
+            if s.startswith('SELECT') and 'max(' in s and ArchiveTable.__tablename__ in s
+        ]
+        self.assertEqual(len(max_queries), 1)
+        for row in rows:
+            self.assertEqual(row.version(self.session), 1)
+            self._verify_archive(
+                dict(product_id=row.product_id, col1='bar', col2=row.product_id), 1,
+                log_id=row.va_id,
+            )
+
+    def test_update_many_products_backfills_va_ids_once(self):
+        rows = [UserTable(product_id=i, col1='foo', col2=i, col3=True) for i in range(1, 51)]
+        self.session.add_all(rows)
+        with self._record_statements() as statements:
+            self.session.flush()
+        self.assertEqual(self._count_statements(
+            statements, 'UPDATE', UserTable.__tablename__
+        ), 1)
+
+        for row in rows:
+            row.col2 = -row.col2
+        with self._record_statements() as statements:
+            self.session.flush()
+        # one for the ORM update of col2 and one for the va_id back-fill
+        self.assertEqual(self._count_statements(
+            statements, 'UPDATE', UserTable.__tablename__
+        ), 2)
+        self.session.expire_all()
+        for row in rows:
+            self.assertEqual(row.version(self.session), 1)
+            self._verify_archive(
+                dict(product_id=row.product_id, col2=row.col2), 1, log_id=row.va_id
+            )
+
 
 class TestConcurrentUpdate(unittest.TestCase, VaTestHelpers):
     DATABASE_URL = 'sqlite:///test.db'
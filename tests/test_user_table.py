@@ -1,13 +1,32 @@
 from __future__ import absolute_import
 
+import os
+import shutil
+import tempfile
+import warnings
+
 from sqlalchemy import Column, Integer, UniqueConstraint
+from sqlalchemy.dialects import mysql, oracle, postgresql
+from sqlalchemy.exc import NoSuchTableError
 from sqlalchemy.ext.declarative import declarative_base
 
-from tests.models import ArchiveTable, UserTable
+from tests.models import (
+    ArchiveTable,
+    CounterArchiveTable,
+    CounterUserTable,
+    MultiColumnArchiveTable,
+    MultiColumnUserTable,
+    UserTable,
+)
 from tests.utils import SQLiteTestBase
-from versionalchemy import VAModelMixin
-from versionalchemy.exceptions import LogTableCreationError
-from versionalchemy.models import VALogMixin
+from versionalchemy import register_all, schema, utils, VAModelMixin
+from versionalchemy.exceptions import LogTableCreationError, MissingIndexWarning
+from versionalchemy.models import VALIDATION_ENV_VAR, VALogMixin
+
+try:
+    from unittest import mock  # PY3
+except ImportError:
+    import mock
 
 
 class TestUserTable(SQLiteTestBase):
@@ -64,11 +83,226 @@ class TestUserTable(SQLiteTestBase):
                     UniqueConstraint('pid1', 'va_version', name='pid'),
                 )
             Base_.metadata.create_all(self.engine)
-            PKConstraint.register(PKConstraintArchive, self.engine)
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                PKConstraint.register(PKConstraintArchive, self.engine)
+            self.assertEqual([x.category for x in w], [MissingIndexWarning] * 2)
         finally:
             UserTable.register(ArchiveTable, self.engine)
             Base_.metadata.drop_all(self.engine)
 
+    def test_register_creates_indexes(self):
+        Base_ = declarative_base()
+
+        class IndexedTable(VAModelMixin, Base_):
+            __tablename__ = 'indexed_table'
+            va_version_columns = ['pid2', 'pid1']
+            id = Column(Integer, primary_key=True)
+            pid1 = Column(Integer)
+            pid2 = Column(Integer)
+            __table_args__ = (
+                UniqueConstraint('pid1', 'pid2'),
+            )
+
+        class IndexedTableArchive(VALogMixin, Base_):
+            __tablename__ = 'indexed_table_archive'
+            pid1 = Column(Integer)
+            pid2 = Column(Integer)
+            user_id = Column(Integer)
+            __table_args__ = (
+                UniqueConstraint('pid1', 'pid2', 'va_version'),
+            )
+        try:
+            Base_.metadata.create_all(self.engine)
+            IndexedTable.register(IndexedTableArchive, self.engine, create_indexes=True)
+            self.assertEqual(IndexedTableArchive._version_col_names, ['pid2', 'pid1'])
+            self.assertTrue(utils.has_index(
+                'indexed_table_archive', self.engine, 'pid2', 'pid1', 'va_updated_at'
+            ))
+            self.assertTrue(utils.has_index('indexed_table_archive', self.engine, 'va_updated_at'))
+            self.assertFalse(utils.has_index(
+                'indexed_table_archive', self.engine, 'pid1', 'pid2', 'va_updated_at'
+            ))
+
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                IndexedTable.register(IndexedTableArchive, self.engine)
+            self.assertEqual(w, [])
+        finally:
+            Base_.metadata.drop_all(self.engine)
+
+    def test_register_all(self):
+        models = [
+            (UserTable, ArchiveTable),
+            (MultiColumnUserTable, MultiColumnArchiveTable),
+            (CounterUserTable, CounterArchiveTable),
+        ]
+        tmp_dir = tempfile.mkdtemp()
+        cache_path = os.path.join(tmp_dir, 'schema.json')
+        try:
+            # each table is reflected once
+            with self._record_statements() as separate:
+                for Model, Archive in models:
+                    Model.register(Archive, self.engine)
+                    Archive._check_indexes(self.engine)
+            with self._record_statements() as statements:
+                register_all(models, self.engine)
+            self.assertLess(len(statements), len(separate))
+
+            # the snapshot is saved
+            with self._record_statements() as statements:
+                register_all(models, self.engine, cache_path=cache_path)
+            self.assertGreater(len(statements), 2)
+            self.assertTrue(os.path.exists(cache_path))
+
+            # warm starts only query the fingerprint
+            with self._record_statements() as statements:
+                register_all(models, self.engine, cache_path=cache_path)
+            self.assertEqual(len(statements), 1)
+            self.assertIs(UserTable.ArchiveTable, ArchiveTable)
+
+            # a schema change invalidates the snapshot
+            tbl_names = [table.__tablename__ for m in models for table in m]
+            fingerprint = schema.fingerprint(self.engine, tbl_names)
+            self.engine.execute('CREATE INDEX ix_test_col1 ON test_table (col1)')
+            try:
+                self.assertNotEqual(schema.fingerprint(self.engine, tbl_names), fingerprint)
+                with self._record_statements() as statements:
+                    register_all(models, self.engine, cache_path=cache_path)
+                self.assertGreater(len(statements), 2)
+            finally:
+                self.engine.execute('DROP INDEX ix_test_col1')
+
+            # without a fingerprint the snapshot is not used
+            with mock.patch.object(schema, 'fingerprint', return_value=None):
+                with self._record_statements() as statements:
+                    register_all(models, self.engine, cache_path=cache_path)
+            self.assertGreater(len(statements), 2)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_fingerprint_queries(self):
+        tbl_names = ['a', 'b']
+        self.assertIn(
+            'information_schema.statistics',
+            str(schema._get_fingerprint_query(mysql.dialect(), tbl_names)),
+        )
+        self.assertIn(
+            'pg_indexes', str(schema._get_fingerprint_query(postgresql.dialect(), tbl_names))
+        )
+        engine = mock.Mock(dialect=oracle.dialect())
+        self.assertIsNone(schema.fingerprint(engine, tbl_names))
+        engine.connect.assert_not_called()
+
+        snapshot = schema.SchemaSnapshot(tables={'a': {'indexes': []}})
+        self.assertEqual(snapshot.get_indexes('a'), [])
+        with self.assertRaises(NoSuchTableError):
+            snapshot.get_pk_constraint('a')
+
+    def test_register_all_validates(self):
+        Base_ = declarative_base()
+
+        class NoConstraint(VAModelMixin, Base_):
+            __tablename__ = 'no_constraint'
+            va_version_columns = ['pid1']
+            id = Column(Integer, primary_key=True)
+            pid1 = Column(Integer)
+
+        class NoConstraintArchive(VALogMixin, Base_):
+            __tablename__ = 'no_constraint_archive'
+            pid1 = Column(Integer)
+            user_id = Column(Integer)
+        try:
+            Base_.metadata.create_all(self.engine)
+            with self.assertRaises(LogTableCreationError):
+                register_all([(NoConstraint, NoConstraintArchive)], self.engine)
+        finally:
+            Base_.metadata.drop_all(self.engine)
+
+    def _make_lazy_models(self, constraint=True):
+        Base_ = declarative_base()
+
+        class LazyTable(VAModelMixin, Base_):
+            __tablename__ = 'lazy_table'
+            va_version_columns = ['pid']
+            id = Column(Integer, primary_key=True)
+            pid = Column(Integer)
+            __table_args__ = (UniqueConstraint('pid'),)
+
+        class LazyTableArchive(VALogMixin, Base_):
+            __tablename__ = 'lazy_table_archive'
+            pid = Column(Integer)
+            user_id = Column(Integer)
+            __table_args__ = (UniqueConstraint('pid', 'va_version'),) if constraint else ()
+
+        Base_.metadata.create_all(self.engine)
+        self.addCleanup(Base_.metadata.drop_all, self.engine)
+        return LazyTable, LazyTableArchive
+
+    def test_register_skips_validation(self):
+        LazyTable, LazyTableArchive = self._make_lazy_models(constraint=False)
+        with self._record_statements() as statements:
+            LazyTable.register(LazyTableArchive, self.engine, validate='skip')
+            with mock.patch.dict(os.environ, {VALIDATION_ENV_VAR: 'skip'}):
+                register_all([(LazyTable, LazyTableArchive)], self.engine)
+        self.assertEqual(statements, [])
+        self.assertIs(LazyTable.ArchiveTable, LazyTableArchive)
+        self.assertEqual(LazyTableArchive._version_col_names, ['pid'])
+        # the checks of the user table still pass when it is validated with an engine
+        LazyTable._validate(self.engine, LazyTable.pid)
+
+        with mock.patch.dict(os.environ, {VALIDATION_ENV_VAR: 'eager'}):
+            with self.assertRaises(LogTableCreationError):
+                LazyTable.register(LazyTableArchive, self.engine)
+        with self.assertRaises(ValueError):
+            LazyTable.register(LazyTableArchive, self.engine, validate='never')
+        with self.assertRaises(ValueError):
+            LazyTable.register(
+                LazyTableArchive, self.engine, validate='lazy', create_indexes=True
+            )
+
+    def test_register_validates_lazily(self):
+        LazyTable, LazyTableArchive = self._make_lazy_models()
+        with self._record_statements() as statements:
+            LazyTable.register(LazyTableArchive, self.engine, validate='lazy')
+        self.assertEqual(statements, [])
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            self.session.add(UserTable(**self.p1))
+            self.session.flush()
+            self.assertEqual(w, [])
+            self.session.add(LazyTable(pid=1))
+            self.session.flush()
+            self.assertEqual([x.category for x in w], [MissingIndexWarning] * 2)
+            self.session.add(LazyTable(pid=2))
+            self.session.flush()
+            self.assertEqual(len(w), 2)
+        self.session.commit()
+        self.assertEqual(self.session.query(LazyTableArchive).count(), 2)
+
+    def test_lazy_validation_runs_once(self):
+        LazyTable, LazyTableArchive = self._make_lazy_models()
+        LazyTable.register(LazyTableArchive, self.engine, validate='lazy')
+        # another flush validates the model while this one waits for the lock
+        lock = mock.MagicMock()
+        lock.__enter__.side_effect = \
+            lambda: setattr(LazyTable, '_va_validation_pending', False)
+        with mock.patch('versionalchemy.models._validation_lock', lock), \
+                mock.patch.object(LazyTable, '_check_schema') as check:
+            LazyTable._check_schema_lazily(self.session)
+        check.assert_not_called()
+
+    def test_lazy_validation_fails_flush(self):
+        LazyTable, LazyTableArchive = self._make_lazy_models(constraint=False)
+        LazyTable.register(LazyTableArchive, self.engine, validate='lazy')
+        for pid in range(2):
+            self.session.add(LazyTable(pid=pid))
+            with self.assertRaises(LogTableCreationError):
+                self.session.flush()
+            self.session.rollback()
+        self.assertEqual(self.session.query(LazyTableArchive).count(), 0)
+
     def test_insert_into_unregistered_table_fails(self):
         Base_ = declarative_base()
 
@@ -80,3 +314,16 @@ class TestUserTable(SQLiteTestBase):
         self.session.add(UnregisteredTable(pid=1, col1=5))
         with self.assertRaises(LogTableCreationError):
             self.session.commit()
+        # Rows of unregistered models can still be serialized
+        self.assertEqual(
+            UnregisteredTable(pid=2, col1=6)._to_dict(self.engine.dialect),
+            {'pid': 2, 'col1': 6, 'va_id': None},
+        )
+
+    def test_to_dict_serializer_is_cached(self):
+        dialect = self.engine.dialect
+        self.assertIs(UserTable._serializer(dialect), UserTable._serializer(dialect))
+        self.assertIsNot(UserTable._serializer(None), UserTable._serializer(dialect))
+
+        p = UserTable(col4=5, **self.p1)
+        self.assertEqual(p._to_dict(dialect), dict(self.p1, id=None, other_name=5))
@@ -1,18 +1,27 @@
 from __future__ import absolute_import
 
 import json
+import math
+import sys
 import unittest
-from datetime import datetime
+import uuid
+from datetime import date, datetime
 from decimal import Decimal
 
 import six
 import sqlalchemy as sa
+from sqlalchemy.dialects import mysql, oracle
 from sqlalchemy.exc import StatementError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 from versionalchemy import utils
 
+try:
+    from unittest import mock  # PY3
+except ImportError:
+    import mock
+
 EXCEPTIONS_NAME = 'builtins' if six.PY3 else 'exceptions'
 TYPE_NAME = 'class' if six.PY3 else 'type'
 
@@ -26,6 +35,15 @@ class TestModel(Base):
     json_dict = sa.Column(utils.JSONEncodedDict)
 
 
+class Name(str):
+    pass
+
+
+class NameType(sa.types.TypeDecorator):
+    impl = sa.String
+    python_type = Name
+
+
 class TestClass(object):
     def __init__(self, foo):
         self.foo = foo
@@ -54,6 +72,30 @@ class TestUtils(unittest.TestCase):
         attr = utils.get_column_attribute(test_row, 'json_list')
         self.assertEqual(attr, val)
 
+    def test_row_serializer(self):
+        m = TestModel(json_list=[1], json_dict={'a': 1})
+        self.session.add(m)
+        self.session.commit()
+        self.assertEqual(m.json_list, [1])
+        m.json_list = [1, 2]
+
+        dialect = self.engine.dialect
+        serializer = utils.RowSerializer(TestModel, dialect, ignore={'id'})
+        for use_dirty in (True, False):
+            self.assertEqual(serializer.to_dict(m, use_dirty=use_dirty), {
+                c: utils.get_column_attribute(m, c, use_dirty=use_dirty, dialect=dialect)
+                for c in ('json_list', 'json_dict')
+            })
+        self.assertEqual(
+            utils.RowSerializer(TestModel).to_dict(m, use_dirty=False),
+            {'id': m.id, 'json_list': [1], 'json_dict': {'a': 1}},
+        )
+
+        new = TestModel(json_list=[3])
+        self.assertEqual(
+            serializer.to_dict(new, use_dirty=False), {'json_list': None, 'json_dict': None}
+        )
+
     def test_json_encoded_none_value(self):
         m = TestModel(json_list=None, json_dict=None)
         self.session.add(m)
@@ -131,7 +173,158 @@ class TestUtils(unittest.TestCase):
             return
         self.assertTrue(False, 'Test should have raised ValueError')
 
+    def test_load_json_value(self):
+        self.assertEqual(
+            utils.load_json_value(sa.Column('c', sa.DateTime), '2020-01-01T12:00:00'),
+            datetime(2020, 1, 1, 12),
+        )
+        self.assertEqual(
+            utils.load_json_value(sa.Column('c', sa.Date), '2020-01-01'), date(2020, 1, 1)
+        )
+        self.assertEqual(utils.load_json_value(sa.Column('c', sa.Float), 1), 1.0)
+        self.assertEqual(utils.load_json_value(sa.Column('c', sa.types.NullType), 'a'), 'a')
+        self.assertIsNone(utils.load_json_value(sa.Column('c', sa.DateTime), None))
+        self.assertEqual(utils.load_json_value(sa.Column('c', sa.String), u'\xe9'), u'\xe9')
+        # Text is not converted to other string types, e.g. str on PY2
+        self.assertIs(
+            type(utils.load_json_value(sa.Column('c', NameType), u'\xe9')), six.text_type
+        )
+        with self.assertRaises(ValueError):
+            utils.load_json_value(sa.Column('c', sa.DateTime), 'yesterday')
+
+    def test_json_datetime(self):
+        col = sa.column('ts', sa.DateTime)
+        self.assertTrue(utils.is_naive_datetime(sa.Column('c', sa.DateTime)))
+        self.assertFalse(utils.is_naive_datetime(sa.Column('c', sa.DateTime(timezone=True))))
+        self.assertFalse(utils.is_naive_datetime(sa.Column('c', sa.Date)))
+        self.assertEqual(
+            str(utils.json_datetime(mysql.dialect(), col).compile(
+                dialect=mysql.dialect(), compile_kwargs={'literal_binds': True}
+            )),
+            "CASE WHEN (microsecond(ts) = 0) THEN date_format(ts, '%%Y-%%m-%%dT%%H:%%i:%%s') "
+            "ELSE date_format(ts, '%%Y-%%m-%%dT%%H:%%i:%%s.%%f') END",
+        )
+        self.assertIs(utils.json_datetime(oracle.dialect(), col), col)
+        ts = datetime(2020, 1, 1, 12, 30)
+        for value in (ts, ts.replace(microsecond=500), None):
+            self.assertEqual(
+                self.session.execute(sa.select([
+                    utils.json_datetime(self.engine.dialect, sa.literal(value, sa.DateTime))
+                ])).scalar(),
+                value and value.isoformat(),
+            )
+
     def test_is_modified(self):
         row = TestModel(json_list=[1, 2, 3])
         row.json_list = [1]
         self.assertTrue(utils.is_modified(row))
+
+
+class TestJSONCodecs(unittest.TestCase):
+    def setUp(self):
+        self.codecs = utils.get_json_codecs()
+
+    def tearDown(self):
+        utils.set_json_codec(self.codecs[0])
+        utils.set_json_codec(self.codecs[1], decode_only=True)
+
+    def _installed_codecs(self):
+        codecs = []
+        for name in ('orjson', 'rapidjson', 'ujson', 'json'):
+            try:
+                utils.set_json_codec(name)
+            except ImportError:
+                continue
+            codecs.append(name)
+        return codecs
+
+    def test_codecs_serialize_types_identically(self):
+        ts = datetime(2019, 1, 2, 3, 4, 5, 678)
+        u = uuid.UUID('12345678-1234-5678-1234-567812345678')
+        value = {
+            'ts': ts,
+            'date': date(2019, 1, 2),
+            'dec': Decimal('2.5'),
+            'uuid': u,
+            'nested': [1, u'\u2603', None, True, 1.5, {'a': 'b/c'}],
+        }
+        expected = json.loads(json.dumps(value, cls=utils.VAJSONEncoder))
+        self.assertEqual(expected['ts'], ts.isoformat())
+        self.assertEqual(expected['date'], '2019-01-02')
+        self.assertEqual(expected['uuid'], str(u))
+        for name in self._installed_codecs():
+            utils.set_json_codec(name)
+            self.assertEqual(utils.get_json_codecs(), (name, name))
+            self.assertEqual(utils.json_loads(utils.json_dumps(value)), expected)
+            for v in (ts, date(2019, 1, 2), Decimal('2.5'), u, u'\u2603', 'a/b'):
+                self.assertEqual(
+                    utils.json_dumps(v), json.dumps(v, ensure_ascii=False, cls=utils.VAJSONEncoder)
+                )
+
+    def test_codec_falls_back_to_json(self):
+        for name in self._installed_codecs():
+            utils.set_json_codec(name)
+            big = 2 ** 70
+            self.assertEqual(utils.json_loads(utils.json_dumps([big])), [big])
+            self.assertTrue(math.isnan(utils.json_loads('[NaN]')[0]))
+            with self.assertRaises(TypeError):
+                utils.json_dumps([TestClass('foo')])
+            with self.assertRaises(ValueError):
+                utils.json_loads('{')
+
+    def test_set_json_codec(self):
+        utils.set_json_codec('json')
+        self.assertEqual(utils.get_json_codecs(), ('json', 'json'))
+        utils.set_json_codec('auto', decode_only=True)
+        self.assertEqual(utils.get_json_codecs()[0], 'json')
+        utils.set_json_codec('auto')
+        self.assertIn(utils.get_json_codecs()[0], ('orjson', 'rapidjson', 'ujson', 'json'))
+        with self.assertRaises(KeyError):
+            utils.set_json_codec('foo')
+
+    def test_auto_skips_missing_codecs(self):
+        def missing():
+            raise ImportError('missing')
+        with mock.patch.dict(utils._json_codec_factories, clear=True):
+            utils._json_codec_factories['missing'] = missing
+            with self.assertRaises(ImportError):
+                utils.set_json_codec('auto')
+            utils._json_codec_factories['json'] = utils._stdlib_codec
+            utils.set_json_codec('auto')
+            self.assertEqual(utils.get_json_codecs(), ('json', 'json'))
+
+    def test_rapidjson_and_ujson_codecs(self):
+        # The calls of the codecs are checked with stand-ins of the libraries
+        rapidjson = mock.Mock(DM_NONE=0, UM_NONE=0)
+        ujson = mock.Mock()
+        with mock.patch.dict(sys.modules, rapidjson=rapidjson, ujson=ujson):
+            for name, module in [('rapidjson', rapidjson), ('ujson', ujson)]:
+                utils.set_json_codec(name)
+                self.assertEqual(utils.get_json_codecs(), (name, name))
+                self.assertIs(utils.json_dumps({'a': 1}), module.dumps.return_value)
+                self.assertIs(utils.json_loads('{"a": 1}'), module.loads.return_value)
+                module.loads.assert_called_once_with('{"a": 1}')
+        rapidjson.dumps.assert_called_once_with(
+            {'a': 1}, ensure_ascii=False, default=utils._json_default, datetime_mode=0, uuid_mode=0,
+        )
+        ujson.dumps.assert_called_once_with(
+            {'a': 1}, ensure_ascii=False, escape_forward_slashes=False,
+            default=utils._json_default,
+        )
+
+    def test_register_json_codec(self):
+        calls = []
+
+        def dumps(value):
+            calls.append(value)
+            return json.dumps(value)
+        utils.register_json_codec('custom', dumps, json.loads)
+        utils.set_json_codec('custom')
+        self.assertEqual(utils.JSONEncodedDict().process_bind_param({'a': 1}, None), '{"a": 1}')
+        self.assertEqual(calls, [{'a': 1}])
+
+    def test_string_values_are_not_reserialized(self):
+        value = '{"a":  "\\u2603"}'
+        self.assertEqual(utils.JSONEncodedDict().process_bind_param(value, None), value)
+        with self.assertRaises(ValueError):
+            utils.JSONEncodedList().process_bind_param(value, None)
@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+from tests.models import CounterArchiveTable, CounterUserTable, UserTable
+from tests.utils import SQLiteTestBase
+from versionalchemy import VAModelMixin
+from versionalchemy.exceptions import LogTableCreationError
+
+
+class TestVersionCounter(SQLiteTestBase):
+    UserTable = CounterUserTable
+
+    def setUp(self):
+        super(TestVersionCounter, self).setUp()
+        self.r1 = dict(product_id=10, col1='foo')
+        self.r2 = dict(product_id=11, col1='bar')
+
+    def _max_queries(self, statements):
+        return [
+            s for s in statements
+            if 'max(' in s and CounterArchiveTable.__tablename__ in s
+        ]
+
+    def test_insert(self):
+        row = CounterUserTable(**self.r1)
+        self._add_and_test_version(row, 0)
+        self.assertEqual(row.va_version, 0)
+        self._verify_row(dict(self.r1, va_version=0), 0)
+        self._verify_archive(self.r1, 0, log_id=row.va_id)
+
+    def test_update_does_not_query_versions(self):
+        row = CounterUserTable(**self.r1)
+        self._add_and_test_version(row, 0)
+
+        for i in range(1, 4):
+            row.col1 = 'change{}'.format(i)
+            with self._record_statements() as statements:
+                self.session.flush()
+            self.assertEqual(self._max_queries(statements), [])
+            self.assertEqual(row.va_version, i)
+            self._verify_archive(dict(self.r1, col1=row.col1), i, log_id=row.va_id)
+        self.session.commit()
+        self._verify_row(dict(self.r1, col1='change3', va_version=3), 3)
+
+    def test_version_does_not_query_archive(self):
+        row = CounterUserTable(**self.r1)
+        self.session.add(row)
+        self.session.flush()
+        with self._record_statements() as statements:
+            self.assertEqual(row.version(self.session), 0)
+        self.assertEqual(statements, [])
+
+    def test_counter_not_in_data(self):
+        row = CounterUserTable(**self.r1)
+        self._add_and_test_version(row, 0)
+        row.col1 = 'new'
+        self._add_and_test_version(row, 1)
+        data = self.session.execute(
+            sa.select([CounterArchiveTable.va_data])
+            .where(CounterArchiveTable.va_id == row.va_id)
+        ).scalar()
+        self.assertNotIn('va_version', data)
+
+    def test_delete_and_insert(self):
+        row = CounterUserTable(**self.r1)
+        self._add_and_test_version(row, 0)
+        row.col1 = 'new'
+        self._add_and_test_version(row, 1)
+
+        self.session.delete(row)
+        self.session.flush()
+        self._verify_archive(dict(self.r1, col1='new'), 2, deleted=True)
+
+        row = CounterUserTable(**dict(self.r1, col1='again'))
+        self._add_and_test_version(row, 3)
+        self._verify_archive(dict(self.r1, col1='again'), 3, log_id=row.va_id)
+
+    def test_update_version_column(self):
+        old = CounterUserTable(**self.r1)
+        self._add_and_test_version(old, 0)
+        self.session.delete(old)
+        self.session.commit()
+
+        row = CounterUserTable(**self.r2)
+        self._add_and_test_version(row, 0)
+        row.product_id = self.r1['product_id']
+        self._add_and_test_version(row, 2)
+        self._verify_archive(self.r2, 1, deleted=True)
+        self._verify_archive(dict(self.r2, product_id=10), 2, log_id=row.va_id)
+
+    def test_populate_version_counter(self):
+        rows = [CounterUserTable(**self.r1), CounterUserTable(**self.r2)]
+        self.session.add_all(rows)
+        self.session.commit()
+        rows[0].col1 = 'new'
+        self.session.commit()
+        self.session.execute(sa.update(CounterUserTable.__table__).values(va_version=None))
+
+        self.assertEqual(CounterUserTable.populate_version_counter(self.session), 2)
+        self.session.expire_all()
+        self.assertEqual([r.va_version for r in rows], [1, 0])
+        self.assertEqual(CounterUserTable.populate_version_counter(self.session), 0)
+
+    def test_unpopulated_counter_queries_versions(self):
+        row = CounterUserTable(**self.r1)
+        self._add_and_test_version(row, 0)
+        self.session.execute(sa.update(CounterUserTable.__table__).values(va_version=None))
+        self.session.expire_all()
+
+        row.col1 = 'new'
+        with self._record_statements() as statements:
+            self.session.flush()
+        self.assertEqual(len(self._max_queries(statements)), 1)
+        self.assertEqual(row.version(self.session), 1)
+
+    def test_register_validates_counter(self):
+        Base_ = declarative_base()
+
+        class WrongCounterType(VAModelMixin, Base_):
+            __tablename__ = 'wrong_counter_type'
+            va_version_columns = ['pid']
+            pid = Column(Integer, primary_key=True)
+            va_version = Column(String(10))
+        with self.assertRaises(LogTableCreationError):
+            WrongCounterType.register(CounterArchiveTable, self.engine)
+
+        with self.assertRaises(LogTableCreationError):
+            UserTable.populate_version_counter(self.session)
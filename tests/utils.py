@@ -1,5 +1,8 @@
 from __future__ import absolute_import
 
+import contextlib
+import os
+import tempfile
 import unittest
 
 import sqlalchemy as sa
@@ -10,6 +13,8 @@ import versionalchemy as va
 from tests.models import (
     ArchiveTable,
     Base,
+    CounterArchiveTable,
+    CounterUserTable,
     MultiColumnArchiveTable,
     MultiColumnUserTable,
     UserTable,
@@ -26,6 +31,29 @@ class VaTestHelpers(object):
     def _result_to_dict(self, res):
         return utils.result_to_dict(res)
 
+    @contextlib.contextmanager
+    def _record_statements(self, engine=None):
+        '''
+        Yields a list which collects the SQL of every statement executed on engine (defaults to
+        self.engine) until the context exits; an executemany is recorded once.
+        '''
+        if engine is None:
+            engine = self.engine
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        sa.event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            sa.event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    def _count_statements(self, statements, prefix, table):
+        return len([
+            s for s in statements if s.startswith(prefix) and ' {} '.format(table) in s + ' '
+        ])
+
     def _verify_archive(
         self,
         expected,
@@ -125,6 +153,7 @@ class SQLiteTestBase(unittest.TestCase, VaTestHelpers):
         Base.metadata.create_all(self.engine)
         UserTable.register(ArchiveTable, self.engine)
         MultiColumnUserTable.register(MultiColumnArchiveTable, self.engine)
+        CounterUserTable.register(CounterArchiveTable, self.engine)
         self.p1 = dict(product_id=10, col1='foobar', col2=10, col3=1)
         self.p2 = dict(product_id=11, col1='baz', col2=11, col3=1)
         self.p3 = dict(product_id=2546, col1='test', col2=12, col3=0)
@@ -136,4 +165,22 @@ class SQLiteTestBase(unittest.TestCase, VaTestHelpers):
         self.engine.execute(delete_cmd.format(ArchiveTable.__tablename__))
         self.engine.execute(delete_cmd.format(MultiColumnUserTable.__tablename__))
         self.engine.execute(delete_cmd.format(MultiColumnArchiveTable.__tablename__))
+        self.engine.execute(delete_cmd.format(CounterUserTable.__tablename__))
+        self.engine.execute(delete_cmd.format(CounterArchiveTable.__tablename__))
         self.session.close()
+
+
+class SQLiteFileTestBase(SQLiteTestBase):
+    '''
+    Runs the tests on a database file instead of in memory, so that other threads can connect to
+    the same database.
+    '''
+    def setUp(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.engine = sa.create_engine(
+            'sqlite:///{}'.format(path), connect_args={'isolation_level': None}
+        )
+        self.Session = sessionmaker(bind=self.engine)
+        super(SQLiteFileTestBase, self).setUp()
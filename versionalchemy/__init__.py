@@ -1,15 +1,21 @@
 from __future__ import absolute_import
 
+import six
 import sqlalchemy as sa
+from six.moves import zip
 from sqlalchemy.orm import Session
 
-from versionalchemy import utils
+from versionalchemy import api, schema, utils
+from versionalchemy.bulk import versioned_delete, versioned_update  # noqa
 from versionalchemy.exceptions import LogTableCreationError
 
-from .models import VAModelMixin
+from .models import get_validation_mode, VAModelMixin
 
 _initialized = False
 
+# The key in Session.info of the rows archived by triggers whose va_id is expired after the flush
+_TRIGGERED_KEY = 'va_triggered_rows'
+
 
 def init():
     """
@@ -21,6 +27,7 @@ def init():
         return
     _initialized = True
     sa.event.listen(Session, 'after_flush', _after_flush_handler)
+    sa.event.listen(Session, 'after_flush_postexec', _after_flush_postexec_handler)
 
 
 def is_initialized():
@@ -28,64 +35,361 @@ def is_initialized():
     return _initialized
 
 
+def register_all(models, engine, create_indexes=False, cache_path=None, validate=None):
+    """
+    :param models: an iterable of ``(Model, ArchiveTable)`` or \
+        ``(Model, ArchiveTable, CheckpointTable)`` tuples to register with \
+        :meth:`~versionalchemy.models.VAModelMixin.register`
+    :param engine: the database engine
+    :param create_indexes: whether to create the missing indexes of the archive tables, see \
+        :meth:`~versionalchemy.models.VAModelMixin.register`
+    :param cache_path: an optional path of a file to cache the reflected schema in. If the file \
+        was written for the current schema fingerprint (see \
+        :func:`versionalchemy.schema.fingerprint`) the tables are validated against it without \
+        reflecting them; otherwise it is rewritten once all models are registered.
+    :param validate: when to reflect the tables to validate them, see \
+        :meth:`~versionalchemy.models.VAModelMixin.register`. The cache is only used by eager \
+        validation.
+
+    Registers all models while reflecting every table once, with a single inspector shared by all
+    models.
+    """
+    models = [tuple(m) for m in models]
+    tbl_names = sorted({table.__tablename__ for m in models for table in m})
+    validate = get_validation_mode(validate)
+    snapshot = fingerprint = None
+    if cache_path is not None and validate == 'eager':
+        fingerprint = schema.fingerprint(engine, tbl_names)
+        if fingerprint is not None:
+            snapshot = schema.load_snapshot(cache_path, fingerprint, engine)
+    if snapshot is None:
+        snapshot = schema.SchemaSnapshot(engine)
+
+    for m in models:
+        Model, ArchiveTable = m[:2]
+        Model.register(
+            ArchiveTable,
+            engine,
+            create_indexes=create_indexes,
+            CheckpointTable=m[2] if len(m) > 2 else None,
+            inspector=snapshot,
+            validate=validate,
+        )
+
+    # The schema changes if indexes were created, in which case it is reflected again next time
+    if (
+        fingerprint is not None and snapshot.reflected and
+        schema.fingerprint(engine, tbl_names) == fingerprint
+    ):
+        schema.save_snapshot(cache_path, fingerprint, snapshot)
+
+
 def _after_flush_handler(session, flush_context):
     handlers = [
         (_versioned_delete, session.deleted),
         (_versioned_insert, session.new),
         (_versioned_update, session.dirty),
     ]
+    to_version = []
+    to_outbox = []
+    triggered = []
     for handler, rows in handlers:
         for row in rows:
             if isinstance(row, VAModelMixin):
                 if not hasattr(row, 'ArchiveTable'):
                     raise LogTableCreationError('Need to register va tables!!')
-                user_id = getattr(row, '_updated_by', None)
-                va_id = handler(row, session, user_id)
-                if va_id:
-                    Model = type(row)
-                    where_clause = utils.generate_and_clause(
-                        Model, row, row.va_version_columns
-                    )
-                    session.execute(sa.update(Model, values={'va_id': va_id}).where(where_clause))
-                    row.va_id = va_id
-
-
-def _versioned_delete(row, session, user_id=None):
-    result = session.execute(
-        sa.insert(row.ArchiveTable),
-        row.ArchiveTable.build_row_dict(row, session, deleted=True, user_id=user_id)
-    )
-    # This should not matter since the row is being deleted anyways from the user
-    # table but is here if we ever decide to implement soft deletes on the user table
-    return result.inserted_primary_key[0]
-
-
-def _versioned_update(row, session, user_id=None):
-    if not utils.is_modified(row, ignore={'va_id'}):
+                row._check_schema_lazily(session)
+                if row.va_triggers:
+                    triggered.append(row)
+                else:
+                    (to_version if row.va_outbox is None else to_outbox).append((handler, row))
+    if to_outbox:
+        _put_outbox_rows(session, to_outbox)
+    if triggered:
+        _invalidate_triggered(session, triggered)
+        session.info[_TRIGGERED_KEY] = triggered
+
+    latest_versions = _prefetch_latest_versions(session, to_version)
+    archive_rows = []
+    versioned = []
+    for handler, row in to_version:
+        user_id = getattr(row, '_updated_by', None)
+        ArchiveTable = row.ArchiveTable
+        row_dicts = handler(row, session, user_id, latest_versions[ArchiveTable])
+        if not row_dicts:
+            continue
+        archive_rows.extend((ArchiveTable, row_dict) for row_dict in row_dicts)
+        # The va_id of a user table row points at the last archive row written for it
+        versioned.append((row, len(archive_rows) - 1))
+
+    va_ids = _insert_archive_rows(session, archive_rows)
+    _update_user_rows(session, versioned, archive_rows, va_ids)
+    _invalidate_caches(archive_rows, session=session)
+
+
+def _after_flush_postexec_handler(session, flush_context):
+    """
+    Expires the ``va_id`` of the rows archived by triggers, which the triggers set in the
+    database, so that it is loaded again instead of keeping the value it had before the flush.
+    """
+    for row in session.info.pop(_TRIGGERED_KEY, ()):
+        if sa.inspect(row).persistent:
+            session.expire(row, ['va_id'])
+
+
+def _put_outbox_rows(session, to_outbox):
+    """
+    :param session: the session being flushed
+    :param to_outbox: a list of ``(handler, row)`` tuples for the rows of models registered with \
+        an outbox
+
+    Builds the archive rows of the rows and puts them into the outbox of their model without
+    versions, which are assigned when the outbox is drained (see :mod:`versionalchemy.outbox`).
+    No query is issued to look up the latest versions.
+    """
+    entries = {}
+    for handler, row in to_outbox:
+        user_id = getattr(row, '_updated_by', None)
+        # An empty map of latest versions stops build_row_dict from querying them
+        row_dicts = handler(row, session, user_id, {})
+        for row_dict in row_dicts:
+            del row_dict['va_version']
+        entries.setdefault(row.va_outbox, []).extend(
+            (type(row), row_dict) for row_dict in row_dicts
+        )
+    for outbox, outbox_entries in six.iteritems(entries):
+        outbox.put(session, outbox_entries)
+
+
+def _invalidate_caches(archive_rows, session=None):
+    """
+    :param archive_rows: the ``(ArchiveTable, row_dict)`` tuples inserted by this flush
+    :param session: the session which inserted the rows, if it did not commit them yet
+
+    Invalidates the cached reads of the rows archived by this flush, see
+    :class:`~versionalchemy.api.cache.ReadCache`.
+    """
+    if not api.cache._caches:
         return
+    keys = {}
+    for ArchiveTable, row_dict in archive_rows:
+        keys.setdefault(ArchiveTable, set()).add(
+            tuple(row_dict[col_name] for col_name in ArchiveTable._version_col_names)
+        )
+    for ArchiveTable, table_keys in six.iteritems(keys):
+        api.cache.invalidate(ArchiveTable, table_keys, session=session)
+
+
+def _invalidate_triggered(session, rows):
+    """
+    :param session: the session being flushed
+    :param rows: the flushed rows of models whose archive rows are written by triggers, see
+        :mod:`versionalchemy.triggers`
+
+    Invalidates the cached reads of the rows, under their keys before and after the flush.
+    """
+    if not api.cache._caches:
+        return
+    keys = {}
+    for row in rows:
+        keys.setdefault(row.ArchiveTable, set()).update(_version_keys(row))
+    for ArchiveTable, table_keys in six.iteritems(keys):
+        api.cache.invalidate(ArchiveTable, table_keys, session=session)
+
+
+def _update_user_rows(session, versioned, archive_rows, va_ids):
+    """
+    :param session: the session being flushed
+    :param versioned: a list of ``(row, i)`` tuples where ``archive_rows[i]`` is the last archive \
+        row written for the user table row
+    :param archive_rows: the ``(ArchiveTable, row_dict)`` tuples inserted by this flush
+    :param va_ids: the va_ids of archive_rows
+
+    Points the user table rows, in memory and in the database, at their latest archive rows.
+    """
+    backfill = {}
+    for row, i in versioned:
+        row_dict = archive_rows[i][1]
+        params = {'va_id': va_ids[i]}
+        if row._va_version_counter:
+            params['va_version'] = row_dict['va_version']
+        for attr, value in six.iteritems(params):
+            setattr(row, attr, value)
+        # A deleted row no longer exists in the user table so only its in memory state is updated
+        if not row_dict['va_deleted']:
+            params.update(
+                (_key_param(c), utils.get_column_attribute(row, c))
+                for c in row.va_version_columns
+            )
+            backfill.setdefault(type(row), []).append(params)
+
+    for Model, params in six.iteritems(backfill):
+        _backfill_va_ids(session, Model, params)
+
+
+def _prefetch_latest_versions(session, to_version):
+    """
+    :param session: the session being flushed
+    :param to_version: a list of ``(handler, row)`` tuples for the rows archived by this flush
+
+    Looks up the latest version of every key touched by the flush with one grouped query per
+    archive table. Keys of rows with a version counter are taken from the counter instead.
+    build_row_dict bumps the versions it hands out in these maps, so a key that is archived more
+    than once per flush does not reuse a version that has not been written yet.
+
+    :return: a dict mapping each archive table to a dict of key -> latest version
+    :rtype: dict
+    """
+    keys = {}
+    latest_versions = {}
+    for handler, row in to_version:
+        table_keys = keys.setdefault(row.ArchiveTable, set())
+        table_versions = latest_versions.setdefault(row.ArchiveTable, {})
+        key, committed_key = _version_keys(row)
+        table_keys.add(key)
+        if handler is _versioned_insert:
+            continue
+        counter = row._committed_version()
+        if counter is None:
+            table_keys.add(committed_key)
+        else:
+            table_versions[committed_key] = counter
+
+    for ArchiveTable, table_keys in six.iteritems(keys):
+        table_versions = latest_versions[ArchiveTable]
+        table_versions.update(ArchiveTable._latest_versions(
+            session, table_keys.difference(table_versions)
+        ))
+    return latest_versions
 
+
+def _key_param(col_name):
+    # Bind parameter names may not collide with the names of columns in the SET clause
+    return '_va_key_{}'.format(col_name)
+
+
+def _backfill_va_ids(session, Model, params):
+    """
+    :param session: the session being flushed
+    :param Model: a registered user table model
+    :param params: a list of dicts with the new ``va_id`` (and ``va_version`` if the model has a \
+        version counter) of a row and the values of its version columns, keyed by \
+        :func:`_key_param`
+
+    Points the user table rows at their latest archive rows with a single executemany
+    ``UPDATE`` rather than one round trip per row.
+    """
+    where_clause = sa.and_(*(
+        getattr(Model, col_name) == sa.bindparam(_key_param(col_name))
+        for col_name in Model.va_version_columns
+    ))
+    session.execute(sa.update(Model.__table__).where(where_clause), params)
+
+
+def _version_keys(row):
+    """
+    :param row: an instance of a registered user table
+
+    :return: a tuple of the values of the version columns of row and their values before they
+        were changed (the same tuple if they were not changed), each in the order of
+        ``row.ArchiveTable._version_col_names``.
+    :rtype: tuple
+    """
+    col_names = row.ArchiveTable._version_col_names
+    key = tuple(utils.get_column_attribute(row, c) for c in col_names)
+    if not any(getattr(sa.inspect(row).attrs, c).history.has_changes() for c in col_names):
+        return key, key
+    return key, tuple(utils.get_column_attribute(row, c, use_dirty=False) for c in col_names)
+
+
+def _insert_archive_rows(session, archive_rows):
+    """
+    :param session: the session being flushed
+    :param archive_rows: a list of ``(ArchiveTable, row_dict)`` tuples where each ``row_dict`` was
+        built by :meth:`~versionalchemy.models.VALogMixin.build_row_dict`
+
+    Inserts the rows with one executemany per archive table (and set of columns), instead of one
+    round trip per row.
+
+    :return: a list of the va_ids of the inserted rows, in the same order as ``archive_rows``
+    :rtype: list
+    """
+    groups = {}
+    for i, (ArchiveTable, row_dict) in enumerate(archive_rows):
+        groups.setdefault((ArchiveTable, frozenset(row_dict)), []).append(i)
+
+    va_ids = [None] * len(archive_rows)
+    for (ArchiveTable, _), indices in six.iteritems(groups):
+        row_dicts = [archive_rows[i][1] for i in indices]
+        result = session.execute(sa.insert(ArchiveTable), row_dicts)
+        if len(row_dicts) == 1:
+            va_ids[indices[0]] = result.inserted_primary_key[0]
+            continue
+
+        # Primary keys are not reported for executemany, so read them back through the unique
+        # constraint on the version columns and va_version.
+        col_names = list(ArchiveTable._version_col_names) + ['va_version']
+        positions = {
+            tuple(row_dict[col_name] for col_name in col_names): i
+            for i, row_dict in zip(indices, row_dicts)
+        }
+        for keys in utils.chunks(list(positions), utils.max_conditions(len(col_names))):
+            result = session.execute(
+                sa.select(
+                    [ArchiveTable.va_id] + [getattr(ArchiveTable, c) for c in col_names]
+                ).where(utils.generate_in_clause(ArchiveTable, col_names, keys))
+            )
+            for row in result:
+                i = positions.pop(tuple(row[1:]), None)
+                if i is not None:
+                    va_ids[i] = row[0]
+        # Keys which are read back as other values than they were written with, e.g. by types
+        # which convert values, are looked up one by one with the values they were written with
+        for key, i in six.iteritems(positions):
+            va_ids[i] = session.execute(
+                sa.select([ArchiveTable.va_id]).where(sa.and_(*(
+                    getattr(ArchiveTable, col_name) == value
+                    for col_name, value in zip(col_names, key)
+                )))
+            ).scalar()
+    return va_ids
+
+
+def _versioned_delete(row, session, user_id=None, latest_versions=None):
+    # The va_id of this row should not matter since the row is being deleted anyways from the user
+    # table but is kept in sync in case we ever decide to implement soft deletes on the user table
+    return [row.ArchiveTable.build_row_dict(
+        row, session, deleted=True, user_id=user_id, latest_versions=latest_versions
+    )]
+
+
+def _versioned_update(row, session, user_id=None, latest_versions=None):
+    if not utils.is_modified(row, ignore={'va_id', 'va_version'}):
+        return []
+
+    row_dicts = []
     # Check if composite key has been changed
     for col in row.va_version_columns:
         hist = getattr(sa.inspect(row).attrs, col).history
         if hist.has_changes():
             # delete the original row from the archive table
-            session.execute(
-                sa.insert(row.ArchiveTable),
-                row.ArchiveTable.build_row_dict(
-                    row, session, user_id=user_id, deleted=True, use_dirty=False
-                )
-            )
+            row_dicts.append(row.ArchiveTable.build_row_dict(
+                row,
+                session,
+                user_id=user_id,
+                deleted=True,
+                use_dirty=False,
+                latest_versions=latest_versions,
+            ))
 
-    result = session.execute(
-        sa.insert(row.ArchiveTable),
-        row.ArchiveTable.build_row_dict(row, session, user_id=user_id)
-    )
-    return result.inserted_primary_key[0]
+    # The new row is a delta of the previous version unless its key changed
+    row_dicts.append(row.ArchiveTable.build_row_dict(
+        row, session, user_id=user_id, latest_versions=latest_versions, delta=not row_dicts
+    ))
+    return row_dicts
 
 
-def _versioned_insert(row, session, user_id=None):
-    result = session.execute(
-        sa.insert(row.ArchiveTable),
-        row.ArchiveTable.build_row_dict(row, session, user_id=user_id)
-    )
-    return result.inserted_primary_key[0]
+def _versioned_insert(row, session, user_id=None, latest_versions=None):
+    return [row.ArchiveTable.build_row_dict(
+        row, session, user_id=user_id, latest_versions=latest_versions
+    )]
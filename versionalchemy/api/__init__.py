@@ -1,3 +1,5 @@
 from __future__ import absolute_import
 
-from .data import delete, get  # noqa
+from .cache import ReadCache  # noqa
+from .checkpoint import build_checkpoint  # noqa
+from .data import delete, get, get_many, iter_history, Page  # noqa
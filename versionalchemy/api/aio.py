@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from versionalchemy.api import data
+
+
+class AsyncAPI(object):
+    '''
+    Runs :func:`versionalchemy.api.get` and :func:`versionalchemy.api.delete` on a bounded pool of
+    threads so they do not block the event loop. Each method returns an awaitable future, and
+    each call uses a session of its own which is closed when the call is done, e.g.::
+
+        va_api = AsyncAPI(Session, max_workers=8)
+        result = await va_api.get(UserTable, conds=[{'product_id': 10}])
+        results = await va_api.get_each(UserTable, [[{'product_id': 10}], [{'product_id': 11}]])
+
+    Calls share the connections of the engine's pool, so max_workers should not exceed the
+    connections the pool allows (``pool_size + max_overflow``), or calls wait for a connection.
+
+    :param session_factory: a callable returning a new session, e.g. a \
+        :class:`~sqlalchemy.orm.session.sessionmaker`
+    :param max_workers: the maximum number of calls which run concurrently; defaults to the \
+        default of :class:`~concurrent.futures.ThreadPoolExecutor`
+    '''
+    def __init__(self, session_factory, max_workers=None):
+        self.session_factory = session_factory
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get(self, va_table, *args, **kwargs):
+        '''
+        Takes the arguments of :func:`versionalchemy.api.get` without the session.
+
+        :return: a future of the result of :func:`versionalchemy.api.get`
+        '''
+        return self._run(self._get, va_table, *args, **kwargs)
+
+    def get_each(self, va_table, conds_list, *args, **kwargs):
+        '''
+        :param conds_list: a list of ``conds`` arguments
+
+        Runs :meth:`get` concurrently for each of conds_list with the other arguments.
+
+        :return: a future of the list of results, in the order of conds_list
+        '''
+        return asyncio.gather(*[
+            self.get(va_table, *args, conds=conds, **kwargs) for conds in conds_list
+        ])
+
+    def delete(self, va_table, conds):
+        '''
+        Takes the arguments of :func:`versionalchemy.api.delete` without the session, and commits
+        the deletion.
+
+        :return: a future which is done once the rows are deleted
+        '''
+        return self._run(self._delete, va_table, conds)
+
+    def shutdown(self, wait=True):
+        '''
+        Stops the threads once the pending calls are done.
+        '''
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def _get(self, va_table, *args, **kwargs):
+        session = self.session_factory()
+        try:
+            return data.get(va_table, session, *args, **kwargs)
+        finally:
+            session.close()
+
+    def _delete(self, va_table, conds):
+        session = self.session_factory()
+        try:
+            data.delete(va_table, session, conds)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
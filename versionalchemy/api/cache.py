@@ -0,0 +1,225 @@
+from __future__ import absolute_import
+
+import copy
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from datetime import datetime
+
+import six
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+# Every live ReadCache, so that flushes can invalidate them
+_caches = weakref.WeakSet()
+_caches_lock = threading.Lock()
+
+# The key in Session.info of the rows written by the transaction of a session, which are
+# invalidated again when it ends
+_PENDING_KEY = 'va_cache_pending'
+
+_listening = False
+_listening_lock = threading.Lock()
+
+
+class ReadCache(object):
+    '''
+    An in process cache of the results of :func:`versionalchemy.api.get`, which is used by passing
+    it as the ``cache`` argument. Results are keyed by the table and all arguments of ``get``.
+
+    The least recently used results are evicted once there are more than ``maxsize``, and results
+    expire ``ttl`` seconds after they were cached. Results of historical queries (time slices with
+    t1 and ranges with t2 before the time the query is cached) do not expire since later writes
+    cannot change them, but they are still evicted and invalidated.
+
+    Results for a row are invalidated when the row is archived by a flush of any session in this
+    process, or deleted with :func:`versionalchemy.api.delete`, and again when the transaction
+    which wrote them is committed or rolled back, so that results read in between are not kept;
+    results of queries without ``conds`` are invalidated by changes to any row of the table.
+    Sessions whose transaction wrote rows of a table which are not committed yet read the table
+    without the cache, so their uncommitted rows are neither cached nor hidden by cached results.
+    Changes made by other processes are only picked up when results expire.
+
+    :param maxsize: the maximum number of results cached
+    :param ttl: the number of seconds after which results expire, or None if results only need \
+        to be invalidated
+    '''
+    def __init__(self, maxsize=1024, ttl=60):
+        if maxsize < 1:
+            raise ValueError('maxsize must be >= 1')
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # cache key -> (expiry, archive table, row keys, result), in least recently used order
+        self._entries = OrderedDict()
+        # archive table -> row key -> cache keys; all rows are under the key None
+        self._index = {}
+        with _caches_lock:
+            _caches.add(self)
+        _listen_for_transactions()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+
+    def get(self, key):
+        '''
+        :param key: a key returned by :meth:`make_key`
+
+        :return: a copy of the cached result for key, or None if it is not cached
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] <= time.time():
+                self._remove(key)
+                return None
+            self._entries[key] = self._entries.pop(key)
+        return copy.deepcopy(entry[3])
+
+    def set(self, key, va_table, row_keys, result, historical=False):
+        '''
+        :param key: a key returned by :meth:`make_key`
+        :param va_table: the model class of the user table which was queried
+        :param row_keys: the tuples of version column values of the rows the result depends on, \
+            or None if it depends on every row in the table
+        :param result: the result to cache, which is copied
+        :param historical: whether the result can no longer change, so it does not expire
+        '''
+        expiry = None if historical or self.ttl is None else time.time() + self.ttl
+        table = va_table.ArchiveTable
+        result = copy.deepcopy(result)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expiry, table, row_keys, result)
+            index = self._index.setdefault(table, {})
+            for row_key in ([None] if row_keys is None else row_keys):
+                index.setdefault(row_key, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, ArchiveTable, row_keys):
+        '''
+        :param ArchiveTable: the model class of an archive table
+        :param row_keys: tuples of version column values of rows which changed, or None if any \
+            row may have changed
+
+        Removes the results which depend on the rows.
+        '''
+        with self._lock:
+            index = self._index.get(ArchiveTable)
+            if not index:
+                return
+            if row_keys is None:
+                keys = set().union(*index.values())
+            else:
+                keys = set(index.get(None, ()))
+                for row_key in row_keys:
+                    keys.update(index.get(row_key, ()))
+            for key in keys:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, table, row_keys, _ = self._entries.pop(key)
+        index = self._index[table]
+        for row_key in ([None] if row_keys is None else row_keys):
+            keys = index[row_key]
+            keys.discard(key)
+            if not keys:
+                del index[row_key]
+
+    @staticmethod
+    def make_key(va_table, conds, fields, **kwargs):
+        '''
+        :param va_table: the model class of the user table which is queried
+        :param conds: the conds argument of :func:`versionalchemy.api.get`
+        :param fields: the fields argument of :func:`versionalchemy.api.get`
+        :param kwargs: the other arguments of :func:`versionalchemy.api.get`
+
+        :return: a hashable key of the query
+        '''
+        return (
+            va_table,
+            None if conds is None else tuple(tuple(sorted(six.iteritems(c))) for c in conds),
+            None if fields is None else tuple(fields),
+            tuple(sorted(six.iteritems(kwargs))),
+        )
+
+    @staticmethod
+    def is_historical(t1, t2):
+        '''
+        :return: whether a query with t1 and t2 can no longer change, i.e. it only covers \
+        versions written before now
+        '''
+        t = t1 if t2 is None else t2
+        return isinstance(t, datetime) and t < datetime.now()
+
+
+def invalidate(ArchiveTable, row_keys, session=None):
+    '''
+    :param ArchiveTable: the model class of an archive table
+    :param row_keys: tuples of version column values of rows which changed, or None if any row \
+        may have changed
+    :param session: the session which changed the rows, if they are not committed yet. The rows \
+        are then invalidated again when its transaction ends, since they may have been read and \
+        cached before it is committed or rolled back.
+
+    Removes the results which depend on the rows from every :class:`ReadCache`.
+    '''
+    with _caches_lock:
+        caches = list(_caches)
+    if not caches:
+        return
+    if row_keys is not None:
+        row_keys = list(row_keys)
+    for cache in caches:
+        cache.invalidate(ArchiveTable, row_keys)
+    if session is not None:
+        pending = session.info.setdefault(_PENDING_KEY, {})
+        if row_keys is None or pending.get(ArchiveTable, ()) is None:
+            pending[ArchiveTable] = None
+        else:
+            pending.setdefault(ArchiveTable, set()).update(row_keys)
+
+
+def has_pending_writes(session, ArchiveTable):
+    '''
+    :param session: a session
+    :param ArchiveTable: the model class of an archive table
+
+    :return: whether the transaction of session archived rows of ArchiveTable which are not \
+    committed yet, so its reads of them may not be cached
+    '''
+    return ArchiveTable in session.info.get(_PENDING_KEY, ())
+
+
+def _listen_for_transactions():
+    global _listening
+    with _listening_lock:
+        if _listening:
+            return
+        _listening = True
+        sa.event.listen(Session, 'after_soft_rollback', _after_soft_rollback)
+        sa.event.listen(Session, 'after_transaction_end', _after_transaction_end)
+
+
+def _invalidate_pending(session, pending):
+    for ArchiveTable, row_keys in six.iteritems(pending or {}):
+        invalidate(ArchiveTable, row_keys)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    # Results read within a savepoint which was rolled back may include its rows
+    _invalidate_pending(session, session.info.get(_PENDING_KEY))
+
+
+def _after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        _invalidate_pending(session, session.info.pop(_PENDING_KEY, None))
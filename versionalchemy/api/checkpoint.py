@@ -0,0 +1,52 @@
+from __future__ import absolute_import
+
+from datetime import datetime
+
+import sqlalchemy as sa
+
+from versionalchemy.api.data import _get_time_slice
+
+
+def build_checkpoint(va_table, session, t=None):
+    '''
+    :param va_table: the model class which inherits from \
+        :class:`~versionalchemy.models.user_table.VAModelMixin` and was registered with a \
+        checkpoint table
+    :param session: a sqlalchemy session with connections to the database
+    :param t: the time of the checkpoint; if None or unspecified, defaults to now. This must \
+        be later than the latest checkpoint of the table.
+
+    Stores the va_id of the latest version of every row at t in the checkpoint table, with a
+    single ``INSERT ... SELECT``. The checkpoint is built from the previous checkpoint and the
+    versions written since, so only those versions are scanned.
+
+    Versions are timestamped when they are flushed, not when they are committed, so t should be
+    far enough in the past that no transaction which flushed versions before t is still open,
+    e.g. the start of the previous day.
+
+    :return: the number of rows in the checkpoint
+    :rtype: int
+    '''
+    cp = va_table.CheckpointTable
+    if cp is None:
+        raise ValueError('{} has no checkpoint table'.format(va_table.__name__))
+    if t is None:
+        t = datetime.now()
+    later = session.execute(
+        sa.select([sa.func.max(cp.va_checkpoint_at)]).where(cp.va_checkpoint_at >= t)
+    ).scalar()
+    if later is not None:
+        raise ValueError('t must be later than the latest checkpoint at {}'.format(later))
+
+    at = va_table.ArchiveTable
+    col_names = list(at._version_col_names)
+    time_slice = _get_time_slice(va_table, session, t, None, True)
+    result = session.execute(sa.insert(cp.__table__).from_select(
+        [getattr(cp, col_name).property.columns[0].name for col_name in col_names] +
+        ['va_id', 'va_checkpoint_at'],
+        time_slice.with_only_columns(
+            [getattr(at, col_name) for col_name in col_names] +
+            [at.va_id, sa.literal(t, type_=sa.DateTime)]
+        ),
+    ))
+    return result.rowcount
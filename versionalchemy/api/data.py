@@ -1,9 +1,17 @@
 from __future__ import absolute_import
 
+import base64
+import binascii
+import heapq
+from multiprocessing.pool import ThreadPool
+
 import six
 import sqlalchemy as sa
+from six.moves import range, zip
+from sqlalchemy.dialects import postgresql
 
 from versionalchemy import utils
+from versionalchemy.api import cache as read_cache
 
 
 def delete(va_table, session, conds):
@@ -18,9 +26,16 @@ def delete(va_table, session, conds):
         in this dictionary must be exactly the unique columns that versioning pivots around.
 
     Performs a hard delete on a row, which means the row is deleted from the versionalchemy \
-    table as well as the archive table.
+    table as well as the archive table (and checkpoint table).
     '''
     with session.begin_nested():
+        if va_table.CheckpointTable is not None:
+            checkpoint_conds_list = _get_conditions_list(
+                va_table, conds, table=va_table.CheckpointTable
+            )
+            session.execute(sa.delete(
+                va_table.CheckpointTable, whereclause=_get_conditions(checkpoint_conds_list)
+            ))
         archive_conds_list = _get_conditions_list(va_table, conds)
         session.execute(
             sa.delete(va_table.ArchiveTable, whereclause=_get_conditions(archive_conds_list))
@@ -29,6 +44,19 @@ def delete(va_table, session, conds):
         session.execute(
             sa.delete(va_table, whereclause=_get_conditions(conds_list))
         )
+    read_cache.invalidate(va_table.ArchiveTable, _get_row_keys(va_table, conds), session=session)
+
+
+class Page(list):
+    '''
+    A list of the records returned by :func:`get` with the cursor of the next page.
+
+    :ivar cursor: an opaque string which can be passed as the ``cursor`` argument of :func:`get` \
+        to fetch the page after this one, or None if this is the last page.
+    '''
+    def __init__(self, records=(), cursor=None):
+        super(Page, self).__init__(records)
+        self.cursor = cursor
 
 
 def get(
@@ -42,6 +70,8 @@ def get(
     include_deleted=True,
     page=1,
     page_size=100,
+    cursor=None,
+    cache=None,
 ):
     '''
     :param va_table: the model class which inherits from \
@@ -69,38 +99,341 @@ def get(
         the result set will contain results 100 - 199
     :param page_size: upper bound on number of results to display. Note the actual returned result \
         set may be smaller than this due to the roll up.
+    :param cursor: the ``cursor`` of a :class:`Page` previously returned by this function with \
+        the same arguments. If specified, returns the page after that one; unlike ``page``, this \
+        seeks to the start of the page instead of scanning all of the rows before it. It cannot \
+        be combined with ``page``.
+    :param cache: if specified, a :class:`~versionalchemy.api.cache.ReadCache` which the result \
+        is looked up in and stored in, unless the transaction of session archived rows of the \
+        table which are not committed yet.
+
+    :return: the records of the page
+    :rtype: :class:`Page`
     '''
+    if cache is not None and not read_cache.has_pending_writes(session, va_table.ArchiveTable):
+        kwargs = dict(
+            va_id=va_id,
+            t1=t1,
+            t2=t2,
+            include_deleted=include_deleted,
+            page=page,
+            page_size=page_size,
+            cursor=cursor,
+        )
+        key = cache.make_key(va_table, conds, fields, **kwargs)
+        result = cache.get(key)
+        if result is None:
+            historical = va_id is None and cache.is_historical(t1, t2)
+            result = get(va_table, session, fields=fields, conds=conds, **kwargs)
+            cache.set(key, va_table, _get_row_keys(va_table, conds), result, historical=historical)
+        return result
+
+    if cursor is not None and page != 1:
+        raise ValueError('page cannot be specified with cursor')
     limit, offset = _get_limit_and_offset(page, page_size)
-    version_col_names = va_table.va_version_columns
+    at = va_table.ArchiveTable
+    dialect = utils.get_dialect(session)
+    fields_column = None
     if fields is None:
         fields = [name for name in utils.get_column_names(va_table) if name != 'va_id']
+    else:
+        fields_column = _get_fields_column(at, dialect, fields)
+
+    query = _get_query(va_table, session, va_id, t1, t2, conds, include_deleted)
+    if fields_column is not None:
+        query = _select_fields_column(query, at, fields_column)
+    if cursor is not None:
+        query = query.where(_get_cursor_clause(at, cursor))
+    query = query.order_by(*_get_order_clause(at)).limit(limit)
+    if offset:
+        query = query.offset(offset)
+    rows = utils.result_to_dict(session.execute(query))
+    next_cursor = _make_cursor(at, rows[-1]) if rows and len(rows) == limit else None
+    if fields_column is not None:
+        rows = _unpack_fields(rows, fields)
+    rows = _expand_deltas(at, session, rows)
+    return Page(_format_response(rows, fields, va_table.va_version_columns), next_cursor)
+
+
+def _get_row_keys(va_table, conds):
+    '''
+    Returns the tuples of version column values of the rows matched by conds, or None if conds
+    match every row.
+    '''
+    if not conds:
+        return None
+    return [tuple(cond[col_name] for col_name in va_table.va_version_columns) for cond in conds]
 
-    if va_id is not None:
-        return _format_response(utils.result_to_dict(session.execute(
-            sa.select([va_table.ArchiveTable])
-            .where(va_table.ArchiveTable.va_id > va_id)
-            .order_by(*_get_order_clause(va_table.ArchiveTable))
-            .limit(page_size)
-            .offset(offset)
-        )), fields, version_col_names)
 
+def _get_query(va_table, session, va_id, t1, t2, conds, include_deleted):
+    '''
+    Returns the unordered select of the archive rows matched by the arguments of :func:`get`.
+    '''
+    if va_id is not None:
+        return sa.select([va_table.ArchiveTable]).where(va_table.ArchiveTable.va_id > va_id)
     if t1 is None and t2 is None:
-        rows = _get_latest_time_slice(va_table, session, conds, include_deleted, limit, offset)
-        return _format_response(rows, fields, version_col_names)
-
+        return _get_latest_time_slice(va_table, conds, include_deleted)
     if t2 is None:  # return a historical time slice
-        rows = _get_historical_time_slice(
-            va_table, session, t1, conds, include_deleted, limit, offset
-        )
-        return _format_response(rows, fields, version_col_names)
-
+        return _get_time_slice(va_table, session, t1, conds, include_deleted)
     if t1 is None:
         t1 = 0
+    return _get_historical_changes(va_table, conds, t1, t2, include_deleted)
 
-    rows = _get_historical_changes(
-        va_table, session, conds, t1, t2, include_deleted, limit, offset
+
+def iter_history(
+    va_table,
+    session,
+    va_id=None,
+    t1=None,
+    t2=None,
+    fields=None,
+    conds=None,
+    include_deleted=True,
+    batch_size=1000,
+):
+    '''
+    :param va_table: the model class which inherits from \
+        :class:`~versionalchemy.models.user_table.VAModelMixin` and specifies the model of \
+        the user table from which we are querying
+    :param session: a sqlalchemy session with connections to the database
+    :param va_id: see :func:`get`
+    :param t1: see :func:`get`
+    :param t2: see :func:`get`
+    :param fields: see :func:`get`
+    :param conds: see :func:`get`
+    :param include_deleted: see :func:`get`
+    :param batch_size: the number of archive rows fetched from the database at a time
+
+    Like :func:`get`, but returns an iterator over all of the records instead of a page. Rows are
+    read with a server side cursor (``stream_results``) ``batch_size`` at a time and formatted as
+    they are read, so memory use does not grow with the size of the result. For archive tables
+    which store deltas, each batch is read with a separate keyset query instead, since the
+    connection is needed to fetch the keyframes of deltas while iterating.
+
+    :return: an iterator of records in the format returned by :func:`get`
+    '''
+    if batch_size < 1:
+        raise ValueError('batch_size must be >= 1')
+    at = va_table.ArchiveTable
+    dialect = utils.get_dialect(session)
+    fields_column = None
+    if fields is None:
+        fields = [name for name in utils.get_column_names(va_table) if name != 'va_id']
+    else:
+        fields_column = _get_fields_column(at, dialect, fields)
+
+    query = _get_query(va_table, session, va_id, t1, t2, conds, include_deleted)
+    if fields_column is not None:
+        query = _select_fields_column(query, at, fields_column)
+    query = query.order_by(*_get_order_clause(at))
+    if at._va_deltas:
+        batches = _iter_keyset_batches(at, session, query, batch_size)
+    else:
+        batches = _iter_streamed_batches(session, query, batch_size)
+    if fields_column is not None:
+        batches = (_unpack_fields(rows, fields) for rows in batches)
+    return _iter_format_response(
+        _iter_expanded_rows(at, session, batches), fields, va_table.va_version_columns
     )
-    return _format_response(rows, fields, version_col_names)
+
+
+def get_many(
+    va_table,
+    session_factory,
+    keys,
+    t1=None,
+    t2=None,
+    fields=None,
+    include_deleted=True,
+    chunk_size=None,
+    max_workers=4,
+):
+    '''
+    :param va_table: the model class which inherits from \
+        :class:`~versionalchemy.models.user_table.VAModelMixin` and specifies the model of \
+        the user table from which we are querying
+    :param session_factory: a callable returning a new session, e.g. a \
+        :class:`~sqlalchemy.orm.session.sessionmaker`; each chunk is read with its own session
+    :param keys: a list of dictionaries of the values of the version columns of rows, as in the \
+        ``conds`` argument of :func:`get`
+    :param t1: see :func:`get`
+    :param t2: see :func:`get`
+    :param fields: see :func:`get`
+    :param include_deleted: see :func:`get`
+    :param chunk_size: the number of keys read by each query; defaults to a quarter of what fits \
+        in :data:`~versionalchemy.utils.MAX_BIND_PARAMS`, since time slices repeat the conditions
+    :param max_workers: the number of chunks which are read concurrently, each on a connection of \
+        its own from the engine's pool
+
+    Like :func:`iter_history` with ``conds=keys``, but splits keys into chunks which are read
+    concurrently on a pool of threads, instead of matching all keys with one large condition.
+    The records of a key are all read by the same chunk, so they are rolled up as by :func:`get`,
+    and the records of all chunks are merged in the order of :func:`get`, i.e. by the values of
+    the version columns as compared in Python, and version.
+
+    :return: all of the records of the keys
+    :rtype: list
+    '''
+    if max_workers < 1:
+        raise ValueError('max_workers must be >= 1')
+    at = va_table.ArchiveTable
+    if chunk_size is None:
+        chunk_size = max(1, utils.max_conditions(len(at._version_col_names)) // 4)
+    elif chunk_size < 1:
+        raise ValueError('chunk_size must be >= 1')
+    unique_keys = []
+    seen = set()
+    for key in keys:
+        hashable = tuple(sorted(six.iteritems(key)))
+        if hashable not in seen:
+            seen.add(hashable)
+            unique_keys.append(key)
+    chunks = [unique_keys[i:i + chunk_size] for i in range(0, len(unique_keys), chunk_size)]
+    if not chunks:
+        return []
+
+    def read_chunk(chunk):
+        session = session_factory()
+        try:
+            return list(iter_history(
+                va_table,
+                session,
+                t1=t1,
+                t2=t2,
+                fields=fields,
+                conds=chunk,
+                include_deleted=include_deleted,
+            ))
+        finally:
+            session.close()
+
+    pool = ThreadPool(min(max_workers, len(chunks)))
+    try:
+        results = pool.map(read_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Records are decorated with their position so that equal sort keys never compare them
+    col_names = _get_order_col_names(at)
+    decorated = [
+        [
+            (tuple(record[col_name] for col_name in col_names), i, j, record)
+            for j, record in enumerate(records)
+        ]
+        for i, records in enumerate(results)
+    ]
+    return [record for _, _, _, record in heapq.merge(*decorated)]
+
+
+def _iter_streamed_batches(session, query, batch_size):
+    '''
+    Yields lists of at most batch_size rows of query, read with a server side cursor.
+    '''
+    result = session.execute(query.execution_options(stream_results=True))
+    try:
+        keys = result.keys()
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [dict(zip(keys, row)) for row in rows]
+    finally:
+        result.close()
+
+
+def _iter_keyset_batches(archive_table, session, query, batch_size):
+    '''
+    Yields lists of at most batch_size rows of query, each read with a separate query which seeks
+    past the last row of the previous batch.
+    '''
+    batch_query = query
+    while True:
+        rows = utils.result_to_dict(session.execute(batch_query.limit(batch_size)))
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        batch_query = query.where(_get_keyset_clause(archive_table, rows[-1]))
+
+
+def _iter_expanded_rows(archive_table, session, batches):
+    '''
+    Yields the rows of batches, which are not empty, with deltas expanded, see
+    :func:`_expand_deltas`.
+    '''
+    previous = None
+    for rows in batches:
+        rows = _expand_deltas(archive_table, session, rows, previous=previous)
+        for row in rows:
+            yield row
+        previous = rows[-1]
+
+
+def _get_fields_column(archive_table, dialect, fields):
+    '''
+    :param archive_table: the model class of the archive table
+    :param dialect: the :py:class:`~sqlalchemy.engine.interfaces.Dialect` of the session
+    :param fields: a list of the fields requested from va_data
+
+    Returns a column which extracts fields from va_data into a JSON array with the JSON functions
+    of the database, so that only the requested fields are sent and parsed instead of the whole
+    blob. Returns None if the database has no JSON functions or va_data is not stored as plain
+    JSON (e.g. compressed or delta encoded), or a field cannot be written in the JSON paths of the
+    database, in which case the fields are picked from the parsed va_data.
+    '''
+    if (
+        not fields or
+        type(archive_table.va_data.type) is not utils.JSONEncodedDict or
+        archive_table._va_deltas
+    ):
+        return None
+    va_data = archive_table.va_data
+    version = dialect.server_version_info or ()
+    # SQLite has no escape for quotes in the keys of paths, so they are only used when no field
+    # needs one
+    paths = ['$."{}"'.format(field) for field in fields]
+    plain = not any('"' in field or '\\' in field for field in fields)
+    if dialect.name == 'sqlite' and version >= (3, 38) and plain:
+        # JSON functions are only built in from 3.38. With a single path, json_extract returns
+        # the SQL value instead of an array, so the path is repeated.
+        return sa.func.json_extract(va_data, *(paths if len(paths) > 1 else paths * 2))
+    if (
+        dialect.name == 'mysql' and
+        not getattr(dialect, '_is_mariadb', False) and
+        version >= (5, 7, 8) and
+        plain
+    ):
+        # JSON_EXTRACT with several paths leaves out missing fields, so they are extracted one by
+        # one into an array
+        return sa.func.json_array(*[sa.func.json_extract(va_data, path) for path in paths])
+    if dialect.name == 'postgresql' and version >= (9, 5):
+        data = sa.cast(va_data, postgresql.JSONB)
+        return sa.cast(sa.func.jsonb_build_array(*[data[field] for field in fields]), sa.Text)
+    return None
+
+
+def _select_fields_column(query, archive_table, fields_column):
+    '''
+    Returns query with the va_data column replaced by fields_column.
+    '''
+    return query.with_only_columns([
+        fields_column.label('va_data') if col.key == 'va_data' else col
+        for col in archive_table.__table__.columns
+    ])
+
+
+def _unpack_fields(rows, fields):
+    '''
+    Replaces the JSON arrays selected by the column of :func:`_get_fields_column` in rows with
+    dictionaries of fields to values.
+    '''
+    for row in rows:
+        values = row['va_data']
+        if isinstance(values, (six.binary_type, six.text_type)):
+            values = utils.json_loads(values)
+        row['va_data'] = dict(zip(fields, values))
+    return rows
 
 
 def _format_response(rows, fields, unique_col_names):
@@ -125,26 +458,127 @@ def _format_response(rows, fields, unique_col_names):
     Note that some versions may be omitted in the output for the same key if the specified fields
     were not changed between versions.
     '''
-    output = []
+    return list(_iter_format_response(rows, fields, unique_col_names))
+
+
+def _iter_format_response(rows, fields, unique_col_names):
+    '''
+    A generator version of :func:`_format_response`, which only keeps the last record in memory.
+    '''
+    last = None
     old_id = None
     for row in rows:
         id_ = {k: row[k] for k in unique_col_names}
-        formatted = {k: row[k] for k in row if k != 'va_data'}
-        if id_ != old_id:  # new unique versioned row
-            data = row['va_data']
-            formatted['va_data'] = {k: data.get(k) for k in fields}
-            output.append(formatted)
-        else:
-            data = row['va_data']
-            pruned_data = {k: data.get(k) for k in fields}
-            if (
-                pruned_data != output[-1]['va_data'] or
-                row['va_deleted'] != output[-1]['va_deleted']
-            ):
-                formatted['va_data'] = pruned_data
-                output.append(formatted)
+        data = row['va_data']
+        pruned_data = {k: data.get(k) for k in fields}
+        # new unique versioned row, or the fields changed since the last record of this row
+        if id_ != old_id or (pruned_data, row['va_deleted']) != last:
+            last = (pruned_data, row['va_deleted'])
+            formatted = {k: row[k] for k in row if k != 'va_data'}
+            formatted['va_data'] = dict(pruned_data)
+            yield formatted
         old_id = id_
-    return output
+
+
+def _expand_deltas(archive_table, session, rows, previous=None):
+    '''
+    :param archive_table: the model class of the archive table
+    :param session: a sqlalchemy session with connections to the database
+    :param rows: a list of dictionaries representing rows from the ArchiveTable, ordered as by \
+        _get_order_clause
+    :param previous: if specified, the expanded row directly before rows, when rows are read in \
+        batches
+
+    Replaces the va_data of rows that were stored as deltas with the full row. A delta that
+    directly follows the previous version of its key in rows is applied to that version; for
+    any other delta, the versions of its key since the last keyframe are fetched, with one query
+    per :func:`~versionalchemy.utils.max_conditions` keys.
+    '''
+    if not archive_table._va_deltas:
+        return rows
+    col_names = list(archive_table._version_col_names)
+    full = {}
+    prev = None
+    if previous is not None:
+        prev = (tuple(previous[col_name] for col_name in col_names), previous['va_version'])
+        full[prev] = previous['va_data']
+
+    # Find the deltas whose previous version is not in rows
+    missing = {}
+    for row in rows:
+        key = tuple(row[col_name] for col_name in col_names)
+        if row['va_delta'] and prev != (key, row['va_version'] - 1):
+            lowest, highest = missing.get(key, (row['va_version'], row['va_version']))
+            missing[key] = (min(lowest, row['va_version']), max(highest, row['va_version']))
+        prev = (key, row['va_version'])
+
+    for key, row in _get_delta_bases(archive_table, session, missing):
+        full[key, row['va_version']] = _apply_delta(full, key, row)
+
+    expanded = []
+    for row in rows:
+        key = tuple(row[col_name] for col_name in col_names)
+        if row['va_delta']:
+            row = dict(row, va_data=_apply_delta(full, key, row))
+        full[key, row['va_version']] = row['va_data']
+        expanded.append(row)
+    return expanded
+
+
+def _apply_delta(full, key, row):
+    '''
+    :param full: a dict mapping (key, version) to the full va_data of that version
+    :param key: a tuple of the version column values of row
+    :param row: a dictionary representing a row from the ArchiveTable
+
+    :return: the full va_data of row
+    :rtype: dict
+    '''
+    if not row['va_delta']:
+        return row['va_data']
+    data = dict(full.get((key, row['va_version'] - 1), {}))
+    data.update(row['va_data'])
+    return data
+
+
+def _get_delta_bases(archive_table, session, missing):
+    '''
+    :param archive_table: the model class of the archive table
+    :param session: a sqlalchemy session with connections to the database
+    :param missing: a dict mapping tuples of version column values to the lowest and highest \
+        version of that key whose previous version is needed
+
+    :return: a generator of (key, row) tuples of the versions of each key from the last keyframe \
+    before its lowest version up to its highest version (exclusive), in ascending version order
+    '''
+    col_names = list(archive_table._version_col_names)
+    at2 = archive_table.__table__.alias('at2')
+    for chunk in utils.chunks(list(missing), utils.max_conditions(2 * len(col_names) + 3)):
+        conditions = []
+        for key in chunk:
+            lowest, highest = missing[key]
+            key_cols = list(zip(col_names, key))
+            keyframe = (
+                sa.select([sa.func.max(at2.c.va_version)])
+                .where(sa.and_(
+                    at2.c.va_delta.is_(False),
+                    at2.c.va_version < lowest,
+                    *[getattr(at2.c, col_name) == value for col_name, value in key_cols]
+                ))
+                .as_scalar()
+            )
+            conditions.append(sa.and_(
+                archive_table.va_version >= keyframe,
+                archive_table.va_version < highest,
+                *[getattr(archive_table, col_name) == value for col_name, value in key_cols]
+            ))
+        result = session.execute(
+            sa.select([archive_table])
+            .where(sa.or_(*conditions))
+            .order_by(*_get_order_clause(archive_table))
+        )
+        for row in utils.result_to_dict(result):
+            yield tuple(row[col_name] for col_name in col_names), row
 
 
 def _get_conditions(pk_conds, and_conds=None):
@@ -167,7 +601,7 @@ def _get_conditions(pk_conds, and_conds=None):
     return sa.and_(condition1, condition2)
 
 
-def _get_conditions_list(va_table, conds, archive=True):
+def _get_conditions_list(va_table, conds, archive=True, table=None):
     '''
     :param va_table: the user table model class which inherits from \
         versionalchemy.models.VAModelMixin
@@ -175,6 +609,8 @@ def _get_conditions_list(va_table, conds, archive=True):
         values are conditions to be placed on the column.
     :param archive: If true, the condition is with columns from the archive table. Else its from \
         the user table.
+    :param table: if specified, the conditions are with columns from this model instead, e.g. \
+        the checkpoint table.
 
     This function returns a list of list of == conditions on sqlalchemy columns given conds. \
     This should be treated as an or of ands.
@@ -188,7 +624,9 @@ def _get_conditions_list(va_table, conds, archive=True):
             raise ValueError('Conditions must specify all unique constraints.')
 
         conditions = []
-        t = va_table.ArchiveTable if archive else va_table
+        t = table
+        if t is None:
+            t = va_table.ArchiveTable if archive else va_table
 
         for col_name, value in six.iteritems(cond):
             if col_name not in va_table.va_version_columns:
@@ -200,57 +638,126 @@ def _get_conditions_list(va_table, conds, archive=True):
     return all_conditions
 
 
-def _get_historical_changes(va_table, session, conds, t1, t2, include_deleted, limit, offset):
+def _get_historical_changes(va_table, conds, t1, t2, include_deleted):
     pk_conditions = _get_conditions_list(va_table, conds)
     and_clause = _get_conditions(
         pk_conditions,
         [va_table.ArchiveTable.va_updated_at >= t1, va_table.ArchiveTable.va_updated_at < t2] +
-        [] if include_deleted else [va_table.ArchiveTable.va_deleted.is_(False)],
+        ([] if include_deleted else [va_table.ArchiveTable.va_deleted.is_(False)]),
     )
+    return sa.select([va_table.ArchiveTable]).where(and_clause)
 
-    return utils.result_to_dict(session.execute(
-        sa.select([va_table.ArchiveTable])
-        .where(and_clause)
-        .order_by(*_get_order_clause(va_table.ArchiveTable))
-        .limit(limit)
-        .offset(offset)
-    ))
 
+def _get_time_slice(va_table, session, t, conds, include_deleted):
+    '''
+    Returns the select of the historical time slice at t, with the strategy supported by the
+    database and the nearest checkpoint at or before t if the table has checkpoints.
+    '''
+    since = _get_checkpoint_time(va_table, session, t)
+    if _supports_window_functions(utils.get_dialect(session)):
+        return _get_historical_time_slice_ranked(va_table, t, conds, include_deleted, since)
+    return _get_historical_time_slice(va_table, t, conds, include_deleted, since)
 
-def _get_historical_time_slice(va_table, session, t, conds, include_deleted, limit, offset):
+
+def _get_historical_time_slice(va_table, t, conds, include_deleted, since=None):
     at = va_table.ArchiveTable
     vc = va_table.va_version_columns
     pk_conditions = _get_conditions_list(va_table, conds)
     and_clause = _get_conditions(
         pk_conditions,
         [at.va_updated_at <= t] +
-        [] if include_deleted else [va_table.ArchiveTable.va_deleted.is_(False)],
+        ([] if include_deleted else [va_table.ArchiveTable.va_deleted.is_(False)]) +
+        ([] if since is None else [at.va_id.in_(_get_checkpoint_candidates(
+            va_table, t, conds, since
+        ))]),
     )
     t2 = at.__table__.alias('t2')
-    return utils.result_to_dict(session.execute(
+    return (
         sa.select([at])
         .select_from(at.__table__.join(
             t2,
             sa.and_(
                 t2.c.va_updated_at <= t,
                 at.va_version < t2.c.va_version,
-                *[getattr(at, c) == getattr(t2.c, c) for c in vc]
+                # newer versions than the candidates were all written after the checkpoint
+                *([getattr(at, c) == getattr(t2.c, c) for c in vc] +
+                  ([] if since is None else [t2.c.va_updated_at > since]))
             ),
             isouter=True,
         ))
         .where(t2.c.va_version.is_(None) & and_clause)
-        .order_by(*_get_order_clause(at))
-        .limit(limit)
-        .offset(offset)
-    ))
+    )
+
+
+def _get_historical_time_slice_ranked(va_table, t, conds, include_deleted, since=None):
+    '''
+    Like :func:`_get_historical_time_slice`, but finds the latest version of each key at t by
+    numbering the versions of each key with the ``ROW_NUMBER()`` window function instead of the
+    anti-join, which is quadratic in the number of versions per key when it is not optimized.
+    '''
+    at = va_table.ArchiveTable
+    ranked = (
+        sa.select([
+            at.va_id,
+            sa.func.row_number().over(
+                partition_by=[getattr(at, c) for c in va_table.va_version_columns],
+                order_by=at.va_version.desc(),
+            ).label('va_row_number'),
+        ])
+        .where(_get_conditions(
+            _get_conditions_list(va_table, conds),
+            [at.va_updated_at <= t] +
+            ([] if since is None else [at.va_id.in_(_get_checkpoint_candidates(
+                va_table, t, conds, since
+            ))]),
+        ))
+        .alias('ranked')
+    )
+    return (
+        sa.select([at])
+        .select_from(at.__table__.join(ranked, at.va_id == ranked.c.va_id))
+        .where(sa.and_(
+            ranked.c.va_row_number == 1,
+            *([] if include_deleted else [at.va_deleted.is_(False)])
+        ))
+    )
+
+
+def _get_checkpoint_time(va_table, session, t):
+    '''
+    Returns the time of the latest checkpoint of va_table at or before t, or None if there is none.
+    '''
+    cp = va_table.CheckpointTable
+    if cp is None:
+        return None
+    return session.execute(
+        sa.select([sa.func.max(cp.va_checkpoint_at)]).where(cp.va_checkpoint_at <= t)
+    ).scalar()
 
 
-def _get_latest_time_slice(va_table, session, conds, include_deleted, limit, offset):
+def _get_checkpoint_candidates(va_table, t, conds, since):
+    '''
+    Returns the select of the va_ids of the versions which can be the latest version of a row at t:
+    the versions in the checkpoint at since, and the versions written between since and t.
+    '''
+    at = va_table.ArchiveTable
+    cp = va_table.CheckpointTable
+    return sa.union_all(
+        sa.select([cp.va_id]).where(_get_conditions(
+            _get_conditions_list(va_table, conds, table=cp), [cp.va_checkpoint_at == since]
+        )),
+        sa.select([at.va_id]).where(_get_conditions(
+            _get_conditions_list(va_table, conds), [at.va_updated_at > since, at.va_updated_at <= t]
+        )).correlate(None),
+    )
+
+
+def _get_latest_time_slice(va_table, conds, include_deleted):
     and_clause = _get_conditions(
         _get_conditions_list(va_table, conds, archive=False),
         [] if include_deleted else [va_table.ArchiveTable.va_deleted.is_(False)],
     )
-    result = session.execute(
+    return (
         sa.select([va_table.ArchiveTable]).select_from(
             va_table.ArchiveTable.__table__.join(
                 va_table,
@@ -258,11 +765,66 @@ def _get_latest_time_slice(va_table, session, conds, include_deleted, limit, off
             )
         )
         .where(and_clause)
-        .order_by(*_get_order_clause(va_table.ArchiveTable))
-        .limit(limit)
-        .offset(offset)
     )
-    return utils.result_to_dict(result)
+
+
+def _supports_window_functions(dialect):
+    '''
+    Returns whether the database of dialect supports window functions such as ``ROW_NUMBER()``.
+    '''
+    version = dialect.server_version_info or ()
+    if dialect.name == 'sqlite':
+        return version >= (3, 25)
+    if dialect.name == 'mysql':
+        return version >= ((10, 2) if getattr(dialect, '_is_mariadb', False) else (8, 0))
+    return dialect.name in ('postgresql', 'mssql', 'oracle')
+
+
+def _get_cursor_clause(archive_table, cursor):
+    '''
+    :param archive_table: the model class of the archive table
+    :param cursor: a cursor returned by :func:`_make_cursor`
+
+    Returns the condition that a row comes after the cursor, see :func:`_get_keyset_clause`.
+    '''
+    try:
+        values = utils.json_loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+        return _get_keyset_clause(archive_table, {
+            col_name: utils.load_json_value(getattr(archive_table, col_name), values[col_name])
+            for col_name in _get_order_col_names(archive_table)
+        })
+    except (TypeError, ValueError, KeyError, binascii.Error):
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+
+
+def _get_keyset_clause(archive_table, row):
+    '''
+    :param archive_table: the model class of the archive table
+    :param row: a dictionary with the values of the order columns of a row
+
+    Returns the condition that a row comes after row in the order of :func:`_get_order_clause`,
+    i.e. for order columns c1, ..., cn and values v1, ..., vn:
+        c1 > v1 or (c1 = v1 and c2 > v2) or ... or (c1 = v1 and ... and cn > vn)
+    '''
+    col_names = _get_order_col_names(archive_table)
+    values = [row[col_name] for col_name in col_names]
+    cols = [getattr(archive_table, col_name) for col_name in col_names]
+    return sa.or_(*[
+        sa.and_(*[col == value for col, value in zip(cols[:i], values[:i])] + [cols[i] > values[i]])
+        for i in range(len(cols))
+    ])
+
+
+def _make_cursor(archive_table, row):
+    '''
+    :param archive_table: the model class of the archive table
+    :param row: a dictionary representing the last row from the ArchiveTable of a page
+
+    :return: an opaque cursor of the position of row in the order of :func:`_get_order_clause`
+    :rtype: str
+    '''
+    values = {col_name: row[col_name] for col_name in _get_order_col_names(archive_table)}
+    return base64.urlsafe_b64encode(utils.json_dumps(values).encode('utf-8')).decode('ascii')
 
 
 def _get_limit_and_offset(page, page_size):
@@ -281,8 +843,12 @@ def _get_order_clause(archive_table):
     Returns an ascending order clause on the versioned unique constraint as well as the
     version column.
     '''
-    order_clause = [
-        sa.asc(getattr(archive_table, col_name)) for col_name in archive_table._version_col_names
-    ]
-    order_clause.append(sa.asc(archive_table.va_version))
-    return order_clause
+    return [sa.asc(getattr(archive_table, col_name))
+            for col_name in _get_order_col_names(archive_table)]
+
+
+def _get_order_col_names(archive_table):
+    '''
+    Returns the names of the columns of the order clause.
+    '''
+    return list(archive_table._version_col_names) + ['va_version']
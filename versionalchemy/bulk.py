@@ -0,0 +1,458 @@
+'''
+Versioned equivalents of the bulk operations of :class:`~sqlalchemy.orm.session.Session` and
+:class:`~sqlalchemy.orm.query.Query`, which write rows without the unit of work, so they are not
+archived by flushes::
+
+    bulk.bulk_insert_mappings(session, Example, [{'product_id': 1, 'value': 'a'}, ...])
+    bulk.bulk_update_mappings(session, Example, [{'id': 1, 'value': 'b'}, ...], user_id='loader')
+
+The user table rows are written with the bulk operations of the session and their archive rows
+are built from mappings. The latest versions of all keys are looked up with one grouped query,
+and the archive rows and the ``va_id`` of the user table rows are written with one executemany
+each. Rows are read from the user table once per call to fill in their other columns. Models
+registered with an outbox or triggers are archived by them instead.
+
+:func:`versioned_update` and :func:`versioned_delete` archive the rows matched by a query without
+loading them at all::
+
+    bulk.versioned_update(session.query(Example).filter(Example.value == 'a'), {'value': 'b'})
+'''
+from __future__ import absolute_import
+
+from datetime import datetime
+
+import six
+import sqlalchemy as sa
+
+import versionalchemy
+from versionalchemy import utils
+from versionalchemy.exceptions import LogTableCreationError
+
+
+def bulk_insert_mappings(session, Model, mappings, user_id=None):
+    '''
+    :param session: the session to insert the rows with, which is not committed
+    :param Model: a registered model which inherits from \
+        :class:`~versionalchemy.models.VAModelMixin`
+    :param mappings: a list of dicts of the values of the new rows keyed by attribute key, which \
+        include the version columns
+    :param user_id: the user_id of the archive rows
+
+    Inserts the rows with :meth:`~sqlalchemy.orm.session.Session.bulk_insert_mappings` and
+    archives them.
+    '''
+    _check_registered(session, Model)
+    mappings = [dict(mapping) for mapping in mappings]
+    if not mappings:
+        return
+    ArchiveTable = Model.ArchiveTable
+    col_names = list(ArchiveTable._version_col_names)
+    for mapping in mappings:
+        missing = [col_name for col_name in col_names if col_name not in mapping]
+        if missing:
+            raise ValueError('Mappings are missing the version columns {}'.format(missing))
+    keys = [_get_key(col_names, mapping) for mapping in mappings]
+    if Model.va_triggers:
+        session.bulk_insert_mappings(Model, mappings)
+        versionalchemy.api.cache.invalidate(ArchiveTable, set(keys), session=session)
+        return
+
+    versions = None
+    if Model.va_outbox is None:
+        # Versions are assigned first to fill in the version counter of the new rows
+        versions = _next_versions(session, ArchiveTable, keys)
+        if Model._va_version_counter:
+            for mapping, version in zip(mappings, versions):
+                mapping['va_version'] = version
+    session.bulk_insert_mappings(Model, mappings)
+    # The rows are read back for the columns which were filled in by the database
+    rows = _select_rows(session, Model, col_names, keys)
+    archived = _archive(session, Model, [(None, rows[key]) for key in keys], user_id, versions)
+    if archived is not None:
+        versionalchemy._backfill_va_ids(session, Model, [
+            dict(
+                ((versionalchemy._key_param(col_name), value)
+                 for col_name, value in zip(col_names, key)),
+                va_id=va_id,
+            )
+            for key, (va_id, _) in zip(keys, archived)
+        ])
+
+
+def bulk_update_mappings(session, Model, mappings, user_id=None):
+    '''
+    :param session: the session to update the rows with, which is not committed
+    :param Model: a registered model which inherits from \
+        :class:`~versionalchemy.models.VAModelMixin`
+    :param mappings: a list of dicts of the changed values of rows keyed by attribute key, which \
+        include the primary key of the rows
+    :param user_id: the user_id of the archive rows
+
+    Updates the rows with :meth:`~sqlalchemy.orm.session.Session.bulk_update_mappings` and
+    archives the ones which changed; as by a flush, a row whose version columns change is
+    archived as a deletion of its old key and a new row. Mappings of rows which do not exist or
+    do not change them are ignored.
+    '''
+    _check_registered(session, Model)
+    mapper = sa.inspect(Model)
+    pk_names = [mapper.get_property_by_column(col).key for col in mapper.primary_key]
+    mappings = list(mappings)
+    for mapping in mappings:
+        missing = [pk_name for pk_name in pk_names if pk_name not in mapping]
+        if missing:
+            raise ValueError('Mappings are missing the primary key columns {}'.format(missing))
+    rows = _select_rows(
+        session, Model, pk_names, [_get_key(pk_names, mapping) for mapping in mappings]
+    )
+    changes = []
+    for mapping in mappings:
+        old = rows.get(_get_key(pk_names, mapping))
+        if old is not None and dict(old, **mapping) != old:
+            changes.append((old, dict(old, **mapping), dict(mapping)))
+    if not changes:
+        return
+
+    mappings = [mapping for _, _, mapping in changes]
+    if Model.va_triggers:
+        col_names = Model.ArchiveTable._version_col_names
+        versionalchemy.api.cache.invalidate(Model.ArchiveTable, {
+            _get_key(col_names, row) for old, new, _ in changes for row in (old, new)
+        }, session=session)
+    else:
+        # The archive rows are written first so that the rows are updated with their va_ids
+        archived = _archive(session, Model, [(old, new) for old, new, _ in changes], user_id)
+        for mapping, (va_id, version) in zip(mappings, archived or ()):
+            mapping['va_id'] = va_id
+            if Model._va_version_counter:
+                mapping['va_version'] = version
+    session.bulk_update_mappings(Model, mappings)
+
+
+def bulk_save_objects(session, objects, user_id=None):
+    '''
+    :param session: the session to save the objects with, which is not committed
+    :param objects: instances of registered models; the ones without an identity are inserted \
+        and the others are updated with their changed attributes
+    :param user_id: the user_id of the archive rows
+
+    Saves the objects with :func:`bulk_insert_mappings` and :func:`bulk_update_mappings`, one
+    call per model. As with :meth:`~sqlalchemy.orm.session.Session.bulk_save_objects`, the
+    objects are not added to the session, and objects which were already in it are expired so
+    their changes are not flushed again.
+    '''
+    inserts = {}
+    updates = {}
+    for obj in objects:
+        state = sa.inspect(obj)
+        Model = type(obj)
+        if state.key is None:
+            mapping = {
+                key: state.dict[key] for key in _get_column_keys(Model) if key in state.dict
+            }
+            inserts.setdefault(Model, []).append(mapping)
+            continue
+        mapping = dict(zip(
+            [state.mapper.get_property_by_column(col).key for col in state.mapper.primary_key],
+            state.key[1],
+        ))
+        mapping.update(
+            (key, state.dict[key])
+            for key in _get_column_keys(Model)
+            if state.attrs[key].history.has_changes()
+        )
+        updates.setdefault(Model, []).append(mapping)
+        if state.session_id is not None:
+            state.session.expire(obj)
+
+    for Model, mappings in six.iteritems(inserts):
+        bulk_insert_mappings(session, Model, mappings, user_id=user_id)
+    for Model, mappings in six.iteritems(updates):
+        bulk_update_mappings(session, Model, mappings, user_id=user_id)
+
+
+def versioned_update(query, values, user_id=None, synchronize_session='fetch'):
+    '''
+    :param query: a :class:`~sqlalchemy.orm.query.Query` of a registered model, e.g. \
+        ``session.query(Example).filter(Example.value == 'a')``
+    :param values: the values to set, as for :meth:`~sqlalchemy.orm.query.Query.update`; they \
+        may be SQL expressions of the columns, e.g. ``{Example.count: Example.count + 1}``
+    :param user_id: the user_id of the archive rows
+    :param synchronize_session: how to update the objects in the session, see \
+        :meth:`~sqlalchemy.orm.query.Query.update`; ``'evaluate'`` is not supported
+
+    Runs :meth:`~sqlalchemy.orm.query.Query.update` and archives the rows which change without
+    loading them, with an ``INSERT INTO ... SELECT`` from the user table which builds ``va_data``
+    with the JSON functions of the database (SQLite, PostgreSQL and MySQL are supported), so
+    ``va_data`` must be stored with :class:`~versionalchemy.utils.JSONEncodedDict`. The ``va_id``
+    of the rows is updated by the same ``UPDATE``.
+
+    :return: the number of rows matched by the query
+    :rtype: int
+    '''
+    Model = _get_query_model(query)
+    session = query.session
+    values = _get_update_values(Model, values)
+    if not Model.va_triggers:
+        at = Model.ArchiveTable
+        old = {key: getattr(Model, key) for key in _get_column_keys(Model)}
+        new = dict(old, **values)
+        if any(col_name in values for col_name in at._version_col_names):
+            # Rows whose version columns change are archived as deleted under their old key
+            key_changed = sa.or_(*(
+                old[col_name].is_distinct_from(new[col_name])
+                for col_name in at._version_col_names
+            ))
+            _archive_query(session, Model, old, True, [query.whereclause, key_changed], user_id)
+        changed = sa.or_(*(getattr(Model, key).is_distinct_from(value)
+                           for key, value in six.iteritems(values)))
+        _archive_query(session, Model, new, False, [query.whereclause, changed], user_id)
+
+        # The rows point at the latest archive rows of their new keys
+        latest = [('va_id', at.va_id)]
+        if Model._va_version_counter:
+            latest.append(('va_version', at.va_version))
+        for key, col in latest:
+            values[key] = sa.select([sa.func.max(col)]).where(
+                _match_key(at, new)
+            ).correlate(Model.__table__).as_scalar()
+    result = query.update(values, synchronize_session=synchronize_session)
+    versionalchemy.api.cache.invalidate(Model.ArchiveTable, None, session=session)
+    return result
+
+
+def versioned_delete(query, user_id=None, synchronize_session='evaluate'):
+    '''
+    :param query: a :class:`~sqlalchemy.orm.query.Query` of a registered model
+    :param user_id: the user_id of the archive rows
+    :param synchronize_session: how to update the objects in the session, see \
+        :meth:`~sqlalchemy.orm.query.Query.delete`
+
+    Runs :meth:`~sqlalchemy.orm.query.Query.delete` and archives the deletions of the rows
+    without loading them, as :func:`versioned_update`.
+
+    :return: the number of rows deleted
+    :rtype: int
+    '''
+    Model = _get_query_model(query)
+    if not Model.va_triggers:
+        row = {key: getattr(Model, key) for key in _get_column_keys(Model)}
+        _archive_query(query.session, Model, row, True, [query.whereclause], user_id)
+    result = query.delete(synchronize_session=synchronize_session)
+    versionalchemy.api.cache.invalidate(Model.ArchiveTable, None, session=query.session)
+    return result
+
+
+def _check_registered(session, Model):
+    if not hasattr(Model, 'ArchiveTable'):
+        raise LogTableCreationError('Need to register va tables!!')
+    Model._check_schema_lazily(session)
+
+
+def _get_column_keys(Model):
+    return [key for key, _ in utils.get_column_keys_and_names(Model)]
+
+
+def _get_key(col_names, mapping):
+    return tuple(mapping[col_name] for col_name in col_names)
+
+
+def _get_query_model(query):
+    descriptions = query.column_descriptions
+    Model = descriptions[0]['expr'] if len(descriptions) == 1 else None
+    if not isinstance(Model, type) or not issubclass(Model, versionalchemy.VAModelMixin):
+        raise ValueError('The query must select a single versioned model')
+    _check_registered(query.session, Model)
+    if Model.va_outbox is not None:
+        raise ValueError('Models registered with an outbox cannot be versioned by queries')
+    # Archive rows written by queries are built with the JSON functions of the database
+    if not Model.va_triggers and not isinstance(
+        Model.ArchiveTable.va_data.type, utils.JSONEncodedDict
+    ):
+        raise ValueError('Queries can only be versioned if va_data is stored as JSON text')
+    return Model
+
+
+def _get_update_values(Model, values):
+    '''
+    :return: a dict of values keyed by attribute key, where values which are not SQL \
+    expressions are bound with the type of their column
+    '''
+    result = {}
+    for key, value in six.iteritems(values):
+        if not isinstance(key, six.string_types):
+            key = key.key
+        col = getattr(Model, key).property.columns[0]
+        if not isinstance(value, sa.sql.ClauseElement):
+            value = sa.literal(value, type_=col.type)
+        result[key] = value
+    return result
+
+
+def _match_key(ArchiveTable, row):
+    return sa.and_(*(
+        getattr(ArchiveTable, col_name) == row[col_name]
+        for col_name in ArchiveTable._version_col_names
+    ))
+
+
+def _archive_query(session, Model, row, deleted, criteria, user_id):
+    '''
+    :param row: a dict of SQL expressions of the values of the archived rows keyed by attribute \
+        key, in terms of the columns of the user table
+    :param criteria: clauses which select the archived rows of the user table; None is ignored
+
+    Archives the rows with a single ``INSERT INTO ... SELECT`` from the user table.
+    '''
+    at = Model.ArchiveTable
+    dialect = utils.get_dialect(session)
+    next_version = sa.select([sa.func.coalesce(sa.func.max(at.va_version), -1) + 1]).where(
+        _match_key(at, row)
+    ).correlate(Model.__table__).as_scalar()
+    columns = [(getattr(at, col_name), row[col_name]) for col_name in at._version_col_names]
+    columns.extend([
+        (at.va_version, next_version),
+        (at.va_deleted, sa.literal(deleted, type_=sa.Boolean)),
+        (at.va_updated_at, sa.literal(datetime.now(), type_=sa.DateTime)),
+        (at.va_data, _json_object(dialect, [
+            (name, _json_value(dialect, Model, key, row[key]))
+            for key, name, _ in Model._serializer(dialect).fields
+        ])),
+    ])
+    if at._va_deltas:
+        columns.append((at.va_delta, sa.literal(False, type_=sa.Boolean)))
+    if user_id is not None:
+        columns.append((at.user_id, sa.literal(user_id, type_=at.user_id.type)))
+
+    select = sa.select([expr for _, expr in columns]).select_from(Model.__table__).where(
+        sa.and_(*[criterion for criterion in criteria if criterion is not None])
+    )
+    session.execute(sa.insert(at.__table__).from_select(
+        [col.property.columns[0] for col, _ in columns], select
+    ))
+
+
+def _json_value(dialect, Model, key, expr):
+    # Datetimes are formatted as flushes serialize them rather than as the database stores them
+    if utils.is_naive_datetime(getattr(Model, key).property.columns[0]):
+        return utils.json_datetime(dialect, expr)
+    return expr
+
+
+def _json_object(dialect, pairs):
+    '''
+    :param pairs: a list of ``(name, expression)`` tuples
+
+    :return: an expression of a JSON object of the values of the expressions keyed by name, as \
+    text
+    '''
+    def args(chunk, path=False):
+        return [
+            arg for name, expr in chunk
+            for arg in (sa.literal('$."{}"'.format(name) if path else name), expr)
+        ]
+    # Functions of SQLite and PostgreSQL take at most 127 and 100 arguments
+    chunks = list(utils.chunks(pairs, 50))
+    if dialect.name == 'sqlite':
+        result = sa.func.json_object(*args(chunks[0]))
+        for chunk in chunks[1:]:
+            result = sa.func.json_set(result, *args(chunk, path=True))
+        return result
+    if dialect.name == 'postgresql':
+        result = sa.func.jsonb_build_object(*args(chunks[0]))
+        for chunk in chunks[1:]:
+            result = result.op('||')(sa.func.jsonb_build_object(*args(chunk)))
+        return sa.cast(result, sa.Text)
+    if dialect.name == 'mysql':
+        return sa.func.json_object(*args(pairs))
+    raise NotImplementedError('Versioning queries is not supported for {}'.format(dialect.name))
+
+
+def _select_rows(session, Model, col_names, keys):
+    '''
+    :return: a dict mapping each of keys to the row of Model whose columns in col_names are equal \
+    to it, as a dict keyed by attribute key; keys which match no row are omitted
+    '''
+    col_keys = _get_column_keys(Model)
+    cols = [getattr(Model, key) for key in col_keys]
+    rows = {}
+    keys = list(set(keys))
+    for chunk in utils.chunks(keys, utils.max_conditions(len(col_names))):
+        result = session.execute(
+            sa.select(cols).where(utils.generate_in_clause(Model, col_names, chunk))
+        )
+        for values in result:
+            row = dict(zip(col_keys, values))
+            rows[_get_key(col_names, row)] = row
+    return rows
+
+
+def _next_versions(session, ArchiveTable, keys):
+    '''
+    :param keys: the keys of archive rows in the order they are written
+
+    :return: the version of each archive row, after the latest version of its key, with one \
+    grouped query
+    '''
+    latest_versions = ArchiveTable._latest_versions(session, set(keys))
+    versions = []
+    for key in keys:
+        version = latest_versions.get(key)
+        version = 0 if version is None else version + 1
+        latest_versions[key] = version
+        versions.append(version)
+    return versions
+
+
+def _archive(session, Model, changes, user_id, versions=None):
+    '''
+    :param changes: a list of ``(old, new)`` tuples of the rows before and after they were \
+        written, keyed by attribute key; old is None for inserted rows
+    :param versions: the versions of the archive rows, if they were already assigned
+
+    Writes the archive rows of changes, i.e. a deleted row for the old key of each row whose
+    version columns changed and a row for its new values, or puts them into the outbox of Model.
+
+    :return: the va_id and version of the archive row of each new row, or None if they were put \
+    into an outbox
+    :rtype: list
+    '''
+    ArchiveTable = Model.ArchiveTable
+    col_names = ArchiveTable._version_col_names
+    entries = []
+    for old, new in changes:
+        if old is not None and _get_key(col_names, old) != _get_key(col_names, new):
+            entries.append((old, True))
+        entries.append((new, False))
+    if versions is None and Model.va_outbox is None:
+        versions = _next_versions(
+            session, ArchiveTable, [_get_key(col_names, row) for row, _ in entries]
+        )
+
+    serializer = Model._serializer(utils.get_dialect(session))
+    now = datetime.now()
+    archive_rows = []
+    for i, (row, deleted) in enumerate(entries):
+        row_dict = {
+            'va_deleted': deleted,
+            'va_updated_at': now,
+            'va_data': serializer.mapping_to_dict(row),
+        }
+        row_dict.update((col_name, row[col_name]) for col_name in col_names)
+        if versions is not None:
+            row_dict['va_version'] = versions[i]
+        if ArchiveTable._va_deltas:
+            row_dict['va_delta'] = False
+        if user_id is not None:
+            row_dict['user_id'] = user_id
+        archive_rows.append((ArchiveTable, row_dict))
+
+    if Model.va_outbox is not None:
+        Model.va_outbox.put(session, [(Model, row_dict) for _, row_dict in archive_rows])
+        return None
+    va_ids = versionalchemy._insert_archive_rows(session, archive_rows)
+    versionalchemy._invalidate_caches(archive_rows, session=session)
+    return [
+        (va_id, version)
+        for va_id, version, (_, deleted) in zip(va_ids, versions, entries)
+        if not deleted
+    ]
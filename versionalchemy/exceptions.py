@@ -3,3 +3,11 @@ class LogTableCreationError(Exception):
     Thrown if an invariant is violated when registering a table for versioning with versionalchemy.
     """
     pass
+
+
+class MissingIndexWarning(UserWarning):
+    """
+    Warned if a table registered for versioning is missing an index which queries on the table
+    rely on.
+    """
+    pass
@@ -1,12 +1,22 @@
 from __future__ import absolute_import
 
+import os
+import threading
+import warnings
 from datetime import datetime
 
 import sqlalchemy as sa
-from sqlalchemy import Boolean, Column, DateTime, func, Integer
+from sqlalchemy import Boolean, Column, DateTime, func, Integer, String
 
 from versionalchemy import utils
-from versionalchemy.exceptions import LogTableCreationError
+from versionalchemy.exceptions import LogTableCreationError, MissingIndexWarning
+
+#: The ways :meth:`VAModelMixin.register` can validate the schema of the tables, see its docs
+VALIDATION_MODES = ('eager', 'lazy', 'skip')
+#: The environment variable which sets the default validation mode
+VALIDATION_ENV_VAR = 'VERSIONALCHEMY_VALIDATION'
+
+_validation_lock = threading.Lock()
 
 
 class VALogMixin(object):
@@ -16,6 +26,15 @@ class VALogMixin(object):
       - user_id - a column corresponding to the user that made the specified change
       - 1 or more columns which are a subset of columns in the user table. These columns
       must have a unique constraint on the user table and also be named the same in both tables
+
+    The ``va_data`` column stores rows as JSON text by default; it can be overridden with a more
+    compact type such as :class:`~versionalchemy.utils.MsgPackEncodedDict`.
+
+    A model may also store updates as deltas by setting ``va_keyframe_interval`` to an integer N
+    and adding a boolean ``va_delta`` column. An update then only stores the columns that changed
+    in ``va_data``, except every N-th version, which stores the full row as a keyframe (as do
+    inserts and deletes). :func:`versionalchemy.api.get` rebuilds full rows from the nearest
+    keyframe when reading.
     """
     va_id = Column(Integer, primary_key=True, autoincrement=True)
     va_version = Column(Integer, nullable=False, index=True)
@@ -23,13 +42,33 @@ class VALogMixin(object):
     va_updated_at = Column(DateTime, nullable=False)
     va_data = Column(utils.JSONEncodedDict, nullable=False)  # JSON blob
 
+    va_keyframe_interval = None
+
+    _va_deltas = False
+
     @classmethod
-    def build_row_dict(cls, ut_row, session, deleted=False, user_id=None, use_dirty=True):
+    def build_row_dict(
+        cls,
+        ut_row,
+        session,
+        deleted=False,
+        user_id=None,
+        use_dirty=True,
+        latest_versions=None,
+        delta=False,
+    ):
         """
         :param ut_row: the row from the user table
         :param deleted: whether or not the row is deleted
         :param user_id: the user that is performing the update on this row
         :param use_dirty: whether to use the dirty fields from ut_row or not
+        :param latest_versions: if specified, a dict mapping tuples of version column values to \
+            the latest version of that key, as returned by :meth:`_latest_versions`. It is used \
+            instead of querying the log table and is updated with the version of this row.
+        :param delta: whether this row may be stored as a delta of the previous version, i.e. \
+            only the columns changed in ut_row, and the columns written by its ``onupdate`` or \
+            ``server_onupdate`` defaults, are stored unless this version is a keyframe. It has no \
+            effect unless ``va_keyframe_interval`` is set.
 
         :return: a dictionary of key value pairs to be inserted into the archive table
         :rtype: dict
@@ -37,13 +76,29 @@ class VALogMixin(object):
         at_data = {
             'va_deleted': deleted,
             'va_updated_at': datetime.now(),
-            'va_data': ut_row._to_dict(utils.get_dialect(session), use_dirty=use_dirty),
         }
-        version = cls._latest_version(session, ut_row, use_dirty=use_dirty)
-        at_data['va_version'] = 0 if version is None else version + 1
         for col_name in cls._version_col_names:
             at_data[col_name] = utils.get_column_attribute(ut_row, col_name, use_dirty=use_dirty)
 
+        if latest_versions is None:
+            version = cls._latest_version(session, ut_row, use_dirty=use_dirty)
+        else:
+            key = tuple(at_data[col_name] for col_name in cls._version_col_names)
+            version = latest_versions.get(key)
+        at_data['va_version'] = 0 if version is None else version + 1
+        if latest_versions is not None:
+            latest_versions[key] = at_data['va_version']
+
+        changed_only = bool(
+            delta and cls.va_keyframe_interval and
+            at_data['va_version'] % cls.va_keyframe_interval
+        )
+        if cls._va_deltas:
+            at_data['va_delta'] = changed_only
+        at_data['va_data'] = ut_row._to_dict(
+            utils.get_dialect(session), use_dirty=use_dirty, changed_only=changed_only
+        )
+
         if user_id is not None:
             at_data['user_id'] = user_id
 
@@ -67,10 +122,37 @@ class VALogMixin(object):
         ).first()
         return None if result is None else result[0]
 
+    @classmethod
+    def _latest_versions(cls, session, keys):
+        """
+        :param session: a session instance to execute a select on the log table
+        :param keys: an iterable of tuples of version column values, in the order of \
+            ``cls._version_col_names``
+
+        :return: a dict mapping each key that has been inserted to its maximum version ID; keys \
+        that have no versions are omitted. This issues one ``GROUP BY`` query per \
+        :func:`~versionalchemy.utils.max_conditions` keys rather than one query per key.
+        :rtype: dict
+        """
+        col_names = list(cls._version_col_names)
+        cols = [getattr(cls, col_name) for col_name in col_names]
+        latest = {}
+        for chunk in utils.chunks(list(keys), utils.max_conditions(len(col_names))):
+            result = session.execute(
+                sa.select(cols + [func.max(cls.va_version)])
+                .where(utils.generate_in_clause(cls, col_names, chunk))
+                .group_by(*cols)
+            )
+            for row in result:
+                latest[tuple(row[:-1])] = row[-1]
+        return latest
+
     @classmethod
     def _validate(cls, engine, *version_cols):
         """
-        :param engine: instance of :class:`~sa.engine.Engine`
+        :param engine: instance of :class:`~sa.engine.Engine`, or an inspector returned by
+        :func:`~versionalchemy.utils.get_inspector`, or None to skip the checks which reflect the
+        table
         :param *version_cols: instances of :class:`~sa.orm.attributes.InstrumentedAttribute` from
         the user table corresponding to the columns that versioning pivots around
 
@@ -80,25 +162,9 @@ class VALogMixin(object):
             - a user_id column exists
             - there is a unique constraint on version and the other versioned columns from the
             user table
+            - a va_delta column exists if va_keyframe_interval is set
         """
-        cls._version_col_names = set()
-        for version_column_ut in version_cols:
-            # Make sure all version columns exist on this table
-            version_col_name = version_column_ut.key
-            version_column_at = getattr(cls, version_col_name, None)
-            if not isinstance(version_column_at, sa.orm.attributes.InstrumentedAttribute):
-                raise LogTableCreationError(
-                    "Log table needs {} column".format(version_col_name)
-                )
-
-            # Make sure the type of the user table and log table columns are the same
-            version_col_at_t = version_column_at.property.columns[0].type.python_type
-            version_col_ut_t = version_column_ut.property.columns[0].type.python_type
-            if version_col_at_t != version_col_ut_t:
-                raise LogTableCreationError(
-                    "Type of column {} must match in log and user table".format(version_col_name)
-                )
-            cls._version_col_names.add(version_col_name)
+        cls._version_col_names = _validate_version_columns(cls, 'Log table', version_cols)
 
         # Ensure user added a user_id column
         # TODO: should user_id column be optional?
@@ -108,31 +174,259 @@ class VALogMixin(object):
                 "Log table needs user_id column"
             )
 
-        # Check the unique constraint on the versioned columns
+        if engine is not None:
+            cls._check_constraints(engine)
+
+        # Deltas are flagged per row so they can still be read if the interval is unset later
+        cls._va_deltas = isinstance(
+            getattr(cls, 'va_delta', None), sa.orm.attributes.InstrumentedAttribute
+        )
+        if cls.va_keyframe_interval is not None:
+            if cls.va_keyframe_interval < 1:
+                raise LogTableCreationError("va_keyframe_interval must be a positive integer")
+            if not cls._va_deltas:
+                raise LogTableCreationError(
+                    "Log table needs va_delta column to store deltas"
+                )
+
+    @classmethod
+    def _check_constraints(cls, engine):
+        """
+        :param engine: instance of :class:`~sa.engine.Engine`, or an inspector returned by
+        :func:`~versionalchemy.utils.get_inspector`
+
+        Raises :class:`~LogTableCreationError` unless there is a unique constraint on version and
+        the other versioned columns.
+        """
         version_col_names = list(cls._version_col_names) + ['va_version']
         if not utils.has_constraint(cls.__tablename__, engine, *version_col_names):
             raise LogTableCreationError(
                 "There is no unique contraint on the version columns"
             )
 
+    @classmethod
+    def _check_indexes(cls, engine, create=False, inspector=None):
+        """
+        :param engine: instance of :class:`~sa.engine.Engine`
+        :param create: whether to create the missing indexes instead of warning about them
+        :param inspector: an optional inspector returned by
+        :func:`~versionalchemy.utils.get_inspector` to reflect the indexes with
+
+        Checks that the log table has the indexes which :func:`versionalchemy.api.get` relies on,
+        with the version columns in the order of ``_version_col_names``, which is also the order
+        of its results:
+            - the version columns and va_updated_at, for time slices and changes of given rows
+            - va_updated_at, for changes of all rows in a time range
+
+        If an index is missing, this function warns with :class:`~MissingIndexWarning` or creates
+        the index.
+        """
+        updated_at = cls.va_updated_at.property.columns[0]
+        version_cols = [
+            getattr(cls, col_name).property.columns[0] for col_name in cls._version_col_names
+        ]
+        for cols in (version_cols + [updated_at], [updated_at]):
+            col_names = [col.name for col in cols]
+            if utils.has_index(cls.__tablename__, inspector or engine, *col_names):
+                continue
+            if create:
+                name = 'ix_{}_{}'.format(cls.__tablename__, '_'.join(col_names))
+                sa.Index(name, *cols).create(engine)
+            else:
+                warnings.warn(
+                    'Log table {} has no index on ({}); pass create_indexes=True to register to '
+                    'create it'.format(cls.__tablename__, ', '.join(col_names)),
+                    MissingIndexWarning,
+                )
+
+
+class VACheckpointMixin(object):
+    """
+    A mixin providing the schema for an optional checkpoint table of a log table, which stores the
+    ``va_id`` of the latest version of every row at points in time. An inheriting model must
+    specify the version columns of the log table, with a unique constraint on them and
+    ``va_checkpoint_at``.
+
+    Checkpoints are built with :func:`versionalchemy.api.build_checkpoint`, e.g. daily. Historical
+    time slices then only scan the versions written after the nearest checkpoint.
+    """
+    va_checkpoint_id = Column(Integer, primary_key=True, autoincrement=True)
+    va_checkpoint_at = Column(DateTime, nullable=False, index=True)
+    va_id = Column(Integer, nullable=False)
+
+    @classmethod
+    def _validate(cls, engine, *version_cols):
+        """
+        :param engine: instance of :class:`~sa.engine.Engine`, or an inspector returned by
+        :func:`~versionalchemy.utils.get_inspector`, or None to skip the checks which reflect the
+        table
+        :param *version_cols: instances of :class:`~sa.orm.attributes.InstrumentedAttribute` from
+        the user table corresponding to the columns that versioning pivots around
+
+        If all of the properties are not met, this function raises :class:`~LogTableCreationError`:
+            - all version columns exist in the checkpoint table
+            - the python types of the user table and checkpoint table columns are the same
+            - there is a unique constraint on va_checkpoint_at and the versioned columns
+        """
+        cls._version_col_names = _validate_version_columns(cls, 'Checkpoint table', version_cols)
+        if engine is not None:
+            cls._check_constraints(engine)
+
+    @classmethod
+    def _check_constraints(cls, engine):
+        """
+        :param engine: instance of :class:`~sa.engine.Engine`, or an inspector returned by
+        :func:`~versionalchemy.utils.get_inspector`
+
+        Raises :class:`~LogTableCreationError` unless there is a unique constraint on
+        va_checkpoint_at and the versioned columns.
+        """
+        version_col_names = list(cls._version_col_names) + ['va_checkpoint_at']
+        if not utils.has_constraint(cls.__tablename__, engine, *version_col_names):
+            raise LogTableCreationError(
+                "There is no unique contraint on the version columns and va_checkpoint_at"
+            )
+
+
+class VAOutboxMixin(object):
+    """
+    A mixin providing the schema for the staging table of a
+    :class:`~versionalchemy.outbox.TableOutbox`, which holds the archive rows of models
+    registered with the outbox until they are drained into their log tables. ``va_table`` is
+    the name of the user table of a row and ``va_payload`` the row, without its version, as JSON.
+    """
+    va_outbox_id = Column(Integer, primary_key=True, autoincrement=True)
+    va_table = Column(String(255), nullable=False)
+    va_payload = Column(utils.JSONEncodedDict, nullable=False)
+
+
+def get_validation_mode(validate=None):
+    """
+    :param validate: one of :data:`VALIDATION_MODES`, or None for the default
+
+    :return: validate, or the mode set by the ``VERSIONALCHEMY_VALIDATION`` environment variable \
+    if it is None, which defaults to ``'eager'``
+    :rtype: str
+    """
+    if validate is None:
+        validate = os.environ.get(VALIDATION_ENV_VAR) or 'eager'
+    if validate not in VALIDATION_MODES:
+        raise ValueError('validate must be one of {}, not {!r}'.format(
+            ', '.join(VALIDATION_MODES), validate
+        ))
+    return validate
+
+
+def _validate_version_columns(cls, table_desc, version_cols):
+    """
+    :param cls: the model of the log or checkpoint table
+    :param table_desc: a description of the table for error messages
+    :param version_cols: instances of :class:`~sa.orm.attributes.InstrumentedAttribute` from the \
+        user table corresponding to the columns that versioning pivots around
+
+    Raises :class:`~LogTableCreationError` unless all version columns exist in cls with the same
+    python types as in the user table.
+
+    :return: the names of the version columns
+    :rtype: list
+    """
+    version_col_names = []
+    for version_column_ut in version_cols:
+        # Make sure all version columns exist on this table
+        version_col_name = version_column_ut.key
+        version_column_at = getattr(cls, version_col_name, None)
+        if not isinstance(version_column_at, sa.orm.attributes.InstrumentedAttribute):
+            raise LogTableCreationError(
+                "{} needs {} column".format(table_desc, version_col_name)
+            )
+
+        # Make sure the type of the user table and log table columns are the same
+        version_col_at_t = version_column_at.property.columns[0].type.python_type
+        version_col_ut_t = version_column_ut.property.columns[0].type.python_type
+        if version_col_at_t != version_col_ut_t:
+            raise LogTableCreationError(
+                "Type of column {} must match in {} and user table".format(
+                    version_col_name, table_desc.lower()
+                )
+            )
+        if version_col_name not in version_col_names:
+            version_col_names.append(version_col_name)
+    return version_col_names
+
 
 class VAModelMixin(object):
+    """
+    A mixin for the user table, the table whose rows are versioned. An inheriting model must set
+    ``va_version_columns`` to the names of 1 or more columns with a unique constraint on them.
+
+    A model may also opt in to a version counter by adding an integer ``va_version`` column. It is
+    kept equal to the latest version of the row, so the next version can be computed from the row
+    in memory instead of querying the archive table. Concurrent writers to the same row then fail
+    on the archive table's unique constraint rather than reading the latest version. Rows that
+    existed before the column was added can be filled in with :meth:`populate_version_counter`.
+    """
     va_id = Column(Integer, nullable=False, default=0)
 
     va_ignore_columns = None
     va_version_columns = None
 
+    CheckpointTable = None
+    va_outbox = None
+    va_triggers = False
+
+    _va_version_counter = False
+    _va_validation_pending = False
+
     def updated_by(self, user):
         self._updated_by = user
 
     @classmethod
-    def register(cls, ArchiveTable, engine):
+    def register(
+        cls,
+        ArchiveTable,
+        engine,
+        create_indexes=False,
+        CheckpointTable=None,
+        inspector=None,
+        validate=None,
+        outbox=None,
+        triggers=False,
+    ):
         """
         :param ArchiveTable: the model for the users archive table
         :param engine: the database engine
         :param version_col_names: strings which correspond to columns that versioning will pivot \
             around. These columns must have a unique constraint set on them.
+        :param create_indexes: whether to create the indexes of the archive table that queries \
+            rely on if they are missing, instead of warning about them
+        :param CheckpointTable: an optional model for the checkpoint table of the archive table, \
+            which inherits from :class:`VACheckpointMixin`
+        :param inspector: an optional inspector returned by \
+            :func:`~versionalchemy.utils.get_inspector` to reflect the tables with, which can be \
+            shared between models; see :func:`versionalchemy.register_all`
+        :param validate: when to run the checks which reflect the tables, i.e. their constraints \
+            and indexes; the checks of the models themselves are always run. One of:
+
+            - ``'eager'``: when registering (the default)
+            - ``'lazy'``: at the first flush which versions a row of this model, so processes \
+              which only write to a few models only reflect their tables
+            - ``'skip'``: never, e.g. in production when the schema is validated by CI
+
+            If None or unspecified, defaults to the ``VERSIONALCHEMY_VALIDATION`` environment \
+            variable, or ``'eager'`` if it is not set.
+        :param outbox: an optional :class:`~versionalchemy.outbox.QueueOutbox` or \
+            :class:`~versionalchemy.outbox.TableOutbox`. If specified, flushes put the archive \
+            rows of this model into the outbox instead of writing them to the log table, and \
+            their versions are assigned when the outbox is drained, see \
+            :mod:`versionalchemy.outbox`. This cannot be used with a ``va_version`` column or \
+            ``va_keyframe_interval``, which need the version when the row is flushed.
+        :param triggers: whether the archive rows of this model are written by the triggers of \
+            :func:`~versionalchemy.triggers.create_triggers` instead of flushes, which then only \
+            invalidate cached reads. The same restrictions as for an outbox apply.
         """
+        validate = get_validation_mode(validate)
+        if create_indexes and validate != 'eager':
+            raise ValueError('create_indexes requires eager validation')
         version_col_names = cls.va_version_columns
         if not version_col_names:
             raise LogTableCreationError('Need to specify version cols in cls.va_version_columns')
@@ -141,38 +435,108 @@ class VAModelMixin(object):
         cls.va_ignore_columns.add('va_id')
         version_cols = [getattr(cls, col_name, None) for col_name in version_col_names]
 
-        cls._validate(engine, *version_cols)
+        cls._validate(None, *version_cols)
+        if cls._va_version_counter:
+            cls.va_ignore_columns.add('va_version')
+        cls._va_serializers = {}
+        cls._serializer(engine.dialect)
 
-        ArchiveTable._validate(engine, *version_cols)
+        ArchiveTable._validate(None, *version_cols)
+        if CheckpointTable is not None:
+            CheckpointTable._validate(None, *version_cols)
+        if outbox is not None or triggers:
+            cls._validate_archived_later(ArchiveTable, outbox, triggers)
+        if validate == 'eager':
+            cls._check_schema(engine, ArchiveTable, CheckpointTable, create_indexes, inspector)
         cls.ArchiveTable = ArchiveTable
+        cls.CheckpointTable = CheckpointTable
+        cls.va_outbox = outbox
+        cls.va_triggers = bool(triggers)
+        if outbox is not None:
+            outbox.register(cls)
+        cls._va_validation_pending = validate == 'lazy'
 
-    def _to_dict(self, dialect, use_dirty=True):
+    def _to_dict(self, dialect, use_dirty=True, changed_only=False):
         """
         :param dialect: a :py:class:`~sqlalchemy.engine.interfaces.Dialect` corresponding to the \
             SQL dialect being used.
         :param use_dirty: whether to make a dict of the fields as they stand, or the fields \
             before the row was updated
+        :param changed_only: whether to only include the fields that were changed
 
         :return: a dictionary of key value pairs representing this row.
         :rtype: dict
         """
-        return {
-            cn: utils.get_column_attribute(self, c, use_dirty=use_dirty, dialect=dialect)
-            for c, cn in utils.get_column_keys_and_names(self)
-            if c not in self.va_ignore_columns
-        }
+        return self._serializer(dialect).to_dict(
+            self, use_dirty=use_dirty, changed_only=changed_only
+        )
+
+    @classmethod
+    def _serializer(cls, dialect):
+        """
+        :param dialect: a :py:class:`~sqlalchemy.engine.interfaces.Dialect` or None
+
+        :return: the :class:`~versionalchemy.utils.RowSerializer` of this model for dialect, \
+        which is compiled on first use and cached on the model.
+        :rtype: :class:`~versionalchemy.utils.RowSerializer`
+        """
+        serializers = cls.__dict__.get('_va_serializers')
+        if serializers is None:
+            serializers = cls._va_serializers = {}
+        serializer = serializers.get(dialect)
+        if serializer is None:
+            serializer = serializers[dialect] = utils.RowSerializer(
+                cls, dialect, ignore=cls.va_ignore_columns or ()
+            )
+        return serializer
 
     @classmethod
     def _validate(cls, engine, *version_cols):
-        version_col_names = set()
         for version_column_ut in version_cols:
             if not isinstance(version_column_ut, sa.orm.attributes.InstrumentedAttribute):
                 raise LogTableCreationError(
                     "All version columns must be <sa.orm.attributes.InstrumentedAttribute>"
                 )
-            version_col_names.add(version_column_ut.key)
 
-        # Check the unique constraint on the versioned columns
+        if engine is not None:
+            cls._check_constraints(engine)
+
+        # Check the type of the optional version counter
+        version_counter = getattr(cls, 'va_version', None)
+        cls._va_version_counter = \
+            isinstance(version_counter, sa.orm.attributes.InstrumentedAttribute)
+        if (
+            cls._va_version_counter and
+            version_counter.property.columns[0].type.python_type is not int
+        ):
+            raise LogTableCreationError("The va_version column must be an integer column")
+
+    @classmethod
+    def _validate_archived_later(cls, ArchiveTable, outbox, triggers):
+        """
+        Raises :class:`~LogTableCreationError` if versions are needed when rows are flushed, so
+        the archive rows of the model cannot be written by an outbox or triggers.
+        """
+        if outbox is not None and triggers:
+            raise LogTableCreationError("Models cannot use both an outbox and triggers")
+        what = 'triggers' if triggers else 'an outbox'
+        if cls._va_version_counter:
+            raise LogTableCreationError(
+                "Models with a va_version column cannot use {}".format(what)
+            )
+        if ArchiveTable.va_keyframe_interval is not None:
+            raise LogTableCreationError("Log tables which store deltas cannot use {}".format(what))
+
+    @classmethod
+    def _check_constraints(cls, engine):
+        """
+        :param engine: instance of :class:`~sa.engine.Engine`, or an inspector returned by
+        :func:`~versionalchemy.utils.get_inspector`
+
+        Raises :class:`~LogTableCreationError` unless the version columns are the primary key or
+        have a unique constraint.
+        """
+        version_col_names = cls.va_version_columns
         insp = sa.inspect(cls)
         uc = sorted([col.name for col in insp.primary_key]) == sorted(version_col_names)
         if not (uc or utils.has_constraint(cls.__tablename__, engine, *version_col_names)):
@@ -180,12 +544,86 @@ class VAModelMixin(object):
                 "There is no unique contraint on the version columns"
             )
 
+    @classmethod
+    def _check_schema(
+        cls, engine, ArchiveTable, CheckpointTable=None, create_indexes=False, inspector=None
+    ):
+        """
+        :param engine: instance of :class:`~sa.engine.Engine` or :class:`~sa.engine.Connection`
+        :param ArchiveTable: the validated model of the archive table
+        :param CheckpointTable: the validated model of the checkpoint table, or None
+        :param create_indexes: whether to create the missing indexes of the archive table
+        :param inspector: an optional inspector returned by
+        :func:`~versionalchemy.utils.get_inspector` to reflect the tables with
+
+        Runs the checks of the tables which reflect them, and raises
+        :class:`~LogTableCreationError` if any of them fails.
+        """
+        if inspector is None:
+            inspector = utils.get_inspector(engine)
+        cls._check_constraints(inspector)
+        ArchiveTable._check_constraints(inspector)
+        ArchiveTable._check_indexes(engine, create=create_indexes, inspector=inspector)
+        if CheckpointTable is not None:
+            CheckpointTable._check_constraints(inspector)
+
+    @classmethod
+    def _check_schema_lazily(cls, session):
+        """
+        :param session: the session being flushed
+
+        Runs the checks of :meth:`_check_schema` which were deferred by
+        ``register(..., validate='lazy')`` on the connection of the flush, the first time it is
+        called for this model. If a check fails, it is run again by the next flush.
+        """
+        if not cls._va_validation_pending:
+            return
+        with _validation_lock:
+            if cls._va_validation_pending:
+                cls._check_schema(
+                    session.connection(mapper=cls), cls.ArchiveTable, cls.CheckpointTable
+                )
+                cls._va_validation_pending = False
+
+    @classmethod
+    def populate_version_counter(cls, session):
+        """
+        :param session: a session instance to execute the update with
+
+        Fills in the ``va_version`` counter of rows where it is ``NULL`` (e.g. rows written before
+        the column was added) from the archive row their ``va_id`` points at, with a single
+        ``UPDATE`` statement.
+
+        :return: the number of rows updated
+        :rtype: int
+        """
+        if not cls._va_version_counter:
+            raise LogTableCreationError('{} has no va_version column'.format(cls.__name__))
+        at = cls.ArchiveTable
+        result = session.execute(
+            sa.update(cls.__table__)
+            .values(va_version=sa.select([at.va_version]).where(at.va_id == cls.va_id).as_scalar())
+            .where(cls.va_version.is_(None))
+        )
+        return result.rowcount
+
+    def _committed_version(self):
+        """
+        :return: the value of the version counter before this row was changed, or None if the \
+        model has no version counter or it has not been populated for this row.
+        """
+        if not self._va_version_counter:
+            return None
+        return utils.get_column_attribute(self, 'va_version', use_dirty=False)
+
     def version(self, session):
         """
         Returns the rows current version. This can only be called after a row has been
         inserted into the table and the session has been flushed. Otherwise this
         method has undefined behavior.
         """
+        if self._va_version_counter and self.va_version is not None:
+            return self.va_version
         result = session.execute(
             sa.select([self.ArchiveTable.va_version]).
             where(self.ArchiveTable.va_id == self.va_id)
@@ -0,0 +1,333 @@
+'''
+Write-behind archiving. The flushes of models registered with an outbox (see
+:meth:`~versionalchemy.models.VAModelMixin.register`) only put their archive rows into the outbox,
+and :func:`drain` moves them into the log tables later in large batches, usually on the
+background thread of an :class:`OutboxWorker`::
+
+    outbox = TableOutbox(ExampleOutbox)
+    Example.register(ExampleArchive, engine, outbox=outbox)
+    worker = OutboxWorker(outbox, Session)
+    worker.start()
+
+Versions are assigned when rows are drained, in the order they were put into the outbox. Until
+then, the history of a row is missing its latest versions and the ``va_id`` of the row in the
+user table is not updated; it is back-filled by :func:`drain`.
+'''
+from __future__ import absolute_import
+
+import collections
+import logging
+import threading
+
+import six
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+import versionalchemy
+from versionalchemy import utils
+
+log = logging.getLogger(__name__)
+
+# The key in Session.info of the rows which are queued when the session commits
+_PENDING_KEY = 'va_outbox_pending'
+
+_listening = False
+_listening_lock = threading.Lock()
+
+
+class QueueOutbox(object):
+    '''
+    An outbox which queues archive rows in memory once the transaction which flushed them commits.
+    It is not durable: the rows which were not drained are lost when the process exits.
+    '''
+    def __init__(self):
+        self._queue = collections.deque()
+        self._lock = threading.Lock()
+        _listen_for_transactions()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def register(self, Model):
+        pass
+
+    def put(self, session, entries):
+        '''
+        :param session: the session being flushed
+        :param entries: a list of ``(Model, row_dict)`` tuples
+        '''
+        session.info.setdefault(_PENDING_KEY, []).append((session.transaction, self, entries))
+
+    def take(self, session, limit):
+        '''
+        :return: a list of at most limit ``(token, Model, row_dict)`` tuples, in the order they \
+        were put
+        '''
+        with self._lock:
+            return [self._queue.popleft() for _ in range(min(limit, len(self._queue)))]
+
+    def ack(self, session, entries):
+        pass
+
+    def requeue(self, entries):
+        '''
+        Puts back entries which were taken but could not be archived, in front of the queue.
+        '''
+        with self._lock:
+            self._queue.extendleft(reversed(entries))
+
+    def _enqueue(self, entries):
+        with self._lock:
+            self._queue.extend((None, Model, row_dict) for Model, row_dict in entries)
+
+
+class TableOutbox(object):
+    '''
+    A durable outbox which stages archive rows in a table, with a multi-row ``INSERT`` in the
+    transaction of the flush, so rows are only drained once it commits.
+
+    Only one process should drain a table outbox at a time; concurrent drains of the same rows
+    fail on the unique constraints of the log tables and are rolled back.
+
+    :param OutboxTable: the model of the staging table, which inherits from \
+        :class:`~versionalchemy.models.VAOutboxMixin`
+    '''
+    def __init__(self, OutboxTable):
+        self.OutboxTable = OutboxTable
+        self._models = {}
+
+    def register(self, Model):
+        self._models[Model.__tablename__] = Model
+
+    def put(self, session, entries):
+        '''
+        :param session: the session being flushed
+        :param entries: a list of ``(Model, row_dict)`` tuples
+        '''
+        values = [
+            {'va_table': Model.__tablename__, 'va_payload': row_dict}
+            for Model, row_dict in entries
+        ]
+        for chunk in utils.chunks(values, utils.max_conditions(2)):
+            session.execute(sa.insert(self.OutboxTable.__table__).values(chunk))
+
+    def take(self, session, limit):
+        '''
+        :return: a list of at most limit ``(token, Model, row_dict)`` tuples, in the order they \
+        were put
+        '''
+        ot = self.OutboxTable
+        result = session.execute(
+            sa.select([ot.va_outbox_id, ot.va_table, ot.va_payload])
+            .order_by(ot.va_outbox_id)
+            .limit(limit)
+        )
+        entries = []
+        for outbox_id, tbl_name, payload in result:
+            if tbl_name not in self._models:
+                raise ValueError('{} is not registered with this outbox'.format(tbl_name))
+            Model = self._models[tbl_name]
+            entries.append((outbox_id, Model, _load_payload(Model.ArchiveTable, payload)))
+        return entries
+
+    def ack(self, session, entries):
+        '''
+        Deletes the staged rows of entries which were archived, in the same transaction.
+        '''
+        ot = self.OutboxTable
+        ids = [outbox_id for outbox_id, _, _ in entries]
+        for chunk in utils.chunks(ids, utils.MAX_BIND_PARAMS):
+            session.execute(sa.delete(ot.__table__).where(ot.va_outbox_id.in_(chunk)))
+
+    def requeue(self, entries):
+        pass
+
+
+def _load_payload(ArchiveTable, payload):
+    '''
+    :return: the row_dict of a staged row, whose values were serialized to JSON, with the values of
+    the columns of ArchiveTable other than va_data as their python types, e.g. datetimes
+    '''
+    return {
+        key: value if key == 'va_data' else utils.load_json_value(getattr(ArchiveTable, key), value)
+        for key, value in six.iteritems(payload)
+    }
+
+
+def drain(outbox, session, limit=1000):
+    '''
+    :param outbox: a :class:`QueueOutbox` or :class:`TableOutbox`
+    :param session: a session to archive the rows with, which is committed
+    :param limit: the maximum number of rows archived
+
+    Moves the oldest rows of the outbox into their log tables. Each row gets the version after
+    the latest version of its key, with one grouped query per log table, and rows are inserted
+    with one executemany per log table. The ``va_id`` of the rows in the user table is then
+    pointed at their latest archive rows.
+
+    :return: the number of rows archived
+    :rtype: int
+    '''
+    entries = outbox.take(session, limit)
+    if not entries:
+        return 0
+    try:
+        archive_rows = _assign_versions(session, entries)
+        va_ids = versionalchemy._insert_archive_rows(session, archive_rows)
+        _backfill_va_ids(session, entries, archive_rows, va_ids)
+        outbox.ack(session, entries)
+        session.commit()
+    except Exception:
+        session.rollback()
+        outbox.requeue(entries)
+        raise
+    versionalchemy._invalidate_caches(archive_rows)
+    return len(entries)
+
+
+def _get_key(ArchiveTable, row_dict):
+    return tuple(row_dict[col_name] for col_name in ArchiveTable._version_col_names)
+
+
+def _assign_versions(session, entries):
+    '''
+    :return: a list of the ``(ArchiveTable, row_dict)`` tuples of entries with their versions
+    '''
+    keys = {}
+    for _, Model, row_dict in entries:
+        keys.setdefault(Model.ArchiveTable, set()).add(_get_key(Model.ArchiveTable, row_dict))
+    latest_versions = {
+        ArchiveTable: ArchiveTable._latest_versions(session, table_keys)
+        for ArchiveTable, table_keys in six.iteritems(keys)
+    }
+
+    archive_rows = []
+    for _, Model, row_dict in entries:
+        ArchiveTable = Model.ArchiveTable
+        key = _get_key(ArchiveTable, row_dict)
+        version = latest_versions[ArchiveTable].get(key)
+        version = 0 if version is None else version + 1
+        latest_versions[ArchiveTable][key] = version
+        archive_rows.append((ArchiveTable, dict(row_dict, va_version=version)))
+    return archive_rows
+
+
+def _backfill_va_ids(session, entries, archive_rows, va_ids):
+    '''
+    Points the rows in the user table at the last archive row of their key in entries, unless
+    it deleted the row.
+    '''
+    last = {}
+    for i, (_, Model, row_dict) in enumerate(entries):
+        last[(Model, _get_key(Model.ArchiveTable, row_dict))] = i
+
+    params = {}
+    for (Model, _), i in six.iteritems(last):
+        row_dict = archive_rows[i][1]
+        if row_dict['va_deleted']:
+            continue
+        row_params = {'va_id': va_ids[i]}
+        row_params.update(
+            (versionalchemy._key_param(col_name), row_dict[col_name])
+            for col_name in Model.va_version_columns
+        )
+        params.setdefault(Model, []).append(row_params)
+    for Model, model_params in six.iteritems(params):
+        versionalchemy._backfill_va_ids(session, Model, model_params)
+
+
+class OutboxWorker(threading.Thread):
+    '''
+    A daemon thread which drains an outbox in batches until it is stopped.
+
+    :param outbox: a :class:`QueueOutbox` or :class:`TableOutbox`
+    :param session_factory: a callable returning a new session, e.g. a \
+        :class:`~sqlalchemy.orm.session.sessionmaker`
+    :param batch_size: the maximum number of rows archived per transaction
+    :param interval: the number of seconds to wait once the outbox is empty before draining it \
+        again
+    '''
+    def __init__(self, outbox, session_factory, batch_size=1000, interval=1.0):
+        super(OutboxWorker, self).__init__(name='versionalchemy-outbox')
+        self.daemon = True
+        self.outbox = outbox
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                drained = self.drain()
+            except Exception:
+                log.exception('Failed to drain the versionalchemy outbox')
+                drained = 0
+            if drained < self.batch_size:
+                self._stopped.wait(self.interval)
+        # Archive what was put into the outbox before the worker was stopped
+        while self.drain() == self.batch_size:
+            pass
+
+    def drain(self):
+        '''
+        Archives a batch of rows with a new session.
+
+        :return: the number of rows archived
+        '''
+        session = self.session_factory()
+        try:
+            return drain(self.outbox, session, self.batch_size)
+        finally:
+            session.close()
+
+    def stop(self, timeout=None):
+        '''
+        Stops the thread after it drains the rows which are in the outbox.
+        '''
+        self._stopped.set()
+        self.join(timeout)
+
+
+def _listen_for_transactions():
+    global _listening
+    with _listening_lock:
+        if _listening:
+            return
+        _listening = True
+        sa.event.listen(Session, 'after_commit', _after_commit)
+        sa.event.listen(Session, 'after_soft_rollback', _after_soft_rollback)
+        sa.event.listen(Session, 'after_transaction_end', _after_transaction_end)
+
+
+def _after_commit(session):
+    # after_commit is also dispatched when a savepoint is released
+    if session.transaction is not None and session.transaction.parent is not None:
+        return
+    for _, outbox, entries in session.info.pop(_PENDING_KEY, ()):
+        outbox._enqueue(entries)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    '''
+    Discards the rows flushed within a transaction or savepoint which was rolled back.
+    '''
+    pending = session.info.get(_PENDING_KEY)
+    if pending:
+        session.info[_PENDING_KEY] = [
+            p for p in pending if not _is_within(p[0], previous_transaction)
+        ]
+
+
+def _after_transaction_end(session, transaction):
+    # Rows which were not queued when the outermost transaction ends were never committed
+    if transaction.parent is None:
+        session.info.pop(_PENDING_KEY, None)
+
+
+def _is_within(transaction, ancestor):
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
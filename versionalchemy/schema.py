@@ -0,0 +1,169 @@
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+
+import sqlalchemy as sa
+
+from versionalchemy import utils
+
+# Bump whenever the format of saved snapshots changes, so old cache files are ignored
+SNAPSHOT_FORMAT = 1
+
+
+def _reflect_unique_constraints(insp, tbl_name):
+    return [
+        {'column_names': list(x['column_names'])} for x in insp.get_unique_constraints(tbl_name)
+    ]
+
+
+def _reflect_pk_constraint(insp, tbl_name):
+    return {'constrained_columns': list(insp.get_pk_constraint(tbl_name)['constrained_columns'])}
+
+
+def _reflect_indexes(insp, tbl_name):
+    return [{'column_names': list(x['column_names'])} for x in insp.get_indexes(tbl_name)]
+
+
+_REFLECTORS = {
+    'unique_constraints': _reflect_unique_constraints,
+    'pk_constraint': _reflect_pk_constraint,
+    'indexes': _reflect_indexes,
+}
+
+
+class SchemaSnapshot(object):
+    '''
+    The unique constraints, primary keys and indexes of tables, which can be passed in place of an
+    :class:`~sqlalchemy.engine.reflection.Inspector` to :func:`versionalchemy.utils.has_constraint`
+    and :func:`versionalchemy.utils.has_index`, and saved to a file.
+
+    Whatever is not in the snapshot yet is reflected with a single inspector shared by all tables
+    and added to the snapshot.
+
+    :param engine: the engine to reflect tables with, or None if the snapshot is complete
+    :param tables: a dict of table name -> reflected constraints and indexes of the table, as \
+        returned by :attr:`tables`
+    '''
+    def __init__(self, engine=None, tables=None):
+        self.engine = engine
+        self.tables = tables if tables is not None else {}
+        #: Whether anything was reflected since the snapshot was created
+        self.reflected = False
+        self._inspector = None
+
+    def get_unique_constraints(self, tbl_name):
+        return self._get(tbl_name, 'unique_constraints')
+
+    def get_pk_constraint(self, tbl_name):
+        return self._get(tbl_name, 'pk_constraint')
+
+    def get_indexes(self, tbl_name):
+        return self._get(tbl_name, 'indexes')
+
+    def _get(self, tbl_name, key):
+        table = self.tables.setdefault(tbl_name, {})
+        if key not in table:
+            if self.engine is None:
+                raise sa.exc.NoSuchTableError(tbl_name)
+            if self._inspector is None:
+                self._inspector = utils.get_inspector(self.engine)
+            table[key] = _REFLECTORS[key](self._inspector, tbl_name)
+            self.reflected = True
+        return table[key]
+
+
+def fingerprint(engine, tbl_names):
+    '''
+    :param engine: an instance of :class:`sa.engine.Engine`
+    :param tbl_names: the names of the tables to fingerprint
+
+    Reads the definitions of the constraints and indexes of all tables with a single query of the
+    database catalog. Only SQLite, MySQL and PostgreSQL are supported.
+
+    :return: a string which changes whenever the constraints or indexes of the tables change, or \
+    None if the dialect is not supported
+    :rtype: str
+    '''
+    tbl_names = sorted(tbl_names)
+    query = _get_fingerprint_query(engine.dialect, tbl_names)
+    if query is None:
+        return None
+    with engine.connect() as conn:
+        rows = [list(row) for row in conn.execute(query)]
+    data = [SNAPSHOT_FORMAT, engine.dialect.name, tbl_names, rows]
+    return hashlib.sha1(json.dumps(data, default=str).encode('utf-8')).hexdigest()
+
+
+def _get_fingerprint_query(dialect, tbl_names):
+    if dialect.name == 'sqlite':
+        # The DDL of the tables, including inline constraints, and of their indexes
+        catalog = sa.table(
+            'sqlite_master', sa.column('type'), sa.column('name'), sa.column('tbl_name'),
+            sa.column('sql'),
+        )
+        c = catalog.c
+        return sa.select([c.tbl_name, c.type, c.name, c.sql]) \
+            .where(c.tbl_name.in_(tbl_names)) \
+            .order_by(c.tbl_name, c.type, c.name)
+    if dialect.name == 'mysql':
+        # Primary keys and unique constraints are indexes too
+        catalog = sa.table(
+            'statistics', sa.column('table_schema'), sa.column('table_name'),
+            sa.column('index_name'), sa.column('seq_in_index'), sa.column('column_name'),
+            sa.column('non_unique'), schema='information_schema',
+        )
+        c = catalog.c
+        cols = [c.table_name, c.index_name, c.seq_in_index, c.column_name, c.non_unique]
+        return sa.select(cols) \
+            .where(c.table_schema == sa.func.database()) \
+            .where(c.table_name.in_(tbl_names)) \
+            .order_by(c.table_name, c.index_name, c.seq_in_index)
+    if dialect.name == 'postgresql':
+        # Primary keys and unique constraints are backed by indexes
+        catalog = sa.table(
+            'pg_indexes', sa.column('schemaname'), sa.column('tablename'),
+            sa.column('indexname'), sa.column('indexdef'),
+        )
+        c = catalog.c
+        return sa.select([c.tablename, c.indexname, c.indexdef]) \
+            .where(c.schemaname == sa.func.current_schema()) \
+            .where(c.tablename.in_(tbl_names)) \
+            .order_by(c.tablename, c.indexname)
+    return None
+
+
+def load_snapshot(path, fingerprint, engine=None):
+    '''
+    :param path: the path of a file written by :func:`save_snapshot`
+    :param fingerprint: the current fingerprint of the schema
+    :param engine: the engine to reflect what is missing from the snapshot with, e.g. the tables \
+        of models which were added since it was saved
+
+    :return: the saved :class:`SchemaSnapshot`, or None if the file does not exist, cannot be \
+    read or was saved for another fingerprint
+    '''
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('fingerprint') != fingerprint:
+        return None
+    return SchemaSnapshot(engine, tables=data.get('tables') or {})
+
+
+def save_snapshot(path, fingerprint, snapshot):
+    '''
+    :param path: the path of the file to write
+    :param fingerprint: the fingerprint of the schema which was reflected
+    :param snapshot: a :class:`SchemaSnapshot`
+
+    Writes the snapshot to a temporary file which is then renamed to path, so that concurrent
+    readers never see a partially written file.
+    '''
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'tables': snapshot.tables}, f, sort_keys=True)
+    getattr(os, 'replace', os.rename)(tmp_path, path)
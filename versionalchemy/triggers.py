@@ -0,0 +1,308 @@
+'''
+Archiving with database triggers instead of flushes. The triggers created by
+:func:`create_triggers` write the archive rows of every ``INSERT``, ``UPDATE`` and ``DELETE`` of
+the user table, including writes which do not go through the ORM, in the same format as flushes:
+``va_data`` is built with the JSON functions of the database and ``va_version`` is the next
+version of the key. The model is then registered with ``triggers=True`` so that flushes leave the
+archiving to the triggers::
+
+    create_triggers(Example, ExampleArchive, engine)
+    Example.register(ExampleArchive, engine, triggers=True)
+
+SQLite (3.18+) and PostgreSQL (9.5+) are supported. The ``user_id`` of archive rows written by
+triggers is NULL, and ``va_data`` must be stored as JSON text, i.e. with
+:class:`~versionalchemy.utils.JSONEncodedDict`. On SQLite, ``INSERT`` statements which do not go
+through SQLAlchemy must set ``va_id`` (e.g. to 0), which has no server default.
+'''
+from __future__ import absolute_import
+
+import sqlalchemy as sa
+
+from versionalchemy import utils
+from versionalchemy.exceptions import LogTableCreationError
+
+# The maximum number of columns passed to one call of SQLite's json_object or json_set
+_SQLITE_JSON_OBJECT_COLUMNS = 50
+
+
+def create_triggers(Model, ArchiveTable, bind):
+    '''
+    :param Model: a model which inherits from :class:`~versionalchemy.models.VAModelMixin`
+    :param ArchiveTable: the model of its log table
+    :param bind: an engine or connection to create the triggers with
+
+    Creates the triggers which archive the rows of Model, replacing existing ones.
+    '''
+    for statement in get_drop_trigger_ddl(Model, bind.dialect):
+        bind.execute(statement)
+    for statement in get_trigger_ddl(Model, ArchiveTable, bind.dialect):
+        bind.execute(statement)
+
+
+def drop_triggers(Model, bind):
+    '''
+    :param Model: a model whose triggers were created with :func:`create_triggers`
+    :param bind: an engine or connection to drop the triggers with
+    '''
+    for statement in get_drop_trigger_ddl(Model, bind.dialect):
+        bind.execute(statement)
+
+
+def get_trigger_ddl(Model, ArchiveTable, dialect):
+    '''
+    :param Model: a model which inherits from :class:`~versionalchemy.models.VAModelMixin`
+    :param ArchiveTable: the model of its log table
+    :param dialect: the :py:class:`~sqlalchemy.engine.interfaces.Dialect` of the database
+
+    :return: the statements which create the triggers that archive the rows of Model
+    :rtype: list
+    '''
+    if not isinstance(ArchiveTable.va_data.type, utils.JSONEncodedDict):
+        raise LogTableCreationError('Triggers can only write va_data as JSON text')
+    if ArchiveTable.va_keyframe_interval is not None:
+        raise LogTableCreationError('Triggers cannot store deltas')
+    tables = _Tables(Model, ArchiveTable, dialect)
+    if dialect.name == 'sqlite':
+        return _get_sqlite_ddl(tables)
+    if dialect.name == 'postgresql':
+        return _get_postgresql_ddl(tables)
+    raise NotImplementedError('Triggers are not supported for {}'.format(dialect.name))
+
+
+def get_drop_trigger_ddl(Model, dialect):
+    '''
+    :return: the statements which drop the triggers created by :func:`create_triggers`
+    :rtype: list
+    '''
+    quote = dialect.identifier_preparer.quote
+    table = quote(Model.__tablename__)
+    names = [quote(name) for name in _get_trigger_names(Model)]
+    if dialect.name == 'sqlite':
+        return ['DROP TRIGGER IF EXISTS {}'.format(name) for name in names]
+    if dialect.name == 'postgresql':
+        return ['DROP TRIGGER IF EXISTS {} ON {}'.format(name, table) for name in names] + [
+            'DROP FUNCTION IF EXISTS {}()'.format(quote(_get_function_name(Model)))
+        ]
+    raise NotImplementedError('Triggers are not supported for {}'.format(dialect.name))
+
+
+def _get_trigger_names(Model):
+    return ['{}_va_{}'.format(Model.__tablename__, op) for op in ('insert', 'update', 'delete')]
+
+
+def _get_function_name(Model):
+    return '{}_va_archive'.format(Model.__tablename__)
+
+
+class _Tables(object):
+    '''
+    The quoted names of the tables and columns which the triggers of a model refer to.
+    '''
+    def __init__(self, Model, ArchiveTable, dialect):
+        quote = dialect.identifier_preparer.quote
+        self.user_table = quote(Model.__tablename__)
+        self.archive_table = quote(ArchiveTable.__tablename__)
+        self.trigger_names = [quote(name) for name in _get_trigger_names(Model)]
+        self.function_name = quote(_get_function_name(Model))
+
+        def column_name(model, key):
+            return quote(getattr(model, key).property.columns[0].name)
+        # (archive table column, user table column) of each version column
+        self.keys = [
+            (column_name(ArchiveTable, key), column_name(Model, key))
+            for key in _unique(Model.va_version_columns)
+        ]
+        ignore = set(Model.va_ignore_columns or ()) | {'va_id'}
+        keys_and_names = list(utils.get_column_keys_and_names(Model))
+        # (JSON key, user table column) of each column in va_data
+        self.data = [(name, quote(name)) for key, name in keys_and_names if key not in ignore]
+        # Names of the columns in va_data whose values are formatted as datetimes are by flushes
+        self.datetime_names = {
+            name for key, name in keys_and_names
+            if key not in ignore and utils.is_naive_datetime(
+                getattr(Model, key).property.columns[0]
+            )
+        }
+        self.dialect = dialect
+        self.ignored_names = sorted(name for key, name in keys_and_names if key in ignore)
+        # Changes to any other column than va_id and va_version are archived, as by flushes
+        self.watched = [
+            quote(name) for key, name in keys_and_names if key not in ('va_id', 'va_version')
+        ]
+        self.archive_columns = ', '.join(
+            [archive_col for archive_col, _ in self.keys] +
+            [quote(name) for name in ('va_version', 'va_deleted', 'va_updated_at', 'va_data')]
+        )
+        self.va_id = quote('va_id')
+        self.va_version = quote('va_version')
+
+    def json_value(self, ref, name, col):
+        '''
+        Returns the SQL of the value of the column col of the row ref (NEW or OLD) in va_data.
+        '''
+        value = '{}.{}'.format(ref, col)
+        if name not in self.datetime_names:
+            return value
+        return str(utils.json_datetime(self.dialect, sa.literal_column(value)).compile(
+            dialect=self.dialect, compile_kwargs={'literal_binds': True}
+        ))
+
+    def key_changed(self, distinct):
+        return ' OR '.join(
+            'OLD.{0} {1} NEW.{0}'.format(user_col, distinct) for _, user_col in self.keys
+        )
+
+    def changed(self, distinct):
+        return ' OR '.join('OLD.{0} {1} NEW.{0}'.format(col, distinct) for col in self.watched)
+
+    def insert_archive_row(self, ref, deleted, now, data, where=None):
+        '''
+        Returns an INSERT of the archive row of the row ref (NEW or OLD) with the next version of
+        its key.
+        '''
+        next_version = '(SELECT COALESCE(MAX({}), -1) + 1 FROM {} WHERE {})'.format(
+            self.va_version,
+            self.archive_table,
+            ' AND '.join(
+                '{}.{} = {}.{}'.format(self.archive_table, archive_col, ref, user_col)
+                for archive_col, user_col in self.keys
+            ),
+        )
+        values = ['{}.{}'.format(ref, user_col) for _, user_col in self.keys] + [
+            next_version, deleted, now, data,
+        ]
+        statement = 'INSERT INTO {} ({}) SELECT {}'.format(
+            self.archive_table, self.archive_columns, ', '.join(values)
+        )
+        if where is not None:
+            statement += ' WHERE {}'.format(where)
+        return statement
+
+
+def _unique(keys):
+    result = []
+    for key in keys:
+        if key not in result:
+            result.append(key)
+    return result
+
+
+def _sqlite_literal(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def _get_sqlite_ddl(tables):
+    # datetime.now() as stored by sqlalchemy, with microseconds
+    now = "strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime') || '000'"
+
+    def data(ref):
+        chunks = list(utils.chunks(tables.data, _SQLITE_JSON_OBJECT_COLUMNS))
+        result = 'json_object({})'.format(', '.join(
+            '{}, {}'.format(_sqlite_literal(key), tables.json_value(ref, key, col))
+            for key, col in chunks[0]
+        ))
+        # json_set, unlike json_patch, keeps the keys of NULL values
+        for chunk in chunks[1:]:
+            result = 'json_set({}, {})'.format(result, ', '.join(
+                '{}, {}'.format(
+                    _sqlite_literal('$."{}"'.format(key)), tables.json_value(ref, key, col)
+                )
+                for key, col in chunk
+            ))
+        return result
+
+    def insert_new():
+        return [
+            tables.insert_archive_row('NEW', '0', now, data('NEW')),
+            'UPDATE {} SET {} = last_insert_rowid() WHERE {}'.format(
+                tables.user_table,
+                tables.va_id,
+                ' AND '.join(
+                    '{0} = NEW.{0}'.format(user_col) for _, user_col in tables.keys
+                ),
+            ),
+        ]
+
+    insert_name, update_name, delete_name = tables.trigger_names
+    triggers = [
+        (insert_name, 'AFTER INSERT', None, insert_new()),
+        (
+            update_name,
+            'AFTER UPDATE OF {}'.format(', '.join(tables.watched)),
+            tables.changed('IS NOT'),
+            [tables.insert_archive_row(
+                'OLD', '1', now, data('OLD'), where=tables.key_changed('IS NOT')
+            )] + insert_new(),
+        ),
+        (delete_name, 'AFTER DELETE', None, [
+            tables.insert_archive_row('OLD', '1', now, data('OLD')),
+        ]),
+    ]
+    return [
+        'CREATE TRIGGER {} {} ON {} FOR EACH ROW{}\nBEGIN\n{}\nEND'.format(
+            name,
+            event,
+            tables.user_table,
+            '' if when is None else ' WHEN {}'.format(when),
+            '\n'.join('    {};'.format(statement) for statement in statements),
+        )
+        for name, event, when, statements in triggers
+    ]
+
+
+def _get_postgresql_ddl(tables):
+    now = 'clock_timestamp()::timestamp'
+
+    def data(ref):
+        # to_jsonb has the columns of the row keyed by their names, as va_data, and datetimes are
+        # formatted as by flushes by replacing them
+        datetimes = [(name, col) for name, col in tables.data if name in tables.datetime_names]
+        return '(to_jsonb({}){}{})::text'.format(ref, ''.join(
+            " - '{}'".format(name.replace("'", "''")) for name in tables.ignored_names
+        ), ''.join(
+            ' || jsonb_build_object({})'.format(', '.join(
+                "'{}', {}".format(name.replace("'", "''"), tables.json_value(ref, name, col))
+                for name, col in chunk
+            ))
+            for chunk in utils.chunks(datetimes, 50)
+        ))
+
+    function = '\n'.join([
+        'CREATE OR REPLACE FUNCTION {}() RETURNS trigger AS $va$',
+        'BEGIN',
+        "    IF TG_OP = 'DELETE' THEN",
+        '        {};',
+        '        RETURN OLD;',
+        '    END IF;',
+        "    IF TG_OP = 'UPDATE' AND ({}) THEN",
+        '        {};',
+        '    END IF;',
+        '    {} RETURNING {} INTO NEW.{};',
+        '    RETURN NEW;',
+        'END',
+        '$va$ LANGUAGE plpgsql',
+    ]).format(
+        tables.function_name,
+        tables.insert_archive_row('OLD', 'true', now, data('OLD')),
+        tables.key_changed('IS DISTINCT FROM'),
+        tables.insert_archive_row('OLD', 'true', now, data('OLD')),
+        tables.insert_archive_row('NEW', 'false', now, data('NEW')),
+        tables.va_id,
+        tables.va_id,
+    )
+    insert_name, update_name, delete_name = tables.trigger_names
+    events = [
+        (insert_name, 'BEFORE INSERT', ''),
+        (
+            update_name,
+            'BEFORE UPDATE OF {}'.format(', '.join(tables.watched)),
+            ' WHEN ({})'.format(tables.changed('IS DISTINCT FROM')),
+        ),
+        (delete_name, 'BEFORE DELETE', ''),
+    ]
+    return [function] + [
+        'CREATE TRIGGER {} {} ON {} FOR EACH ROW{} EXECUTE PROCEDURE {}()'.format(
+            name, event, tables.user_table, when, tables.function_name
+        )
+        for name, event, when in events
+    ]
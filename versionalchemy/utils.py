@@ -1,16 +1,32 @@
 from __future__ import absolute_import
 
+import collections
 import datetime
 import decimal
 import itertools
 import json
+import uuid
+import zlib
 
 import six
 import sqlalchemy as sa
-from six.moves import zip
-from sqlalchemy import TypeDecorator, UnicodeText
+from six.moves import range, zip
+from sqlalchemy import LargeBinary, TypeDecorator, UnicodeText
 from sqlalchemy.engine.reflection import Inspector
 
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# Upper bound on the bind parameters put in a single statement (SQLite's historical default limit)
+MAX_BIND_PARAMS = 999
+
 
 def result_to_dict(res):
     """
@@ -64,6 +80,39 @@ def generate_and_clause(cls, row, cols, use_dirty=True):
     ))
 
 
+def generate_in_clause(cls, cols, keys):
+    """
+    :param cls: the sqlalchemy ORM model
+    :param cols: a list of strings corresponding to column names
+    :param keys: an iterable of tuples of values, one value per column in cols
+
+    :return: a clause which matches rows whose columns in cols are equal to one of the keys; \
+    an ``IN`` clause for a single column or an ``OR`` of :py:func:`sqlalchemy.and_` clauses.
+    """
+    if len(cols) == 1:
+        return getattr(cls, cols[0]).in_([key[0] for key in keys])
+    return sa.or_(*(
+        sa.and_(*(getattr(cls, col_name) == value for col_name, value in zip(cols, key)))
+        for key in keys
+    ))
+
+
+def chunks(seq, size):
+    '''
+    Returns a generator of consecutive slices of seq, each with at most size elements.
+    '''
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def max_conditions(num_cols):
+    '''
+    Returns how many keys of num_cols columns can be matched in a single statement without
+    exceeding :data:`MAX_BIND_PARAMS`.
+    '''
+    return max(1, MAX_BIND_PARAMS // num_cols)
+
+
 def get_bind_processor(row, col_name, dialect):
     '''
     Returns a bind_processor for the given column in the row based on the dialect. If dialect
@@ -99,6 +148,75 @@ def get_column_attribute(row, col_name, use_dirty=True, dialect=None):
     return bind_processor(getattr(row, col_name))
 
 
+class RowSerializer(object):
+    """
+    Serializes rows of a model into dictionaries of column names to values, as done by
+    :func:`get_column_attribute` for every column, with everything that does not depend on the
+    row (the attribute keys, column names and bind processors) resolved once up front.
+
+    :param model: the sqlalchemy ORM model
+    :param dialect: if not None, a :py:class:`~sqlalchemy.engine.interfaces.Dialect` whose bind \
+        processors are applied to the values
+    :param ignore: attribute keys of columns to leave out
+    """
+    def __init__(self, model, dialect=None, ignore=()):
+        fields = []
+        onupdate_keys = set()
+        for key, name in get_column_keys_and_names(model):
+            if key in ignore:
+                continue
+            col = getattr(model, key).property.columns[0]
+            processor = None
+            if dialect is not None:
+                processor = col.type.bind_processor(dialect)
+            fields.append((key, name, processor))
+            if col.onupdate is not None or col.server_onupdate is not None:
+                onupdate_keys.add(key)
+        self.fields = tuple(fields)
+        # Values written by flushes have no history, so these fields always count as changed
+        self.onupdate_keys = frozenset(onupdate_keys)
+
+    def to_dict(self, row, use_dirty=True, changed_only=False):
+        """
+        :param row: an instance of the model
+        :param use_dirty: whether to serialize the fields as they stand, or the fields before the \
+            row was updated
+        :param changed_only: whether to leave out the fields that were not changed. Fields with \
+            ``onupdate`` or ``server_onupdate`` defaults and fields expired by a flush are always \
+            included, since the values written by the flush have no history.
+
+        :rtype: dict
+        """
+        state = None if use_dirty and not changed_only else sa.inspect(row)
+        unloaded = state.unloaded if changed_only else ()
+        result = {}
+        for key, name, processor in self.fields:
+            value = getattr(row, key)
+            if state is not None:
+                hist = state.attrs[key].history
+                if not hist.has_changes():
+                    if changed_only and key not in self.onupdate_keys and key not in unloaded:
+                        continue
+                elif not use_dirty:
+                    value = hist.deleted[0] if hist.deleted else None
+            result[name] = value if processor is None else processor(value)
+        return result
+
+    def mapping_to_dict(self, mapping):
+        """
+        :param mapping: the values of a row keyed by attribute key, e.g. a mapping passed to \
+            :meth:`~sqlalchemy.orm.session.Session.bulk_insert_mappings`; missing values are None
+
+        :return: the same dictionary as :meth:`to_dict` for a row with these values
+        :rtype: dict
+        """
+        result = {}
+        for key, name, processor in self.fields:
+            value = mapping.get(key)
+            result[name] = value if processor is None else processor(value)
+        return result
+
+
 def get_column_keys(table):
     '''
     Return a generator of names of the python attribute for the table columns.
@@ -128,23 +246,59 @@ def get_dialect(session):
     return session.connection().dialect
 
 
+def get_inspector(engine):
+    """
+    :param engine: an instance of :class:`sa.engine.Engine` or :class:`sa.engine.Connection`, \
+    or an object with the reflection methods of :class:`~sa.engine.reflection.Inspector`, e.g. \
+    an inspector or a :class:`~versionalchemy.schema.SchemaSnapshot`, which is returned as is
+
+    :return: an object to reflect constraints and indexes with. Reusing it across calls avoids \
+    reflecting the same table again.
+    """
+    if isinstance(engine, (sa.engine.Engine, sa.engine.Connection)):
+        return Inspector.from_engine(engine)
+    return engine
+
+
 def has_constraint(tbl_name, engine, *col_names):
     """
     :param tbl_name: a string with the name of the table to check
-    :param engine: an instance of :class:`sa.engine.Engine` from which to execute the query
+    :param engine: an instance of :class:`sa.engine.Engine` from which to execute the query, or \
+    an inspector returned by :func:`get_inspector`
     :param col_names: the name of columns which the unique constraint should contain
 
     :rtype: bool
     :return: True if the given columns are part of a unique constraint on tbl_name
     """
-    insp = Inspector.from_engine(engine)
+    insp = get_inspector(engine)
     constraints = itertools.chain(
         (sorted(x['column_names']) for x in insp.get_unique_constraints(tbl_name)),
-        sorted(insp.get_pk_constraint(tbl_name)['constrained_columns']),
+        [sorted(insp.get_pk_constraint(tbl_name)['constrained_columns'])],
     )
     return sorted(col_names) in constraints
 
 
+def has_index(tbl_name, engine, *col_names):
+    """
+    :param tbl_name: a string with the name of the table to check
+    :param engine: an instance of :class:`sa.engine.Engine` from which to execute the query, or \
+    an inspector returned by :func:`get_inspector`
+    :param col_names: the name of columns which the index should start with, in order
+
+    :rtype: bool
+    :return: True if an index, unique constraint or primary key on tbl_name starts with the given \
+    columns, i.e. the database can use it to look up rows by those columns
+    """
+    insp = get_inspector(engine)
+    indexes = itertools.chain(
+        (x['column_names'] for x in insp.get_indexes(tbl_name)),
+        (x['column_names'] for x in insp.get_unique_constraints(tbl_name)),
+        [insp.get_pk_constraint(tbl_name)['constrained_columns']],
+    )
+    col_names = list(col_names)
+    return any(list(index[:len(col_names)]) == col_names for index in indexes)
+
+
 def is_modified(row, ignore=None):
     if ignore is None:
         ignore = set()
@@ -159,25 +313,261 @@ def is_modified(row, ignore=None):
 
 class VAJSONEncoder(json.JSONEncoder):
     """
-    Extends the default encoder to add support for serializing datetime objects and decimals.
+    Extends the default encoder to add support for serializing datetime objects, decimals and
+    UUIDs.
 
-    Datetimes are serialized using `datetime.isoformat()`; the resulting string can be reloaded
+    Datetimes and dates are serialized using `isoformat()`; the resulting string can be reloaded
     into a MySQL/Postgres TIMESTAMP column directly (verified on MySQL 5.6 and Postgres 9.6).
-    Decimals are serialized using `float(Decimal)`.
+    Decimals are serialized using `float(Decimal)` and UUIDs using `str(UUID)`.
     """
     def default(self, obj):
-        if isinstance(obj, datetime.datetime):
+        if isinstance(obj, (datetime.datetime, datetime.date)):
             return obj.isoformat()
         if isinstance(obj, decimal.Decimal):
             return float(obj)
+        if isinstance(obj, uuid.UUID):
+            return str(obj)
         return super(VAJSONEncoder, self).default(obj)
 
 
+# Shared by every codec so the types above are serialized the same way whichever one is used
+_json_default = VAJSONEncoder().default
+
+
+class JSONCodec(object):
+    """
+    A pair of functions used to serialize python values to JSON text and parse them back.
+
+    :param name: the name the codec is registered under
+    :param dumps: a function from a python value to a JSON string
+    :param loads: a function from a JSON string to a python value
+    """
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+
+def _stdlib_codec():
+    return JSONCodec(
+        'json',
+        lambda value: json.dumps(value, ensure_ascii=False, cls=VAJSONEncoder),
+        json.loads,
+    )
+
+
+def _orjson_codec():
+    import orjson
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(value):
+        return orjson.dumps(value, default=_json_default, option=option).decode('utf-8')
+    return JSONCodec('orjson', dumps, orjson.loads)
+
+
+def _rapidjson_codec():
+    import rapidjson
+
+    def dumps(value):
+        return rapidjson.dumps(
+            value,
+            ensure_ascii=False,
+            default=_json_default,
+            datetime_mode=rapidjson.DM_NONE,
+            uuid_mode=rapidjson.UM_NONE,
+        )
+    return JSONCodec('rapidjson', dumps, rapidjson.loads)
+
+
+def _ujson_codec():
+    import ujson
+
+    def dumps(value):
+        return ujson.dumps(
+            value, ensure_ascii=False, escape_forward_slashes=False, default=_json_default
+        )
+    return JSONCodec('ujson', dumps, ujson.loads)
+
+
+_stdlib_json = _stdlib_codec()
+
+# In order of preference for ``set_json_codec('auto')``
+_json_codec_factories = collections.OrderedDict([
+    ('orjson', _orjson_codec),
+    ('rapidjson', _rapidjson_codec),
+    ('ujson', _ujson_codec),
+    ('json', lambda: _stdlib_json),
+])
+
+
+def register_json_codec(name, dumps, loads):
+    """
+    :param name: the name of the codec, to be passed to :func:`set_json_codec`
+    :param dumps: a function from a python value to a JSON string
+    :param loads: a function from a JSON string to a python value
+
+    Registers a custom JSON codec. ``dumps`` should use :class:`VAJSONEncoder`'s representation of
+    datetimes, dates, decimals and UUIDs so values read back are the same whichever codec wrote
+    them.
+    """
+    codec = JSONCodec(name, dumps, loads)
+    _json_codec_factories[name] = lambda: codec
+
+
+def _load_json_codec(name):
+    if name != 'auto':
+        return _json_codec_factories[name]()
+    for factory in six.itervalues(_json_codec_factories):
+        try:
+            return factory()
+        except ImportError:
+            pass
+    raise ImportError('No JSON codec is installed')
+
+
+def set_json_codec(name, decode_only=False):
+    """
+    :param name: the name of a registered codec (``'orjson'``, ``'rapidjson'``, ``'ujson'``, \
+        ``'json'`` or one added by :func:`register_json_codec`), or ``'auto'`` to use the fastest \
+        one installed.
+    :param decode_only: if ``True``, only parse JSON columns with the codec.
+
+    Selects the codec used by :class:`JSONEncodedDict` and :class:`JSONEncodedList`. By default
+    values are serialized with the std lib ``json`` module, whose output other codecs do not
+    reproduce byte for byte (they omit whitespace), and parsed with the fastest codec installed.
+    Values a codec cannot handle (e.g. integers over 64 bits for orjson) fall back to ``json``.
+
+    :raises ImportError: if the codec's library is not installed
+    :raises KeyError: if no codec is registered under name
+    """
+    global _json_encoder, _json_decoder
+    codec = _load_json_codec(name)
+    if not decode_only:
+        _json_encoder = codec
+    _json_decoder = codec
+
+
+def get_json_codecs():
+    """
+    :return: the names of the codecs used to serialize and to parse JSON columns
+    :rtype: tuple
+    """
+    return _json_encoder.name, _json_decoder.name
+
+
+def json_dumps(value):
+    '''
+    Serializes value to a JSON string with the selected codec.
+    '''
+    try:
+        return _json_encoder.dumps(value)
+    except (TypeError, ValueError, OverflowError):
+        if _json_encoder is _stdlib_json:
+            raise
+        return _stdlib_json.dumps(value)
+
+
+def json_loads(value):
+    '''
+    Parses a JSON string with the selected codec.
+    '''
+    try:
+        return _json_decoder.loads(value)
+    except (TypeError, ValueError, OverflowError):
+        if _json_decoder is _stdlib_json:
+            raise
+        return _stdlib_json.loads(value)
+
+
+_json_encoder = _stdlib_json
+_json_decoder = _load_json_codec('auto')
+
+
+# The formats of datetime.isoformat(), with and without microseconds and a UTC offset
+_ISO_DATETIME_FORMATS = [
+    '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z',
+]
+
+
+def load_json_value(col, value):
+    """
+    :param col: a column
+    :param value: a value of col which was serialized to JSON and parsed back, e.g. a datetime \
+        which was serialized to a string by :class:`VAJSONEncoder`
+
+    :return: value as the python type of col
+    """
+    try:
+        python_type = col.type.python_type
+    except NotImplementedError:
+        return value
+    if value is None or isinstance(value, python_type):
+        return value
+    # The python type of String is the byte string str on PY2, which text cannot always convert to
+    if isinstance(value, six.text_type) and issubclass(python_type, six.string_types):
+        return value
+    if python_type is datetime.datetime:
+        for fmt in _ISO_DATETIME_FORMATS:
+            try:
+                return datetime.datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+        raise ValueError('Invalid datetime: {}'.format(value))
+    if python_type is datetime.date:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    return python_type(value)
+
+
+def is_naive_datetime(col):
+    """
+    :param col: a column
+
+    :return: whether col is a :class:`~sqlalchemy.types.DateTime` column without a time zone, \
+    whose values :func:`json_datetime` formats as they are serialized to JSON
+    """
+    return isinstance(col.type, sa.DateTime) and not col.type.timezone
+
+
+def json_datetime(dialect, expr):
+    """
+    :param dialect: the :py:class:`~sqlalchemy.engine.interfaces.Dialect` of the database
+    :param expr: a SQL expression of a naive datetime, e.g. a :class:`~sqlalchemy.types.DateTime` \
+        column
+
+    :return: an expression of expr as text in the format it is serialized to JSON by \
+    :class:`VAJSONEncoder`, i.e. ``datetime.isoformat()`` which leaves out microseconds of 0, for \
+    values put into JSON by the database. Other databases than SQLite, MySQL and PostgreSQL get \
+    expr as is.
+    """
+    if dialect.name == 'sqlite':
+        # SQLAlchemy stores datetimes as e.g. '2020-01-01 12:30:00.000000'
+        text = sa.func.replace(expr, ' ', 'T')
+        return sa.case(
+            [(sa.func.substr(expr, 20) == '.000000', sa.func.substr(text, 1, 19))], else_=text
+        )
+    if dialect.name == 'mysql':
+        fmt = '%Y-%m-%dT%H:%i:%s'
+        return sa.case(
+            [(sa.func.microsecond(expr) == 0, sa.func.date_format(expr, fmt))],
+            else_=sa.func.date_format(expr, fmt + '.%f'),
+        )
+    if dialect.name == 'postgresql':
+        fmt = 'YYYY-MM-DD"T"HH24:MI:SS'
+        return sa.case(
+            [(sa.func.to_char(expr, 'US') == '000000', sa.func.to_char(expr, fmt))],
+            else_=sa.func.to_char(expr, fmt + '.US'),
+        )
+    return expr
+
+
 class _JSONEncoded(TypeDecorator):
     """
     Does validation and serde on a JSON python type (list, dict, int, str) to
     a text based column in a SQL database. This class should be overriden for each
     primitive JSON type.
+
+    Strings are validated as JSON of the right type and stored as is. The codec used for serde can
+    be selected with :func:`set_json_codec`.
     """
 
     impl = UnicodeText
@@ -187,23 +577,24 @@ class _JSONEncoded(TypeDecorator):
         if value is None:
             return None
         elif isinstance(value, six.string_types):
-            value = json.loads(value)
+            self._check_type(json_loads(value))
+            return six.ensure_text(value)
 
-        if self.json_type is not None and not isinstance(value, self.json_type):
-            raise ValueError('value of type {} is not {}'.format(type(value), self.json_type))
-
-        return json.dumps(value, ensure_ascii=False, cls=VAJSONEncoder)
+        self._check_type(value)
+        return json_dumps(value)
 
     def process_result_value(self, value, dialect):
         if value is None:
             return None
 
-        value = json.loads(value)
+        value = json_loads(value)
+        self._check_type(value)
+        return value
+
+    def _check_type(self, value):
         if self.json_type is not None and not isinstance(value, self.json_type):
             raise ValueError('value of type {} is not {}'.format(type(value), self.json_type))
 
-        return value
-
 
 class JSONEncodedList(_JSONEncoded):
     json_type = list
@@ -211,3 +602,143 @@ class JSONEncodedList(_JSONEncoded):
 
 class JSONEncodedDict(_JSONEncoded):
     json_type = dict
+
+
+class _Compressor(object):
+    def __init__(self, marker, compress):
+        self.marker = marker
+        self.compress = compress
+
+
+def _zlib_compressor(level):
+    return _Compressor(b'\x01', lambda data: zlib.compress(data, -1 if level is None else level))
+
+
+def _zstd_compressor(level):
+    if zstandard is None:
+        raise ImportError('zstd compression requires the zstandard package')
+    level = 3 if level is None else level
+    # zstandard compressors are not thread safe so one is created per value
+    return _Compressor(b'\x02', lambda data: zstandard.ZstdCompressor(level=level).compress(data))
+
+
+def _zstd_decompress(data):
+    if zstandard is None:
+        raise ImportError('zstd compression requires the zstandard package')
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+_compressors = {
+    'zlib': _zlib_compressor,
+    'zstd': _zstd_compressor,
+}
+_decompressors = {
+    b'\x01': zlib.decompress,
+    b'\x02': _zstd_decompress,
+}
+_UNCOMPRESSED = b'\x00'
+
+
+class _CompressedJSONEncoded(_JSONEncoded):
+    """
+    Stores JSON in a binary column, compressing values whose JSON is larger than ``threshold``
+    bytes. Each value starts with a marker byte telling whether and how it was compressed, so
+    compressed and uncompressed values can be stored in the same column; values without a marker
+    are read as plain JSON, e.g. rows written to the column before it was compressed.
+
+    :param threshold: the size in bytes above which JSON is compressed
+    :param algorithm: ``'zlib'`` or ``'zstd'`` (requires the ``zstandard`` package). Values \
+        compressed with either algorithm can be read regardless of this setting.
+    :param level: the compression level, defaults to the algorithm's default
+    """
+
+    impl = LargeBinary
+
+    def __init__(self, threshold=1024, algorithm='zlib', level=None, *args, **kwargs):
+        if algorithm not in _compressors:
+            raise ValueError('Unknown compression algorithm {}'.format(algorithm))
+        self.threshold = threshold
+        self.algorithm = algorithm
+        self.level = level
+        self._compressor = _compressors[algorithm](level)
+        super(_CompressedJSONEncoded, self).__init__(*args, **kwargs)
+
+    def process_bind_param(self, value, dialect):
+        value = super(_CompressedJSONEncoded, self).process_bind_param(value, dialect)
+        if value is None:
+            return None
+
+        data = value.encode('utf-8')
+        if len(data) <= self.threshold:
+            return _UNCOMPRESSED + data
+        return self._compressor.marker + self._compressor.compress(data)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+
+        if not isinstance(value, six.text_type):
+            value = bytes(value)
+            marker = value[:1]
+            if marker == _UNCOMPRESSED:
+                value = value[1:]
+            elif marker in _decompressors:
+                value = _decompressors[marker](value[1:])
+            value = value.decode('utf-8')
+        return super(_CompressedJSONEncoded, self).process_result_value(value, dialect)
+
+
+class CompressedJSONEncodedDict(_CompressedJSONEncoded):
+    """
+    A :class:`JSONEncodedDict` which compresses large values. This can be used for the
+    ``va_data`` column of a log table by overriding it in the model:
+
+    .. code-block:: python
+
+        class ExampleArchive(Base, VALogMixin):
+            va_data = sa.Column(utils.CompressedJSONEncodedDict(threshold=512), nullable=False)
+    """
+    json_type = dict
+
+
+class MsgPackEncodedDict(_JSONEncoded):
+    """
+    Stores a dict as `MessagePack <https://msgpack.org/>`_ in a binary column, which is more
+    compact than JSON text and faster to serialize and parse. Values which are not natively
+    supported (datetimes, dates, decimals and UUIDs) are stored the same way as by
+    :class:`VAJSONEncoder`, so rows read back are the same as with :class:`JSONEncodedDict`.
+
+    This can be used for the ``va_data`` column of a log table by overriding it in the model:
+
+    .. code-block:: python
+
+        class ExampleArchive(Base, VALogMixin):
+            va_data = sa.Column(utils.MsgPackEncodedDict, nullable=False)
+
+    Requires the ``msgpack`` package (``pip install versionalchemy[msgpack]``).
+    """
+
+    impl = LargeBinary
+    json_type = dict
+
+    def __init__(self, *args, **kwargs):
+        if msgpack is None:
+            raise ImportError('MsgPackEncodedDict requires the msgpack package')
+        super(MsgPackEncodedDict, self).__init__(*args, **kwargs)
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        elif isinstance(value, six.string_types):
+            value = json_loads(value)
+
+        self._check_type(value)
+        return msgpack.packb(value, use_bin_type=True, default=_json_default)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+
+        value = msgpack.unpackb(value, raw=False)
+        self._check_type(value)
+        return value